@@ -0,0 +1,471 @@
+import bisect
+import logging
+import math
+import typing
+
+import numpy as np
+import pandas as pd
+
+from models import *
+from indicators import Macd, Rsi
+
+logger = logging.getLogger()
+
+
+class CandleData:
+    def __init__(self, timestamp: np.ndarray, open_: np.ndarray, high: np.ndarray, low: np.ndarray, close: np.ndarray,
+                 volume: np.ndarray):
+
+        """
+        Candles of one symbol / timeframe stored as columns.
+        """
+
+        self.timestamp = np.asarray(timestamp, dtype=np.int64)
+        self.open = np.asarray(open_, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+        self.close = np.asarray(close, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.float64)
+
+    @classmethod
+    def from_candles(cls, candles: typing.List[Candle]) -> "CandleData":
+        return cls(np.array([c.timestamp for c in candles]), np.array([c.open for c in candles]),
+                   np.array([c.high for c in candles]), np.array([c.low for c in candles]),
+                   np.array([c.close for c in candles]), np.array([c.volume for c in candles]))
+
+    def __len__(self) -> int:
+        return len(self.timestamp)
+
+    def slice(self, start: int, end: int) -> "CandleData":
+        return CandleData(self.timestamp[start:end], self.open[start:end], self.high[start:end], self.low[start:end],
+                          self.close[start:end], self.volume[start:end])
+
+
+class Prints:
+    def __init__(self, price: np.ndarray, volume: np.ndarray, candle_index: np.ndarray):
+
+        """
+        The sequence of trades the strategies react to, each one belonging to a candle.
+        :param price:
+        :param volume:
+        :param candle_index: Index of the candle of each print, sorted
+        """
+
+        self.price = np.asarray(price, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.float64)
+        self.candle_index = np.asarray(candle_index, dtype=np.int64)
+
+    @classmethod
+    def from_candles(cls, candles: CandleData) -> "Prints":
+
+        """
+        Intrabar path when only candles are available: 4 prints per candle, open, low, high, close for a bullish
+        candle and open, high, low, close for a bearish one, each with a quarter of the volume.
+        :param candles:
+        :return:
+        """
+
+        bullish = candles.close >= candles.open
+
+        price = np.empty((len(candles), 4))
+        price[:, 0] = candles.open
+        price[:, 1] = np.where(bullish, candles.low, candles.high)
+        price[:, 2] = np.where(bullish, candles.high, candles.low)
+        price[:, 3] = candles.close
+
+        volume = np.repeat(candles.volume / 4, 4)
+
+        return cls(price.ravel(), volume, np.repeat(np.arange(len(candles)), 4))
+
+    def __len__(self) -> int:
+        return len(self.price)
+
+
+class BacktestResult:
+    def __init__(self, trades: pd.DataFrame, equity: np.ndarray, initial_balance: float):
+
+        """
+        :param trades: One row per trade: side, entry_time, entry_price, exit_time, exit_price, quantity, fees, pnl,
+        reason (take_profit, stop_loss or end_of_data)
+        :param equity: Balance + unrealized PnL at the close of each candle
+        :param initial_balance:
+        """
+
+        self.trades = trades
+        self.equity = equity
+        self.initial_balance = initial_balance
+
+    @property
+    def net_pnl(self) -> float:
+        return float(self.trades['pnl'].sum()) if len(self.trades) > 0 else 0.0
+
+    @property
+    def trade_count(self) -> int:
+        return len(self.trades)
+
+    @property
+    def win_rate(self) -> float:
+        return float((self.trades['pnl'] > 0).mean()) if len(self.trades) > 0 else 0.0
+
+    @property
+    def profit_factor(self) -> float:
+        gains = self.trades['pnl'][self.trades['pnl'] > 0].sum()
+        losses = -self.trades['pnl'][self.trades['pnl'] < 0].sum()
+        return float(gains / losses) if losses > 0 else math.inf if gains > 0 else 0.0
+
+    @property
+    def max_drawdown(self) -> float:
+
+        """
+        Largest drop of the equity from its previous peak, as a fraction of the peak.
+        """
+
+        if len(self.equity) == 0:
+            return 0.0
+        peaks = np.maximum.accumulate(self.equity)
+        return float(np.max((peaks - self.equity) / peaks))
+
+    @property
+    def sharpe(self) -> float:
+
+        """
+        Mean / standard deviation of the equity returns per candle (not annualized).
+        """
+
+        returns = np.diff(self.equity) / self.equity[:-1]
+        std = returns.std() if len(returns) > 1 else 0
+        return float(returns.mean() / std) if std > 0 else 0.0
+
+    def metric(self, name: str) -> float:
+        return getattr(self, name)
+
+
+class Backtester:
+    def __init__(self, candles: CandleData, strategy: str, other_params: typing.Dict, take_profit: typing.Optional[float],
+                 stop_loss: typing.Optional[float], balance_pct: float = 100, initial_balance: float = 1000,
+                 fee_rate: float = 0.0004, slippage: float = 0.0, prints: typing.Optional[Prints] = None):
+
+        """
+        Runs the rules of TechnicalStrategy / BreakoutStrategy over historical data.
+        Like the live strategies: the Technical signal is checked on the first print of a candle with the indicators
+        of the candle that just closed, the Breakout signal on every print, the take profit / stop loss on every print
+        after the entry (before the signal, so a position can be reopened on the print that closed the previous one),
+        and a single position is open at a time. Orders are filled at the print price.
+        :param candles:
+        :param strategy: Technical or Breakout
+        :param other_params: Same as the strategy parameters popup
+        :param take_profit: In %, None to disable
+        :param stop_loss: In %, None to disable
+        :param balance_pct: Percentage of the current balance used by each trade
+        :param initial_balance: In quote asset
+        :param fee_rate: Fraction of the notional paid on each fill
+        :param slippage: Fraction of the price lost on each fill
+        :param prints: Real trades (tick data), by default a path of 4 prints per candle is used
+        """
+
+        self.candles = candles
+        self.strategy = strategy
+        self.other_params = other_params
+        self.take_profit = take_profit
+        self.stop_loss = stop_loss
+        self.balance_pct = balance_pct
+        self.initial_balance = initial_balance
+        self.fee_rate = fee_rate
+        self.slippage = slippage
+
+        self.prints = prints if prints is not None else Prints.from_candles(candles)
+
+    # Vectorized engine
+
+    def _technical_signals(self) -> np.ndarray:
+
+        """
+        Signal of each closed candle, same formulas as the streaming indicators (pandas adjusted EWM).
+        :return: 1 long, -1 short, 0 nothing
+        """
+
+        closes = pd.Series(self.candles.close)
+
+        ema_fast = closes.ewm(span=self.other_params['ema_fast']).mean()
+        ema_slow = closes.ewm(span=self.other_params['ema_slow']).mean()
+        macd_line = ema_fast - ema_slow
+        macd_signal = macd_line.ewm(span=self.other_params['ema_signal']).mean()
+
+        rsi_length = self.other_params['rsi_length']
+        delta = closes.diff()
+        avg_gain = delta.clip(lower=0).iloc[1:].ewm(com=rsi_length - 1, min_periods=rsi_length).mean()
+        avg_loss = (-delta).clip(lower=0).iloc[1:].ewm(com=rsi_length - 1, min_periods=rsi_length).mean()
+        rsi = (100 - 100 / (1 + avg_gain / avg_loss)).round(2).reindex(closes.index).to_numpy()
+
+        macd_line = macd_line.to_numpy()
+        macd_signal = macd_signal.to_numpy()
+
+        return np.where((rsi < 30) & (macd_line > macd_signal), 1,
+                        np.where((rsi > 70) & (macd_line < macd_signal), -1, 0))
+
+    def _entry_candidates(self) -> typing.Tuple[np.ndarray, np.ndarray]:
+
+        """
+        Prints on which the strategy would open a position if it had none.
+        :return: Print indexes (sorted) and sides
+        """
+
+        prints = self.prints
+
+        if self.strategy == "Technical":
+            signals = self._technical_signals()
+
+            # First print of each candle, the signal comes from the previous candle
+            first_prints = np.flatnonzero(np.diff(prints.candle_index, prepend=-1) != 0)
+            candle_index = prints.candle_index[first_prints]
+
+            valid = candle_index >= 1
+            first_prints, candle_index = first_prints[valid], candle_index[valid]
+
+            sides = signals[candle_index - 1]
+            return first_prints[sides != 0], sides[sides != 0]
+
+        elif self.strategy == "Breakout":
+            min_volume = self.other_params['min_volume']
+
+            # Volume of the forming candle after each print
+            cumulative_volume = np.cumsum(prints.volume)
+            candle_start = np.flatnonzero(np.diff(prints.candle_index, prepend=-1) != 0)
+            start_volume = (cumulative_volume - prints.volume)[candle_start]
+            candle_volume = cumulative_volume - np.repeat(start_volume, np.diff(np.append(candle_start, len(prints))))
+
+            previous = np.maximum(prints.candle_index - 1, 0)
+            valid = (prints.candle_index >= 1) & (candle_volume > min_volume)
+
+            long = valid & (prints.price > self.candles.high[previous])
+            short = valid & ~long & (prints.price < self.candles.low[previous])
+
+            indexes = np.flatnonzero(long | short)
+            return indexes, np.where(long[indexes], 1, -1)
+
+        raise ValueError(f"Unknown strategy {self.strategy}")
+
+    def _levels(self, side: int, entry_price: float) -> typing.Tuple[float, float]:
+
+        """
+        :return: Exit if the price goes at or above the first level, or at or below the second one
+        """
+
+        up, down = math.inf, -math.inf
+
+        if side == 1:
+            if self.take_profit is not None:
+                up = entry_price * (1 + self.take_profit / 100)
+            if self.stop_loss is not None:
+                down = entry_price * (1 - self.stop_loss / 100)
+        else:
+            if self.stop_loss is not None:
+                up = entry_price * (1 + self.stop_loss / 100)
+            if self.take_profit is not None:
+                down = entry_price * (1 - self.take_profit / 100)
+
+        return up, down
+
+    def _find_exit(self, start: int, up: float, down: float) -> typing.Optional[int]:
+
+        """
+        First print from start reaching one of the levels. Searched by windows of growing size so short trades only
+        scan a few prints and long ones a few windows.
+        """
+
+        price = self.prints.price
+        window = 64
+
+        while start < len(price):
+            chunk = price[start:start + window]
+            hits = (chunk >= up) | (chunk <= down)
+            first = int(hits.argmax())
+            if hits[first]:
+                return start + first
+            start += window
+            window *= 4
+
+        return None
+
+    def _fill_price(self, price: float, side: int) -> float:
+        return price * (1 + self.slippage * side)  # Buying fills higher, selling lower
+
+    def _close_trade(self, trades: typing.List[typing.Dict], side: int, entry_print: int, entry_price: float,
+                     quantity: float, exit_print: int, exit_price: float, reason: str) -> float:
+
+        fees = (entry_price + exit_price) * quantity * self.fee_rate
+        pnl = side * (exit_price - entry_price) * quantity - fees
+
+        trades.append({"side": "long" if side == 1 else "short", "entry_price": entry_price, "exit_price": exit_price,
+                       "quantity": quantity, "fees": fees, "pnl": pnl, "reason": reason,
+                       "entry_print": entry_print, "exit_print": exit_print})
+
+        return pnl
+
+    def run(self) -> BacktestResult:
+
+        """
+        Vectorized backtest: the entry candidates and the exit of each position are found with array operations, the
+        only Python loop is over the trades.
+        :return:
+        """
+
+        candidates, sides = self._entry_candidates()
+        candidates, sides = candidates.tolist(), sides.tolist()
+        price = self.prints.price
+
+        trades = []
+        balance = self.initial_balance
+        next_print = 0
+
+        while True:
+            i = bisect.bisect_left(candidates, next_print)
+            if i == len(candidates):
+                break
+
+            entry_print, side = candidates[i], sides[i]
+            entry_price = self._fill_price(price.item(entry_print), side)
+            quantity = balance * self.balance_pct / 100 / entry_price
+
+            up, down = self._levels(side, entry_price)
+            exit_print = self._find_exit(entry_print + 1, up, down)
+
+            if exit_print is None:
+                exit_print = len(price) - 1
+                reason = "end_of_data"
+            else:
+                reason = "take_profit" if (price.item(exit_print) >= up) == (side == 1) else "stop_loss"
+
+            exit_price = self._fill_price(price.item(exit_print), -side)
+            balance += self._close_trade(trades, side, entry_print, entry_price, quantity, exit_print, exit_price,
+                                         reason)
+
+            if reason == "end_of_data" or balance <= 0:
+                break
+
+            next_print = exit_print
+
+        return self._result(trades)
+
+    def _result(self, trades: typing.List[typing.Dict]) -> BacktestResult:
+
+        """
+        Equity at each candle close: realized PnL of the trades exited so far (entry fees paid at the entry) and the
+        unrealized PnL of the open position, built with difference arrays instead of a loop over the candles.
+        """
+
+        trades_df = pd.DataFrame(trades, columns=["side", "entry_price", "exit_price", "quantity", "fees", "pnl", "reason",
+                                                  "entry_print", "exit_print"])
+
+        n = len(self.candles)
+        realized = np.zeros(n + 1)
+        position = np.zeros(n + 1)
+        cost = np.zeros(n + 1)
+
+        if len(trades_df) > 0:
+            candle_index = self.prints.candle_index
+            entry_candle = candle_index[trades_df['entry_print'].to_numpy(dtype=np.int64)]
+            exit_candle = candle_index[trades_df['exit_print'].to_numpy(dtype=np.int64)]
+
+            trades_df['entry_time'] = self.candles.timestamp[entry_candle]
+            trades_df['exit_time'] = self.candles.timestamp[exit_candle]
+
+            side = np.where(trades_df['side'] == "long", 1.0, -1.0)
+            quantity = trades_df['quantity'].to_numpy()
+            entry_price = trades_df['entry_price'].to_numpy()
+            entry_fee = entry_price * quantity * self.fee_rate
+
+            np.add.at(realized, entry_candle, -entry_fee)
+            np.add.at(realized, exit_candle, trades_df['pnl'].to_numpy() + entry_fee)
+
+            # The position is marked to market at the close of the candles from its entry until before its exit
+            np.add.at(position, entry_candle, side * quantity)
+            np.add.at(position, exit_candle, -side * quantity)
+            np.add.at(cost, entry_candle, side * quantity * entry_price)
+            np.add.at(cost, exit_candle, -side * quantity * entry_price)
+
+        equity = (self.initial_balance + np.cumsum(realized)[:n] + np.cumsum(position)[:n] * self.candles.close
+                  - np.cumsum(cost)[:n])
+
+        columns = ["side", "entry_time", "entry_price", "exit_time", "exit_price", "quantity", "fees", "pnl", "reason"]
+        return BacktestResult(trades_df[columns], equity, self.initial_balance)
+
+    # Event-driven replay
+
+    def replay(self) -> BacktestResult:
+
+        """
+        Steps through the prints one by one with the streaming indicators, like the live strategies do.
+        Much slower than run(), used to check that both give the same trades.
+        :return:
+        """
+
+        prints = self.prints
+        candles = self.candles
+
+        macd = rsi = None
+        if self.strategy == "Technical":
+            macd = Macd(self.other_params['ema_fast'], self.other_params['ema_slow'], self.other_params['ema_signal'])
+            rsi = Rsi(self.other_params['rsi_length'])
+
+        trades = []
+        balance = self.initial_balance
+        position = None  # (side, entry_print, entry_price, quantity, up, down)
+
+        current_candle = -1
+        candle_volume = 0.0
+
+        for k in range(len(prints)):
+            price = float(prints.price[k])
+            candle = int(prints.candle_index[k])
+
+            new_candle = candle != current_candle
+            if new_candle:
+                if macd is not None and current_candle >= 0:
+                    macd.update(float(candles.close[current_candle]))
+                    rsi.update(float(candles.close[current_candle]))
+                current_candle = candle
+                candle_volume = 0.0
+
+            candle_volume += float(prints.volume[k])
+
+            # Take profit / stop loss, checked before the signal like the TriggerBook
+
+            if position is not None and k > position[1]:
+                side, entry_print, entry_price, quantity, up, down = position
+                if price >= up or price <= down:
+                    reason = "take_profit" if (price >= up) == (side == 1) else "stop_loss"
+                    balance += self._close_trade(trades, side, entry_print, entry_price, quantity, k,
+                                                 self._fill_price(price, -side), reason)
+                    position = None
+
+            if position is not None or candle == 0 or balance <= 0:
+                continue
+
+            signal = 0
+
+            if self.strategy == "Technical":
+                if new_candle:
+                    if rsi.value < 30 and macd.macd_line > macd.macd_signal:
+                        signal = 1
+                    elif rsi.value > 70 and macd.macd_line < macd.macd_signal:
+                        signal = -1
+
+            elif self.strategy == "Breakout":
+                if price > candles.high[candle - 1] and candle_volume > self.other_params['min_volume']:
+                    signal = 1
+                elif price < candles.low[candle - 1] and candle_volume > self.other_params['min_volume']:
+                    signal = -1
+
+            if signal != 0:
+                entry_price = self._fill_price(price, signal)
+                quantity = balance * self.balance_pct / 100 / entry_price
+                position = (signal, k, entry_price, quantity) + self._levels(signal, entry_price)
+
+        if position is not None:
+            side, entry_print, entry_price, quantity, up, down = position
+            last = len(prints) - 1
+            balance += self._close_trade(trades, side, entry_print, entry_price, quantity, last,
+                                         self._fill_price(float(prints.price[last]), -side), "end_of_data")
+
+        return self._result(trades)
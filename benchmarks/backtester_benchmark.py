@@ -0,0 +1,44 @@
+"""
+Time the vectorized backtest over two years of 1m candles and check that it gives the same trades and equity curve as
+the event-driven replay on a shorter period.
+Run from the project root: python -m benchmarks.backtester_benchmark
+"""
+
+import time
+
+import numpy as np
+
+from backtester import Backtester, CandleData
+
+STRATEGIES = [("Technical", {'ema_fast': 12, 'ema_slow': 26, 'ema_signal': 9, 'rsi_length': 14}),
+              ("Breakout", {'min_volume': 15})]
+
+
+def random_candles(n: int, seed: int = 0) -> CandleData:
+    rng = np.random.default_rng(seed)
+
+    close = 20000 * np.exp(np.cumsum(rng.normal(0, 0.001, n)))
+    open_ = np.r_[close[0], close[:-1]]
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.0005, n)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.0005, n)))
+
+    return CandleData(np.arange(n) * 60000, open_, high, low, close, rng.exponential(10, n))
+
+
+if __name__ == '__main__':
+    for strategy, params in STRATEGIES:
+        backtester = Backtester(random_candles(20_000), strategy, params, 1.0, 0.5, slippage=0.0001)
+        vectorized, replay = backtester.run(), backtester.replay()
+
+        columns = ["entry_time", "entry_price", "exit_time", "exit_price", "pnl"]
+        same = (len(vectorized.trades) == len(replay.trades)
+                and np.allclose(vectorized.trades[columns].to_numpy(float), replay.trades[columns].to_numpy(float))
+                and np.allclose(vectorized.equity, replay.equity))
+
+        candles = random_candles(2 * 365 * 1440)
+        start = time.perf_counter()
+        result = Backtester(candles, strategy, params, 1.0, 0.5, slippage=0.0001).run()
+        duration = time.perf_counter() - start
+
+        print(f"{strategy:>9} | same trades as the replay: {same} | {len(candles)} candles in {duration:.3f} s "
+              f"({result.trade_count} trades, net PnL {result.net_pnl:.2f})")
@@ -0,0 +1,74 @@
+"""
+Close-to-signal latency of a strategy: time between the end of a candle and the end of the signal evaluation.
+Compares the candles closed by the first trade of the next period (previous behavior) with the timer
+closing them close_delay after the boundary, for a liquid symbol (a print every 5 ms) and an illiquid one (a print
+every 2 s on average).
+Run from the project root: python -m benchmarks.candle_close_latency
+"""
+
+import random
+import statistics
+import threading
+import time
+
+from candle_aggregator import CandleAggregator
+from models import Candle
+from strategies import Strategy
+
+ROUNDS = 3
+
+
+class TradeDrivenAggregator(CandleAggregator):
+    def _arm_timer(self):
+        pass
+
+
+class Contract:
+    symbol = "BTCUSDT"
+
+
+class Client:
+    platform = "binance_futures"
+
+    @staticmethod
+    def get_trade_size(contract, price: float, balance_pct: float):
+        return None  # No order ticket, the benchmark never trades
+
+
+def measure(aggregator_class, print_gap: float) -> float:
+    latencies = []
+
+    for _ in range(ROUNDS):
+        now = int(time.time() * 1000)
+        candle_info = {'ts': now - 60000 + 200, 'open': 100, 'high': 100, 'low': 100, 'close': 100, 'volume': 1}
+
+        aggregator = aggregator_class("binance", "BTCUSDT")
+        aggregator.add_timeframe("1m", [Candle(candle_info, "1m", "parse_trade")])
+
+        strategy = Strategy(Client(), Contract(), "Binance", "1m", 1, None, None, "Benchmark")
+        aggregator.subscribe(strategy)
+
+        stop = threading.Event()
+
+        def feed():
+            while not stop.is_set():
+                time.sleep(random.expovariate(1 / print_gap))
+                aggregator.parse_trade(100, 1, int(time.time() * 1000))
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        while len(strategy.close_latencies) == 0:
+            time.sleep(0.001)
+
+        stop.set()
+        latencies.append(strategy.close_latencies[0])
+
+    return statistics.mean(latencies)
+
+
+if __name__ == '__main__':
+    for name, gap in [("liquid", 0.005), ("illiquid", 2)]:
+        trade_driven = measure(TradeDrivenAggregator, gap)
+        timer_driven = measure(CandleAggregator, gap)
+        print(f"{name:>8} | trade-driven close {trade_driven:>7.1f} ms | timer-driven close {timer_driven:>5.1f} ms")
@@ -0,0 +1,60 @@
+"""
+Load time of exported history: a year of 1m candles of 50 symbols (26 million candles) is exported to the columnar
+format, then read back for the whole year and for one week.
+Run from the project root: python -m benchmarks.history_export_benchmark
+"""
+
+import datetime
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from backtester import CandleData
+from history_export import load_candles, save_candles
+from models import Contract
+
+SYMBOLS = [f"SYM{i}USDT" for i in range(50)]
+START = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+TF_MS = 60 * 1000
+
+
+def make_candles(rng: np.random.Generator, n: int) -> CandleData:
+    first = int(START.timestamp() * 1000)
+    close = np.round(20000 + np.cumsum(rng.normal(0, 5, n)), 1)
+    open_ = np.r_[close[0], close[:-1]]
+    spread = np.round(np.abs(rng.normal(0, 3, n)), 1)
+    return CandleData(first + np.arange(n) * TF_MS, open_, np.maximum(open_, close) + spread,
+                      np.minimum(open_, close) - spread, close, np.round(rng.exponential(5, n), 3))
+
+
+if __name__ == '__main__':
+    data_dir = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    n = 365 * 24 * 60
+
+    for symbol in SYMBOLS:
+        contract = Contract({'symbol': symbol, 'baseAsset': symbol[:-4], 'quoteAsset': "USDT", 'pricePrecision': 1,
+                             'quantityPrecision': 3,
+                             'filters': [{'filterType': "PRICE_FILTER", 'tickSize': "0.10"},
+                                         {'filterType': "LOT_SIZE", 'stepSize': "0.001"}]}, "binance")
+        candles = make_candles(rng, n)
+        save_candles(data_dir, "binance_futures", contract, "1m", candles)
+
+    size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(data_dir) for f in files)
+    print(f"exported      | {len(SYMBOLS)} symbols x {n} candles, {size / 1e6:.0f} MB "
+          f"({size / (len(SYMBOLS) * n * 48):.0%} of float64 columns)")
+
+    year_start = int(START.timestamp() * 1000)
+    year_end = year_start + n * TF_MS
+
+    loaded = load_candles(data_dir, "binance_futures", SYMBOLS[-1], "1m", year_start, year_end)
+    assert np.array_equal(loaded.close, candles.close) and np.array_equal(loaded.volume, candles.volume)
+
+    for label, start, end in [("one year", year_start, year_end),
+                              ("one week", year_start + 180 * 24 * 3600 * 1000, year_start + 187 * 24 * 3600 * 1000)]:
+        t = time.perf_counter()
+        total = sum(len(load_candles(data_dir, "binance_futures", symbol, "1m", start, end)) for symbol in SYMBOLS)
+        print(f"{label:<14}| {total} candles of {len(SYMBOLS)} symbols loaded in "
+              f"{(time.perf_counter() - t) * 1000:.0f} ms")
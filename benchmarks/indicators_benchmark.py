@@ -0,0 +1,70 @@
+"""
+Compare the cost of the MACD / RSI computed with pandas over the whole candle history (previous implementation of
+TechnicalStrategy) with the streaming indicators updated once per closed candle.
+Run from the project root: python -m benchmarks.indicators_benchmark
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from indicators import Macd, Rsi
+
+
+EMA_FAST, EMA_SLOW, EMA_SIGNAL, RSI_LENGTH = 12, 26, 9, 14
+CALLS = 50  # Number of closed candles timed for each history size
+
+
+def pandas_macd_rsi(closes: pd.Series):
+    ema_fast = closes.ewm(span=EMA_FAST).mean()
+    ema_slow = closes.ewm(span=EMA_SLOW).mean()
+    macd_line = ema_fast - ema_slow
+    macd_signal = macd_line.ewm(span=EMA_SIGNAL).mean()
+
+    delta = closes.diff().dropna()
+    up, down = delta.copy(), delta.copy()
+    up[up < 0] = 0
+    down[down > 0] = 0
+    avg_gain = up.ewm(com=(RSI_LENGTH - 1), min_periods=RSI_LENGTH).mean()
+    avg_loss = down.abs().ewm(com=(RSI_LENGTH - 1), min_periods=RSI_LENGTH).mean()
+    rsi = (100 - 100 / (1 + avg_gain / avg_loss)).round(2)
+
+    return macd_line, macd_signal, rsi
+
+
+def run(size: int):
+    closes = 20000 + np.cumsum(np.random.default_rng(size).normal(0, 10, size + CALLS))
+
+    # Previous implementation: the candle list is converted and every average recomputed on each new candle
+
+    start = time.perf_counter()
+    for i in range(size, size + CALLS):
+        pandas_macd_rsi(pd.Series(list(closes[:i])))
+    pandas_us = (time.perf_counter() - start) / CALLS * 1e6
+
+    # Streaming implementation: seeded once from history, then one O(1) update per closed candle
+
+    macd = Macd(EMA_FAST, EMA_SLOW, EMA_SIGNAL)
+    rsi = Rsi(RSI_LENGTH)
+    for close in closes[:size]:
+        macd.update(close)
+        rsi.update(close)
+
+    start = time.perf_counter()
+    for close in closes[size:]:
+        macd.update(close)
+        rsi.update(close)
+    streaming_us = (time.perf_counter() - start) / CALLS * 1e6
+
+    macd_line, macd_signal, rsi_values = pandas_macd_rsi(pd.Series(closes))
+    max_error = max(abs(macd_line.iloc[-1] - macd.macd_line), abs(macd_signal.iloc[-1] - macd.macd_signal),
+                    abs(rsi_values.iloc[-1] - rsi.value))
+
+    print(f"{size:>7} candles | pandas {pandas_us:>10.1f} us/candle | streaming {streaming_us:>6.2f} us/candle "
+          f"| x{pandas_us / streaming_us:>8.0f} | max abs difference {max_error:.2e}")
+
+
+if __name__ == '__main__':
+    for n in [1_000, 10_000, 100_000]:
+        run(n)
@@ -0,0 +1,44 @@
+"""
+Write rate of the market data store: 1 million trades of 100 symbols go through the dispatcher handler, then the time
+until all of them are on disk gives the sustained rate of the background writer, to compare with the rate of the
+aggTrade streams (a few thousand trades per second for the 100 most active Binance futures symbols).
+Then the trades of one symbol are read back and rebuilt into 1m candles.
+Run from the project root: python -m benchmarks.market_store_benchmark
+"""
+
+import tempfile
+import time
+
+from events import TradeEvent
+from market_store import MarketDataStore
+
+SYMBOLS = [f"SYM{i}USDT" for i in range(100)]
+TRADES = 1000000
+
+
+if __name__ == '__main__':
+    store = MarketDataStore(tempfile.mkdtemp())
+    store.start(["binance_futures"], quotes=False, candles=False)
+
+    first = 1700000000000
+    events = [TradeEvent("binance_futures", SYMBOLS[i % len(SYMBOLS)], 100 + (i % 97) / 10, 0.01 * (1 + i % 5),
+                         first + i) for i in range(TRADES)]
+
+    start = time.perf_counter()
+    for event in events:
+        store._on_trade(event)
+    handled = time.perf_counter() - start
+
+    store.flush(None)
+    written = time.perf_counter() - start
+
+    print(f"handler       | {handled / TRADES * 1e9:>7.0f} ns per trade in the dispatcher thread")
+    print(f"writer        | {TRADES / written:>9.0f} trades/s sustained ({store.rows} rows, {store.dropped} dropped)")
+
+    del events
+
+    start = time.perf_counter()
+    ticks = store.trades("binance_futures", SYMBOLS[0], first, first + TRADES)
+    candles = ticks.candles("1m")
+    print(f"range query   | {len(ticks)} trades read and {len(candles)} candles rebuilt in "
+          f"{(time.perf_counter() - start) * 1000:.1f} ms")
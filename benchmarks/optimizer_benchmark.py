@@ -0,0 +1,38 @@
+"""
+Time a parameter grid search over one year of 1m candles with an increasing number of worker processes, then run a
+walk-forward analysis with all the cores.
+Run from the project root: python -m benchmarks.optimizer_benchmark
+"""
+
+import os
+import time
+
+from benchmarks.backtester_benchmark import random_candles
+from optimizer import Optimizer
+
+PARAM_GRID = {'ema_fast': [8, 12, 16], 'ema_slow': [26, 40], 'ema_signal': [9], 'rsi_length': [14],
+              'take_profit': [0.5, 1.0, 2.0], 'stop_loss': [0.5, 1.0]}
+
+
+if __name__ == '__main__':
+    candles = random_candles(365 * 1440)
+
+    workers = 1
+    while workers <= os.cpu_count():
+        optimizer = Optimizer(candles, "Technical", PARAM_GRID, metric="sharpe", workers=workers,
+                              backtest_kwargs={'slippage': 0.0001})
+
+        start = time.perf_counter()
+        results = optimizer.grid_search()
+        duration = time.perf_counter() - start
+
+        print(f"{workers:>3} workers | {len(results)} backtests in {duration:.2f} s | best sharpe "
+              f"{results[0]['sharpe']:.4f} with {results[0]['params']}")
+
+        workers *= 2
+
+    optimizer = Optimizer(candles, "Technical", PARAM_GRID, metric="sharpe", backtest_kwargs={'slippage': 0.0001})
+
+    for split in optimizer.walk_forward(4):
+        print(f"Walk-forward | train sharpe {split['train']['sharpe']:.4f} | test sharpe {split['test']['sharpe']:.4f} "
+              f"| {split['train']['params']}")
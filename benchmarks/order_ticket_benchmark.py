@@ -0,0 +1,78 @@
+"""
+Signal-to-wire latency of a Binance entry order: time between the signal of a strategy and the moment the order
+request leaves for the exchange, with the REST round trips simulated by a fixed delay.
+Compares the previous path (balance request for the trade size, server time request, encoding and signature after the
+signal) with an OrderTicket armed at the candle close (only the timestamp and the signature are left).
+Run from the project root: python -m benchmarks.order_ticket_benchmark
+"""
+
+import statistics
+import time
+
+from connectors.binance_futures import BinanceFuturesClient
+from models import Contract
+from orders import OrderTicket
+
+ROUND_TRIP = 0.03  # Seconds, simulated latency of every REST request
+ORDERS = 50
+
+
+class SimulatedClient(BinanceFuturesClient):
+    def __init__(self):
+        self.futures = True
+        self.platform = "binance_futures"
+        self._secret_key = "benchmark"
+        self.server_time_offset = 0
+
+        self.wire_times = []
+
+    def _make_request(self, method: str, endpoint: str, data):
+        if endpoint == "/fapi/v1/order":
+            self.wire_times.append(time.perf_counter_ns())
+            return None
+
+        time.sleep(ROUND_TRIP)
+
+        if endpoint == "/fapi/v1/time":
+            return {'serverTime': int(time.time() * 1000)}
+        if endpoint == "/fapi/v2/account":
+            return {'assets': [{'asset': "USDT", 'initialMargin': 0, 'maintMargin': 0, 'marginBalance': 1000,
+                                'walletBalance': 1000, 'unrealizedProfit': 0}]}
+
+
+def previous_path(client: SimulatedClient, contract: Contract) -> float:
+    signal_time = time.perf_counter_ns()
+
+    trade_size = client.get_trade_size(contract, 20000, 10)
+
+    # The timestamp came from a server time request
+    data = client._order_params(contract, "MARKET", trade_size, "buy", client_order_id="benchmark")
+    data['timestamp'] = client._get_server_time()
+    data['signature'] = client._generate_signature(data)
+    client._make_request("POST", "/fapi/v1/order", data)
+
+    return (client.wire_times[-1] - signal_time) / 1000
+
+
+def ticket_path(client: SimulatedClient, ticket: OrderTicket) -> float:
+    signal_time = time.perf_counter_ns()
+
+    client.place_order_template(ticket.templates["buy"], "benchmark")
+
+    return (client.wire_times[-1] - signal_time) / 1000
+
+
+if __name__ == '__main__':
+    client = SimulatedClient()
+    contract = Contract({'symbol': "BTCUSDT", 'baseAsset': "BTC", 'quoteAsset': "USDT", 'pricePrecision': 2,
+                         'quantityPrecision': 3}, "binance")
+
+    # Armed at the candle close, out of the signal path
+    trade_size = client.get_trade_size(contract, 20000, 10)
+    ticket = OrderTicket(contract, trade_size, 20000,
+                         {side: client.order_template(contract, "MARKET", trade_size, side) for side in ["buy", "sell"]})
+
+    for name, measure, arg in [("previous path", previous_path, contract), ("order ticket", ticket_path, ticket)]:
+        latencies = sorted(measure(client, arg) for _ in range(ORDERS))
+        print(f"{name:>13} | signal-to-wire median {statistics.median(latencies):>9.1f} us | "
+              f"max {latencies[-1]:>9.1f} us")
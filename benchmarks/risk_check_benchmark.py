@@ -0,0 +1,59 @@
+"""
+Cost of the pre-trade risk checks on the order path: time of PortfolioRisk.reserve() for an order on a portfolio of
+10 to 10000 open positions, and of the quote update that revalues a position.
+The checks only read the running totals, so the time doesn't depend on the number of positions.
+Run from the project root: python -m benchmarks.risk_check_benchmark
+"""
+
+import statistics
+import time
+
+from events import QuoteEvent
+from models import Contract
+from risk import PortfolioRisk
+
+ORDERS = 10000
+
+
+def make_contract(i: int) -> Contract:
+    return Contract({'symbol': f"SYM{i}USDT", 'baseAsset': f"SYM{i}", 'quoteAsset': "USDT", 'pricePrecision': 2,
+                     'quantityPrecision': 3}, "binance")
+
+
+def measure(n_positions: int):
+    risk = PortfolioRisk(max_exposure=1e12, max_open_trades=n_positions + ORDERS + 1,
+                         symbol_caps={f"SYM{i}USDT": 1e9 for i in range(n_positions)})
+
+    contracts = [make_contract(i) for i in range(n_positions)]
+    for i, contract in enumerate(contracts):
+        risk.reserve("binance_futures", contract, "buy", 1, f"open{i}", 100.0)
+        risk.on_fill(f"open{i}", 1, 100.0)
+        risk.release(f"open{i}")
+
+    contract = contracts[0]
+
+    check_times = []
+    for i in range(ORDERS):
+        start = time.perf_counter_ns()
+        risk.reserve("binance_futures", contract, "buy", 0.001, f"order{i}", 100.0)
+        check_times.append(time.perf_counter_ns() - start)
+        risk.release(f"order{i}")
+
+    quote_times = []
+    for i in range(ORDERS):
+        event = QuoteEvent("binance_futures", contract.symbol, 100.0 + i % 10, 100.1 + i % 10)
+        start = time.perf_counter_ns()
+        risk._on_quote(event)
+        quote_times.append(time.perf_counter_ns() - start)
+
+    check_times.sort()
+    quote_times.sort()
+
+    print(f"{n_positions:>6} positions | check median {statistics.median(check_times) / 1000:>5.2f} us, "
+          f"p99 {check_times[int(ORDERS * 0.99)] / 1000:>5.2f} us | "
+          f"quote update median {statistics.median(quote_times) / 1000:>5.2f} us")
+
+
+if __name__ == '__main__':
+    for n in [10, 1000, 10000]:
+        measure(n)
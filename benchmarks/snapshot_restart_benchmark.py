@@ -0,0 +1,118 @@
+"""
+Restart time of 50 Technical strategies (10 symbols x 5 parameter sets, 1m candles): from the start of the strategies to
+their first signal evaluation.
+Compares the cold start (1000 historical candles per symbol, indicators computed from the first candle) with a start
+from the snapshot of the previous run (candles and indicators mapped from the file, 5 candles requested for the gap).
+The REST requests are simulated, with a delay proportional to the number of candles returned.
+Run from the project root: python -m benchmarks.snapshot_restart_benchmark
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from candle_aggregator import CandleAggregator
+from indicators import indicator_registry
+from models import Candle, Contract
+from snapshot import SnapshotStore
+from strategies import TechnicalStrategy
+
+SYMBOLS = [f"SYM{i}USDT" for i in range(10)]
+PARAMS = [{'ema_fast': 12 + i, 'ema_slow': 26 + i, 'ema_signal': 9, 'rsi_length': 14} for i in range(5)]
+TF_MS = 60 * 1000
+REQUEST_TIME = 0.05  # Seconds, for a request of 1000 candles
+
+
+class SimulatedClient:
+    def __init__(self):
+        self.platform = "binance_futures"
+        self.server_time_offset = 0
+        self.aggregators = dict()
+        self.strategies = dict()
+        self.contracts = {s: Contract({'symbol': s, 'baseAsset': s[:-4], 'quoteAsset': "USDT", 'pricePrecision': 2,
+                                       'quantityPrecision': 3}, "binance") for s in SYMBOLS}
+
+    def get_aggregator(self, contract: Contract) -> CandleAggregator:
+        if contract.symbol not in self.aggregators:
+            self.aggregators[contract.symbol] = CandleAggregator(self.platform, contract.symbol)
+        return self.aggregators[contract.symbol]
+
+    def position_table(self, contract: Contract):
+        return self.get_aggregator(contract).positions
+
+    def get_historical_candles(self, contract: Contract, interval: str, start_time=None):
+        now = int(time.time() * 1000)
+        last = now - now % TF_MS
+        first = last - 999 * TF_MS if start_time is None else start_time
+        n = (last - first) // TF_MS + 1
+
+        time.sleep(REQUEST_TIME * n / 1000)
+
+        return [Candle({'ts': ts, 'open': 100 + i % 7, 'high': 101 + i % 7, 'low': 99 + i % 7,
+                        'close': 100 + (i * 37) % 11, 'volume': 10}, interval, "parse_trade")
+                for i, ts in enumerate(range(first, last + 1, TF_MS))]
+
+
+def start_strategies(client: SimulatedClient, store: SnapshotStore) -> float:
+    start = time.perf_counter()
+
+    for symbol in SYMBOLS:
+        contract = client.contracts[symbol]
+        aggregator = client.get_aggregator(contract)
+
+        if not aggregator.has_timeframe("1m"):
+            candles = store.restore_candles(client, contract, "Binance", "1m")
+            if candles is None:
+                candles = client.get_historical_candles(contract, "1m")
+            aggregator.add_timeframe("1m", candles)
+
+        for params in PARAMS:
+            strategy = TechnicalStrategy(client, contract, "Binance", "1m", 10, 1, 1, params)
+            aggregator.subscribe(strategy)
+            strategy._check_signal()  # First evaluation: all the indicators up to date
+            client.strategies[len(client.strategies)] = strategy
+
+    return time.perf_counter() - start
+
+
+def stop_strategies(client: SimulatedClient):
+    for strategy in client.strategies.values():
+        strategy.stop()
+    for aggregator in client.aggregators.values():
+        if aggregator._timer is not None:
+            aggregator._timer.cancel()
+
+
+if __name__ == '__main__':
+    path = os.path.join(tempfile.mkdtemp(), "snapshot.bin")
+
+    # First run: cold start, then a snapshot is taken
+
+    client = SimulatedClient()
+    store = SnapshotStore(path)
+    cold = start_strategies(client, store)
+
+    store.start([client])
+    done = threading.Event()
+    store.take(done)
+    done.wait()
+    stop_strategies(client)
+
+    # Second run, 5 minutes later
+
+    real_time = time.time
+    time.time = lambda: real_time() + 300
+
+    client = SimulatedClient()
+    store = SnapshotStore(path)
+
+    load_start = time.perf_counter()
+    store.load()
+    load_time = time.perf_counter() - load_start
+
+    warm = start_strategies(client, store)
+
+    print(f"cold start    | {cold * 1000:>7.1f} ms")
+    print(f"from snapshot | {warm * 1000:>7.1f} ms (+ {load_time * 1000:.1f} ms to map the file of "
+          f"{os.path.getsize(path)} bytes), {len(indicator_registry)} indicator series restored")
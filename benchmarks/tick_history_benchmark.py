@@ -0,0 +1,63 @@
+"""
+Store one synthetic day of BTCUSDT trades like TickHistory does, then time the memory-mapped read, the rebuild of the
+1m candles and the backtest on the real intrabar path.
+Run from the project root: python -m benchmarks.tick_history_benchmark
+"""
+
+import datetime
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from backtester import Backtester
+from models import Contract
+from tick_history import TickHistory, load_ticks
+
+CONTRACT_INFO = {'symbol': "BTCUSDT", 'baseAsset': "BTC", 'quoteAsset': "USDT", 'pricePrecision': 2,
+                 'quantityPrecision': 3, 'filters': [{'filterType': "PRICE_FILTER", 'tickSize': "0.10"},
+                                                     {'filterType': "LOT_SIZE", 'stepSize': "0.001"}]}
+
+
+class FakeClient:
+    platform = "binance_futures"
+
+
+if __name__ == '__main__':
+    n = 2_000_000
+    rng = np.random.default_rng(0)
+    day = datetime.date(2024, 1, 1)
+    day_start = int(datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+    timestamps = np.sort(rng.integers(day_start, day_start + 24 * 3600 * 1000, n))
+    prices = np.round(40000 * np.exp(np.cumsum(rng.normal(0, 0.00005, n))), 1)
+    quantities = np.round(rng.exponential(0.05, n), 3) + 0.001
+    trades = list(zip(timestamps.tolist(), prices.tolist(), quantities.tolist(), (rng.random(n) < 0.5).tolist()))
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        history = TickHistory(FakeClient(), Contract(CONTRACT_INFO, "binance"), data_dir)
+        history._save_meta()
+        history._save_day(day, trades)
+
+        size = sum(os.path.getsize(os.path.join(history._day_directory(day), f))
+                   for f in os.listdir(history._day_directory(day)))
+
+        start = time.perf_counter()
+        ticks = load_ticks(history.directory, day, day)
+        load_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        candles = ticks.candles("1m")
+        candles_duration = time.perf_counter() - start
+
+        prints = ticks.prints(candles)
+        start = time.perf_counter()
+        result = Backtester(candles, "Breakout", {'min_volume': 1}, 0.2, 0.1, prints=prints).run()
+        backtest_duration = time.perf_counter() - start
+
+        print(f"{len(ticks)} trades, {size / 1e6:.1f} MB on disk | memory-mapped in {load_duration * 1000:.2f} ms | "
+              f"{len(candles)} 1m candles rebuilt in {candles_duration * 1000:.1f} ms | "
+              f"backtest on {len(prints)} prints in {backtest_duration * 1000:.1f} ms ({result.trade_count} trades)")
+
+        assert np.allclose(ticks.price, prices) and candles.high.max() == prices.max()
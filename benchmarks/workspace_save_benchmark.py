@@ -0,0 +1,37 @@
+"""
+Cost of saving a workspace of 5000 strategies: time spent in the interface thread by WorkspaceData.save(), and time of
+the background write for a first save, a save with 10 rows changed and a save with nothing changed.
+Run from the project root: python -m benchmarks.workspace_save_benchmark
+"""
+
+import json
+import os
+import tempfile
+import time
+
+from database import WorkspaceData
+
+ROWS = 5000
+
+
+def make_rows(version: int = 0):
+    params = json.dumps({'ema_fast': 12, 'ema_slow': 26, 'ema_signal': 9, 'rsi_length': 14})
+    return [("Technical", f"SYM{i}USDT_Binance", "1m", 10.0, 2.0, 1.0 + (version if i % 500 == 0 else 0), params,
+             "Live", f"{i:032x}") for i in range(ROWS)]
+
+
+def measure(db: WorkspaceData, rows) -> tuple:
+    start = time.perf_counter()
+    db.save("strategies", rows)
+    queued = time.perf_counter() - start
+    db.flush(None)
+    return queued, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    db = WorkspaceData(os.path.join(tempfile.mkdtemp(), "database.db"))
+
+    for label, rows in [("first save", make_rows()), ("10 rows changed", make_rows(1)),
+                        ("nothing changed", make_rows(1))]:
+        queued, written = measure(db, rows)
+        print(f"{label:<16}| save() {queued * 1000:>6.2f} ms | written after {written * 1000:>6.1f} ms")
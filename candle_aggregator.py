@@ -0,0 +1,344 @@
+import logging
+import threading
+import time
+import typing
+
+from models import *
+from scheduler import Timer
+from events import dispatcher, CandleCloseEvent
+from triggers import TriggerBook
+from positions import PositionTable
+
+if typing.TYPE_CHECKING:
+    from strategies import Strategy
+
+logger = logging.getLogger()
+
+
+class CandleAggregator:
+    def __init__(self, exchange: str, symbol: str, base_timeframe: str = "1m", clock_offset: int = 0,
+                 close_delay: int = 300):
+
+        """
+        Builds the candles of one symbol from the trades stream, shared by all the strategies running on it.
+        Every print updates the base timeframe candle, the higher timeframes are rolled up from it: their forming candle
+        takes the same update and they only check for a new period when the base candle closes.
+        The work done per print depends on the number of timeframes, not on the number of strategies.
+        Candles are also closed by a timer shortly after the timeframe boundary (in the exchange clock), so the
+        strategies get the candle close event even when no trade happens after the boundary. The delay leaves time for
+        the last prints of the period to arrive, the prints older than the forming candle are dropped.
+        :param exchange:
+        :param symbol:
+        :param base_timeframe: Smallest timeframe, every other timeframe must be a multiple of it
+        :param clock_offset: Exchange server time - local time, in milliseconds
+        :param close_delay: In milliseconds after the boundary, for the close by the timer
+        """
+
+        self.exchange = exchange
+        self.symbol = symbol
+        self.base_tf = base_timeframe
+
+        self.candles: typing.Dict[str, typing.List[Candle]] = {base_timeframe: []}
+        self._derived_tfs: typing.List[str] = []
+
+        # The base candles are built from the trades as soon as the aggregator exists, even without their history
+        self._history_loaded: typing.Set[str] = set()
+
+        # Timeframe -> forming candle started by the timer, without any trade yet: the first trade gives its open
+        self._timer_candles: typing.Dict[str, Candle] = dict()
+
+        self.late_prints = 0  # Dropped, their candle was already closed
+
+        self._subscribers: typing.Dict[str, typing.List["Strategy"]] = dict()
+
+        self.trigger_book = TriggerBook()
+        self.positions = PositionTable()
+
+        self.last_trade_time: typing.Optional[int] = None
+
+        self.clock_offset = clock_offset
+        self.close_delay = close_delay
+        self._timer: typing.Optional[Timer] = None
+
+        self._lock = threading.RLock()
+
+    def add_timeframe(self, timeframe: str, historical_candles: typing.List[Candle]):
+
+        """
+        Start building the candles of a timeframe, seeded with the historical data fetched from the exchange.
+        :param timeframe:
+        :param historical_candles: The last one is the currently forming candle
+        :return:
+        """
+
+        with self._lock:
+            self._history_loaded.add(timeframe)
+
+            if timeframe == self.base_tf:
+                # The base candles may already have been started from the trades stream, the history goes before them
+                base_candles = self.candles[timeframe]
+                first_ts = base_candles[0].timestamp if len(base_candles) > 0 else None
+
+                if len(historical_candles) > 0 and (first_ts is None or historical_candles[0].timestamp < first_ts):
+                    base_candles[:0] = [c for c in historical_candles if first_ts is None or c.timestamp < first_ts]
+
+                self._arm_timer()
+                return
+
+            if timeframe in self.candles:
+                return
+
+            self.candles[timeframe] = historical_candles
+            self._derived_tfs.append(timeframe)
+            self._derived_tfs.sort(key=lambda tf: TF_EQUIV[tf])
+
+    def server_time(self) -> int:
+        return int(time.time() * 1000) + self.clock_offset
+
+    def has_timeframe(self, timeframe: str) -> bool:
+
+        """
+        :return: True if the historical candles of the timeframe were added
+        """
+
+        return timeframe in self._history_loaded
+
+    def subscribe(self, strategy: "Strategy"):
+
+        """
+        The strategy shares the candles list of its timeframe and receives the candle update/close events.
+        :param strategy:
+        :return:
+        """
+
+        with self._lock:
+            strategy.aggregator = self
+            strategy.candles = self.candles[strategy.tf]
+            self._subscribers.setdefault(strategy.tf, []).append(strategy)
+
+    def unsubscribe(self, strategy: "Strategy"):
+        with self._lock:
+            if strategy in self._subscribers.get(strategy.tf, []):
+                self._subscribers[strategy.tf].remove(strategy)
+
+    def parse_trade(self, price: float, size: float, timestamp: int):
+
+        """
+        Update the candles with a new trade and publish the events to the strategies subscribed.
+        :param price:
+        :param size:
+        :param timestamp: Trade time in milliseconds
+        :return:
+        """
+
+        timestamp_diff = int(time.time() * 1000) - timestamp
+        if timestamp_diff >= 2000:
+            logger.warning("%s %s: %s milliseconds of difference between the current time and the trade time",
+                           self.exchange, self.symbol, timestamp_diff)
+
+        with self._lock:
+            results = dict()
+
+            base_candles = self.candles[self.base_tf]
+
+            if len(base_candles) > 0 and timestamp < base_candles[-1].timestamp:
+                self._late_print(price, size, timestamp)
+                return
+
+            self.last_trade_time = timestamp
+
+            if len(base_candles) == 0:
+                base_equiv = TF_EQUIV[self.base_tf] * 1000
+                candle_info = {'ts': timestamp - timestamp % base_equiv, 'open': price, 'high': price, 'low': price,
+                               'close': price, 'volume': size}
+                base_candles.append(Candle(candle_info, self.base_tf, "parse_trade"))
+                results[self.base_tf] = "new_candle"
+            else:
+                results[self.base_tf] = self._update_candles(self.base_tf, price, size, timestamp)
+
+            for tf in self._derived_tfs:
+                candles = self.candles[tf]
+
+                if len(candles) == 0:
+                    continue
+
+                if results[self.base_tf] == "same_candle":
+                    self._update_last_candle(tf, candles[-1], price, size)
+                    results[tf] = "same_candle"
+                else:
+                    results[tf] = self._update_candles(tf, price, size, timestamp)
+
+            self._arm_timer()
+
+            events = self._events(results)
+
+        self.trigger_book.check(price)
+
+        self._publish(events)
+
+    def _late_print(self, price: float, size: float, timestamp: int):
+
+        """
+        A print of a base candle already closed by the timer, received after the close delay: it still counts in the
+        higher timeframe candles that are forming. Must be called with the lock acquired.
+        """
+
+        self.late_prints += 1
+        logger.debug("%s %s: print of %s received after the close of its candle", self.exchange, self.symbol,
+                     timestamp)
+
+        for tf in self._derived_tfs:
+            candles = self.candles[tf]
+            if len(candles) > 0 and candles[-1].timestamp <= timestamp < candles[-1].timestamp + TF_EQUIV[tf] * 1000:
+                self._update_last_candle(tf, candles[-1], price, size)
+
+    def _arm_timer(self):
+
+        """
+        Schedule the close of the base candle at the end of its period. Must be called with the lock acquired.
+        :return:
+        """
+
+        base_candles = self.candles[self.base_tf]
+
+        if self._timer is not None or len(base_candles) == 0:
+            return
+
+        boundary = base_candles[-1].timestamp + TF_EQUIV[self.base_tf] * 1000
+        self._timer = dispatcher.call_at(boundary + self.close_delay, self._on_timer, self.clock_offset)
+
+    def _on_timer(self):
+
+        """
+        Close the candles whose period ended without any trade to do it.
+        :return:
+        """
+
+        with self._lock:
+            self._timer = None
+
+            now = self.server_time()
+            results = dict()
+
+            for tf in [self.base_tf] + self._derived_tfs:
+                candles = self.candles[tf]
+
+                if len(candles) > 0 and now >= candles[-1].timestamp + TF_EQUIV[tf] * 1000:
+                    self._close_candles(tf, now)
+                    results[tf] = "new_candle"
+
+            self._arm_timer()
+
+            events = self._events(results)
+
+        self._publish(events)
+
+    def _events(self, results: typing.Dict[str, str]) -> typing.List[typing.Tuple]:
+
+        """
+        The strategies to call for each timeframe updated, and the candle that was closed if any. Must be called with
+        the lock acquired.
+        :param results: Timeframe -> same_candle or new_candle
+        :return:
+        """
+
+        events = []
+
+        for tf, tick_type in results.items():
+            candles = self.candles[tf]
+            closed_candle = candles[-2] if tick_type == "new_candle" and len(candles) > 1 else None
+            events.append((tf, tick_type, list(self._subscribers.get(tf, [])), closed_candle))
+
+        return events
+
+    def _publish(self, events: typing.List[typing.Tuple]):
+
+        # The strategies may place orders, so they are called after the lock is released
+
+        for tf, tick_type, strategies, closed_candle in events:
+            for strategy in strategies:
+                if tick_type == "same_candle":
+                    strategy.on_candle_update()
+                else:
+                    strategy.on_candle_close()
+
+            if closed_candle is not None:
+                dispatcher.publish(CandleCloseEvent(self.exchange, self.symbol, tf, closed_candle))
+
+    def _close_candles(self, timeframe: str, timestamp: int):
+
+        """
+        Start the candle containing the timestamp, with the last close price and no volume until a trade comes.
+        :param timeframe:
+        :param timestamp:
+        :return:
+        """
+
+        candles = self.candles[timeframe]
+        tf_equiv = TF_EQUIV[timeframe] * 1000
+
+        last_candle = candles[-1]
+
+        while timestamp >= last_candle.timestamp + tf_equiv:
+            candle_info = {'ts': last_candle.timestamp + tf_equiv, 'open': last_candle.close, 'high': last_candle.close,
+                           'low': last_candle.close, 'close': last_candle.close, 'volume': 0}
+            last_candle = Candle(candle_info, timeframe, "parse_trade")
+            candles.append(last_candle)
+
+        self._timer_candles[timeframe] = last_candle
+
+        logger.info("%s New candle for %s %s (timer)", self.exchange, self.symbol, timeframe)
+
+    def _update_last_candle(self, timeframe: str, candle: Candle, price: float, size: float):
+        if self._timer_candles.get(timeframe) is candle:  # Started by the timer, the first trade gives the real open
+            del self._timer_candles[timeframe]
+            candle.open = candle.high = candle.low = price
+
+        candle.close = price
+        candle.volume += size
+
+        if price > candle.high:
+            candle.high = price
+        elif price < candle.low:
+            candle.low = price
+
+    def _update_candles(self, timeframe: str, price: float, size: float, timestamp: int) -> str:
+        candles = self.candles[timeframe]
+        tf_equiv = TF_EQUIV[timeframe] * 1000
+
+        last_candle = candles[-1]
+
+        # Same Candle
+
+        if timestamp < last_candle.timestamp + tf_equiv:
+            self._update_last_candle(timeframe, last_candle, price, size)
+            return "same_candle"
+
+        # Missing Candle(s)
+
+        if timestamp >= last_candle.timestamp + 2 * tf_equiv:
+
+            missing_candles = int((timestamp - last_candle.timestamp) / tf_equiv) - 1
+
+            logger.info("%s missing %s candles for %s %s (%s %s)", self.exchange, missing_candles, self.symbol,
+                        timeframe, timestamp, last_candle.timestamp)
+
+            for missing in range(missing_candles):
+                new_ts = last_candle.timestamp + tf_equiv
+                candle_info = {'ts': new_ts, 'open': last_candle.close, 'high': last_candle.close,
+                               'low': last_candle.close, 'close': last_candle.close, 'volume': 0}
+                new_candle = Candle(candle_info, timeframe, "parse_trade")
+
+                candles.append(new_candle)
+
+                last_candle = new_candle
+
+        # New Candle
+
+        new_ts = last_candle.timestamp + tf_equiv
+        candle_info = {'ts': new_ts, 'open': price, 'high': price, 'low': price, 'close': price, 'volume': size}
+        candles.append(Candle(candle_info, timeframe, "parse_trade"))
+
+        logger.info("%s New candle for %s %s", self.exchange, self.symbol, timeframe)
+
+        return "new_candle"
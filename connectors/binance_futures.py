@@ -1,3 +1,4 @@
+import concurrent.futures
 import logging
 import requests
 import time
@@ -16,11 +17,20 @@ import threading
 from models import *
 
 from strategies import TechnicalStrategy, BreakoutStrategy
+from candle_aggregator import CandleAggregator
+from positions import PositionTable
+from feed_handler import FeedHandler, FeedReader
+from events import dispatcher, TradeEvent, QuoteEvent, LogEvent
+from orders import OrderManager
+from risk import portfolio_risk
+
+if typing.TYPE_CHECKING:
+    from workers import StrategyWorkerPool
 
 logger = logging.getLogger()
 
 class BinanceFuturesClient:
-    def __init__(self, public_key: str, secret_key: str, testnet: bool, futures: bool):
+    def __init__(self, public_key: str, secret_key: str, testnet: bool, futures: bool, feed_process: bool = False):
 
         self.futures = futures
 
@@ -48,10 +58,29 @@ class BinanceFuturesClient:
         self._headers = {'X-MBX-APIKEY': self._public_key}
 
         self.contracts = self.get_contracts()
+
+        # The signed requests use the local time corrected by this offset, instead of asking the server time first.
+        # It is measured again periodically, the local clock drifts, and when Binance refuses a timestamp.
+        self.server_time_offset = 0
+        self.time_sync_interval = 600  # In seconds
+        self.aggregators: typing.Dict[str, CandleAggregator] = dict()
+        self._schedule_time_sync(self._sync_server_time())
+
         self.balances = self.get_balances()
 
         self.prices = {}
         self.strategies: typing.Dict[int, typing.Union[TechnicalStrategy, BreakoutStrategy]] = dict()
+        self.worker_pool: typing.Optional["StrategyWorkerPool"] = None  # Set to run the strategies in processes
+        self.unrealized_pnl = 0.0  # Of all the open trades of the strategies, in the quote asset
+
+        self.orders = OrderManager(self, risk=portfolio_risk)
+
+        if self.futures:  # The positions opened before the start count in the exposure of the risk checks
+            positions = self.get_positions()
+            if positions is not None:
+                portfolio_risk.set_positions(self.platform, positions, self.contracts)
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)  # Concurrent batches of orders
 
         self.logs = []
 
@@ -62,48 +91,85 @@ class BinanceFuturesClient:
 
         self.ws_subscriptions = {"bookTicker": [], "aggTrade": []}
 
-        t = threading.Thread(target=self._start_ws)
-        t.start()
+        # The market data can be received by a separate feed handler process, that writes it to shared memory
+        self.feed: typing.Optional[FeedHandler] = None
+
+        # The market data is processed in the dispatcher thread, the websocket or feed thread only decodes it
+        dispatcher.subscribe(QuoteEvent, self._on_quote, self.platform)
+        dispatcher.subscribe(TradeEvent, self._on_trade, self.platform)
+
+        if feed_process:
+            self.feed = FeedHandler(self.platform, self._wss_url, list(self.contracts.keys()))
+            self._feed_reader = FeedReader(self.feed.directory, on_trade=self._publish_trade,
+                                           on_quote=self._publish_quote)
+            self.feed.subscribe(["BTCUSDT"], "bookTicker")
+        else:
+            t = threading.Thread(target=self._start_ws)
+            t.start()
 
         logger.info("Binance Futures Client successfully initialized")
 
     def _add_log(self, msg: str):
         logger.info("%s", msg)
         self.logs.append({"log": msg, "displayed": False})
+        dispatcher.publish(LogEvent(self.platform, msg))
+
+    def _generate_signature(self, data: typing.Union[typing.Dict, str]) -> str:
+        query = data if isinstance(data, str) else urlencode(data)
+        return hmac.new(self._secret_key.encode(), query.encode(), hashlib.sha256).hexdigest()
 
-    def _generate_signature(self, data: typing.Dict) -> str:
-        return hmac.new(self._secret_key.encode(), urlencode(data).encode(), hashlib.sha256).hexdigest()
+    def _timestamp(self) -> int:
+        return int(time.time() * 1000) + self.server_time_offset
+
+    def _make_request(self, method: str, endpoint: str, data: typing.Union[typing.Dict, str]):
+        status_code, response = self._send_request(method, endpoint, data)
+
+        if status_code == 200:
+            return response
+        elif status_code is not None:
+            logger.error("Error while making %s request to %s: %s (error code %s)",
+                         method, endpoint, response, status_code)
+        return None
+
+    def _send_request(self, method: str, endpoint: str,
+                      data: typing.Union[typing.Dict, str]) -> typing.Tuple[typing.Optional[int], typing.Any]:
+
+        """
+        :return: The HTTP status code (None if the request couldn't be sent) and the decoded response, which holds the
+        Binance error code when the request failed
+        """
 
-    def _make_request(self, method: str, endpoint: str, data: typing.Dict):
         if method == "GET":
             try:
                 response = requests.get(self._base_url + endpoint, params=data, headers=self._headers)
             except Exception as e:
                 logger.error("Connection error while making %s request to %s: %s", method, endpoint, e)
-                return None
+                return None, None
 
         elif method == "POST":
             try:
                 response = requests.post(self._base_url + endpoint, params=data, headers=self._headers)
             except Exception as e:
                 logger.error("Connection error while making %s request to %s: %s", method, endpoint, e)
-                return None
+                return None, None
 
         elif method == "DELETE":
             try:
                 response = requests.delete(self._base_url + endpoint, params=data, headers=self._headers)
             except Exception as e:
                 logger.error("Connection error while making %s request to %s: %s", method, endpoint, e)
-                return None
+                return None, None
         else:
             raise ValueError()
 
-        if response.status_code == 200:
-            return response.json()
-        else:
-            logger.error("Error while making %s request to %s: %s (error code %s)",
-                         method, endpoint, response.json(), response.status_code)
-            return None
+        response_data = response.json()
+
+        if isinstance(response_data, dict) and response_data.get('code') == -1021:  # Timestamp outside recvWindow
+            logger.warning("Binance refused the timestamp of a %s request to %s, resyncing the server time", method,
+                           endpoint)
+            dispatcher.run_blocking(self._sync_server_time, lambda synced: None)
+
+        return response.status_code, response_data
 
     def get_contracts(self) -> typing.Dict[str, Contract]:
 
@@ -120,12 +186,43 @@ class BinanceFuturesClient:
 
         return contracts
 
-    def get_historical_candles(self, contract: Contract, interval: str) -> typing.List[Candle]:
+    def get_aggregator(self, contract: Contract) -> CandleAggregator:
+
+        """
+        Get the CandleAggregator building the candles of the contract, shared by all the strategies running on it.
+        :param contract:
+        :return:
+        """
+
+        if contract.symbol not in self.aggregators:
+            self.aggregators[contract.symbol] = CandleAggregator(self.platform, contract.symbol,
+                                                                 clock_offset=self.server_time_offset)
+
+        return self.aggregators[contract.symbol]
+
+    def position_table(self, contract: Contract) -> PositionTable:
+
+        """
+        Open trades of the live strategies on the contract, marked to market on its quotes.
+        """
+
+        return self.get_aggregator(contract).positions
+
+    def get_historical_candles(self, contract: Contract, interval: str,
+                               start_time: typing.Optional[int] = None) -> typing.List[Candle]:
+
+        """
+        :param start_time: Open time in milliseconds of the first candle, the last 1000 candles if None
+        """
+
         data = dict()
         data['symbol'] = contract.symbol
         data['interval'] = interval
         data['limit'] = 1000
 
+        if start_time is not None:
+            data['startTime'] = start_time
+
         raw_candles = self._make_request("GET", "/fapi/v1/klines", data)
 
         candles = []
@@ -150,12 +247,38 @@ class BinanceFuturesClient:
             return self.prices[contract.symbol]
 
     def _get_server_time(self):
-        server_time = self._make_request("GET", "/fapi/v1/time", dict())
+        server_time = self._make_request("GET", "/fapi/v1/time" if self.futures else "/api/v3/time", dict())
         return server_time['serverTime'] if server_time else None
 
+    def _sync_server_time(self) -> bool:
+
+        """
+        Measure the offset between the server time and the local time.
+        :return: False if the server time request failed, the previous offset is kept
+        """
+
+        sent = time.time()
+        server_time = self._get_server_time()
+
+        if server_time is None:
+            logger.warning("Binance server time unavailable, the time offset stays at %s ms", self.server_time_offset)
+            return False
+
+        # The server time is taken about halfway through the round trip
+        self.server_time_offset = server_time - int((sent + time.time()) / 2 * 1000)
+
+        for aggregator in list(self.aggregators.values()):
+            aggregator.clock_offset = self.server_time_offset
+
+        return True
+
+    def _schedule_time_sync(self, synced: bool):
+        delay = self.time_sync_interval if synced else 10  # Retried soon after a failure
+        dispatcher.call_later(delay, lambda: dispatcher.run_blocking(self._sync_server_time, self._schedule_time_sync))
+
     def get_balances(self) -> typing.Dict[str, Balance]:
         data = dict()
-        data['timestamp'] = self._get_server_time()
+        data['timestamp'] = self._timestamp()
         data['signature'] = self._generate_signature(data)
 
         balances = dict()
@@ -171,20 +294,33 @@ class BinanceFuturesClient:
 
         return balances
 
-    def place_order(self, contract: Contract, order_type: str, quantity: float, side: str, price=None, tif=None) -> OrderStatus:
+    def _order_params(self, contract: Contract, order_type: str, quantity: float, side: str, price=None, tif=None,
+                      client_order_id: typing.Optional[str] = None, reduce_only: bool = False) -> typing.Dict:
         data = dict()
         data['symbol'] = contract.symbol
         data['side'] = side.upper()
-        data['quantity'] = round(round(quantity / contract.lot_size) * contract.lot_size, 8)
+        data['quantity'] = contract.round_quantity(quantity)
         data['type'] = order_type
 
         if price is not None:
-            data['price'] = round(round(price / contract.tick_size) * contract.tick_size, 8)
+            data['price'] = contract.round_price(price)
 
         if tif is not None:
             data['timeInForce'] = tif
 
-        data['timestamp'] = self._get_server_time()
+        if client_order_id is not None:
+            data['newClientOrderId'] = client_order_id
+
+        if reduce_only:
+            data['reduceOnly'] = "true"
+
+        return data
+
+    def place_order(self, contract: Contract, order_type: str, quantity: float, side: str, price=None, tif=None,
+                    client_order_id: typing.Optional[str] = None) -> OrderStatus:
+        data = self._order_params(contract, order_type, quantity, side, price, tif, client_order_id)
+
+        data['timestamp'] = self._timestamp()
         data['signature'] = self._generate_signature(data)
 
         order_status = self._make_request("POST", "/fapi/v1/order", data)
@@ -194,13 +330,78 @@ class BinanceFuturesClient:
 
         return order_status
 
+    def order_template(self, contract: Contract, order_type: str, quantity: float, side: str, price=None,
+                       tif=None) -> str:
+
+        """
+        Encode an order in advance, place_order_template() only adds the client order id, the timestamp and the
+        signature.
+        """
+
+        return urlencode(self._order_params(contract, order_type, quantity, side, price, tif))
+
+    def place_order_template(self, template: str, client_order_id: str) -> OrderStatus:
+        query = f"{template}&newClientOrderId={client_order_id}&timestamp={self._timestamp()}"
+        query += "&signature=" + self._generate_signature(query)
+
+        order_status = self._make_request("POST", "/fapi/v1/order", query)
+
+        if order_status is not None:
+            order_status = OrderStatus(order_status, "binance")
+
+        return order_status
+
+    def place_orders(self, orders: typing.List[typing.Dict]) -> typing.List[typing.Optional[OrderStatus]]:
+
+        """
+        Place several orders at once: batches of 5 orders (the maximum of the batchOrders endpoint) sent concurrently.
+        :param orders: The arguments of place_order() for each order
+        :return: The status of each order. None when the request failed: the order may or may not have been placed
+        """
+
+        if not self.futures:  # No batch endpoint on Spot, the orders are sent concurrently one by one
+            return list(self._executor.map(lambda o: self.place_order(**o), orders))
+
+        batches = [orders[i:i + 5] for i in range(0, len(orders), 5)]
+
+        statuses = []
+        for batch_statuses in self._executor.map(self._place_batch, batches):
+            statuses.extend(batch_statuses)
+
+        return statuses
+
+    def _place_batch(self, orders: typing.List[typing.Dict]) -> typing.List[typing.Optional[OrderStatus]]:
+        batch = [{key: str(value) for key, value in self._order_params(**o).items()} for o in orders]
+
+        data = dict()
+        data['batchOrders'] = json.dumps(batch)
+        data['timestamp'] = self._timestamp()
+        data['signature'] = self._generate_signature(data)
+
+        response = self._make_request("POST", "/fapi/v1/batchOrders", data)
+
+        if response is None:
+            return [None] * len(orders)
+
+        statuses = []
+
+        for order, result in zip(batch, response):
+            if 'orderId' in result:
+                statuses.append(OrderStatus(result, "binance"))
+            else:  # The order was refused, the others of the batch are placed anyway
+                logger.error("Binance order %s rejected: %s", order.get('newClientOrderId'), result.get('msg'))
+                statuses.append(OrderStatus({'orderId': None, 'status': "REJECTED", 'avgPrice': 0,
+                                             'clientOrderId': order.get('newClientOrderId')}, "binance"))
+
+        return statuses
+
     def cancel_order(self, contract: Contract, order_id: int) -> OrderStatus:
 
         data = dict()
         data['orderId'] = order_id
         data['symbol'] = contract.symbol
 
-        data['timestamp'] = int(time.time() * 1000)
+        data['timestamp'] = self._timestamp()
         data['signature'] = self._generate_signature(data)
 
         if self.futures:
@@ -212,10 +413,77 @@ class BinanceFuturesClient:
             if not self.futures:
                 # Get the average execution price based on the recent trades
                 order_status['avgPrice'] = self._get_execution_price(contract, order_id)
-            order_status = OrderStatus(order_status, self.platform)
+            order_status = OrderStatus(order_status, "binance")
 
         return order_status
 
+    def cancel_all_orders(self, symbols: typing.List[str]) -> bool:
+
+        """
+        Cancel the open orders of the symbols, one request per symbol sent concurrently.
+        :param symbols: The symbols the program trades, Binance can't cancel the orders of all the symbols at once
+        :return: False if a request failed, orders may still be open
+        """
+
+        endpoint = "/fapi/v1/allOpenOrders" if self.futures else "/api/v3/openOrders"
+
+        def cancel_symbol(symbol: str) -> bool:
+            symbol_data = dict()
+            symbol_data['symbol'] = symbol
+            symbol_data['timestamp'] = self._timestamp()
+            symbol_data['signature'] = self._generate_signature(symbol_data)
+
+            status_code, response = self._send_request("DELETE", endpoint, symbol_data)
+
+            # Spot answers "unknown order" (-2011) when the symbol has no open order
+            return status_code == 200 or (isinstance(response, dict) and response.get('code') == -2011)
+
+        failed = [symbol for symbol, done in zip(symbols, self._executor.map(cancel_symbol, symbols)) if not done]
+
+        if len(failed) > 0:
+            logger.warning("Binance: the open orders of %s could not be cancelled", ", ".join(failed))
+
+        return len(failed) == 0
+
+    def get_positions(self) -> typing.Optional[typing.Dict[str, float]]:
+
+        """
+        :return: Symbol -> position quantity, negative when short, for the open positions. None if the request failed
+        """
+
+        if not self.futures:  # Only balances on Spot
+            return dict()
+
+        data = dict()
+        data['timestamp'] = self._timestamp()
+        data['signature'] = self._generate_signature(data)
+
+        positions = self._make_request("GET", "/fapi/v2/positionRisk", data)
+
+        if positions is None:
+            return None
+
+        return {p['symbol']: float(p['positionAmt']) for p in positions if float(p['positionAmt']) != 0}
+
+    def close_all_positions(self, positions: typing.Optional[typing.Dict[str, float]] = None
+                            ) -> typing.List[typing.Optional[OrderStatus]]:
+
+        """
+        Close the open positions with reduce-only market orders, sent in batches.
+        :param positions: Symbol -> quantity, as tracked by the program. Requested from the exchange first if None
+        """
+
+        if positions is None:
+            positions = self.get_positions()
+        if positions is None:
+            return [None]  # Unknown positions, reported as not closed
+
+        orders = [{"contract": self.contracts[symbol], "order_type": "MARKET", "quantity": abs(quantity),
+                   "side": "sell" if quantity > 0 else "buy", "reduce_only": True}
+                  for symbol, quantity in positions.items() if symbol in self.contracts]
+
+        return self.place_orders(orders) if len(orders) > 0 else []
+
     def _get_execution_price(self, contract: Contract, order_id: int) -> float:
 
         """
@@ -247,14 +515,18 @@ class BinanceFuturesClient:
                     fill_pct = float(t['qty']) / executed_qty
                     avg_price += (float(t['price']) * fill_pct)  # Weighted sum
 
-        return round(round(avg_price / contract.tick_size) * contract.tick_size, 8)
+        return contract.round_price(avg_price)
 
-    def get_order_status(self, contract: Contract, order_id: int) -> OrderStatus:
+    def get_order_status(self, contract: Contract, order_id: typing.Optional[int],
+                         client_order_id: typing.Optional[str] = None) -> OrderStatus:
 
         data = dict()
-        data['timestamp'] = self._get_server_time()
+        data['timestamp'] = self._timestamp()
         data['symbol'] = contract.symbol
-        data['orderId'] = order_id
+        if order_id is not None:
+            data['orderId'] = order_id
+        else:
+            data['origClientOrderId'] = client_order_id
         data['signature'] = self._generate_signature(data)
 
         order_status = self._make_request("GET", "/fapi/v1/order", data)
@@ -264,6 +536,35 @@ class BinanceFuturesClient:
 
         return order_status
 
+    def find_order(self, contract: Contract,
+                   client_order_id: str) -> typing.Tuple[typing.Optional[bool], typing.Optional[OrderStatus]]:
+
+        """
+        Look up an order whose placement response was lost.
+        :return: (True, status) if the order exists, (False, None) if Binance answers that it doesn't (error -2013),
+        (None, None) if the lookup itself failed
+        """
+
+        data = dict()
+        data['timestamp'] = self._timestamp()
+        data['symbol'] = contract.symbol
+        data['origClientOrderId'] = client_order_id
+        data['signature'] = self._generate_signature(data)
+
+        endpoint = "/fapi/v1/order" if self.futures else "/api/v3/order"
+        status_code, response = self._send_request("GET", endpoint, data)
+
+        if status_code == 200:
+            return True, OrderStatus(response, "binance")
+
+        if isinstance(response, dict) and response.get('code') == -2013:
+            return False, None
+
+        if status_code is not None:
+            logger.error("Error while looking up order %s: %s (error code %s)", client_order_id, response, status_code)
+
+        return None, None
+
     def _start_ws(self):
         self.ws = websocket.WebSocketApp(self._wss_url, on_open=self._on_open, on_close=self._on_close,
                                           on_error=self._on_error, on_message=self._on_message)
@@ -303,39 +604,47 @@ class BinanceFuturesClient:
 
         if "e" in data:
             if data['e'] == "bookTicker":
+                self._publish_quote(data['s'], float(data['b']), float(data['a']))
 
-                symbol = data['s']
+            if data['e'] == "aggTrade":
+                self._publish_trade(data['s'], float(data['p']), float(data['q']), data['T'])
 
-                if symbol not in self.prices:
-                    self.prices[symbol] = {'bid': float(data['b']), 'ask': float(data['a'])}
-                else:
-                    self.prices[symbol]['bid'] = float(data['b'])
-                    self.prices[symbol]['ask'] = float(data['a'])
-
-                # PNL Calculation
-                try:
-                    for b_index, strat in self.strategies.items():
-                        if strat.contract.symbol == symbol:
-                            for trade in strat.trades:
-                                if trade.status == "open" and trade.entry_price is not None:
-                                    if trade.side == "long":
-                                        trade.pnl = (self.prices[symbol]['bid'] - trade.entry_price) * trade.quantity
-                                    elif trade.side == "short":
-                                        trade.pnl = (trade.entry_price - self.prices[symbol]['ask']) * trade.quantity
-                except RuntimeError as e:
-                    logger.error("Error while looping through the Binance strategies: %s", e)
+    def _publish_quote(self, symbol: str, bid: float, ask: float):
+        dispatcher.publish(QuoteEvent(self.platform, symbol, bid, ask))
 
-            if data['e'] == "aggTrade":
+    def _publish_trade(self, symbol: str, price: float, quantity: float, timestamp: int):
+        dispatcher.publish(TradeEvent(self.platform, symbol, price, quantity, timestamp))
+
+    def _on_quote(self, event: QuoteEvent):
+        symbol, bid, ask = event.symbol, event.bid, event.ask
+
+        if symbol not in self.prices:
+            self.prices[symbol] = {'bid': bid, 'ask': ask}
+        else:
+            self.prices[symbol]['bid'] = bid
+            self.prices[symbol]['ask'] = ask
 
-                symbol = data['s']
+        # PNL Calculation
 
-                for key, strat in self.strategies.items():
-                    if strat.contract.symbol == symbol:
-                        res = strat.parse_trades(float(data['p']), float(data['q']), data['T'])
-                        strat.check_trade(res)
+        if symbol in self.aggregators:
+            self.unrealized_pnl += self.aggregators[symbol].positions.revalue(bid, ask)
+
+        if self.worker_pool is not None:
+            self.worker_pool.publish_quote(symbol, bid, ask)
+
+    def _on_trade(self, event: TradeEvent):
+        if event.symbol in self.aggregators:
+            self.aggregators[event.symbol].parse_trade(event.price, event.quantity, event.timestamp)
+
+        if self.worker_pool is not None:
+            self.worker_pool.publish_trade(event.symbol, event.price, event.quantity, event.timestamp)
 
     def subscribe_channel(self, contracts: list[Contract], channel: str):
 
+        if self.feed is not None:
+            self.feed.subscribe([contract.symbol for contract in contracts], channel)
+            return
+
         if len(contracts) > 200:
             logger.warning("Subscribing to more than 200 symbols will most likely fail. "
                            "Consider subscribing only when adding a symbol to your Watchlist or when starting a ")
@@ -368,19 +677,28 @@ class BinanceFuturesClient:
         self._ws_id += 1
 
     def get_trade_size(self, contract: Contract, price: float, balance_pct: float):
+        balance = self.get_trade_balance()
+        if balance is None:
+            return None
 
-        balance = self.get_balances()
-        if balance is not None:
-            if 'USDT' in balance:
-                balance = balance['USDT'].wallet_balance
-            else:
-                return None
-        else:
+        return self.trade_size_from_balance(contract, price, balance_pct, balance)
+
+    def get_trade_balance(self) -> typing.Optional[float]:
+
+        """
+        :return: The USDT wallet balance the trades are sized on, None if the request failed
+        """
+
+        balances = self.get_balances()
+        if balances is None or 'USDT' not in balances:
             return None
 
+        return balances['USDT'].wallet_balance
+
+    def trade_size_from_balance(self, contract: Contract, price: float, balance_pct: float, balance: float):
         trade_size = (balance * balance_pct / 100) / price
 
-        trade_size = round(round(trade_size / contract.lot_size) * contract.lot_size, 8)
+        trade_size = contract.round_quantity(trade_size)
 
         logger.info("Binance Future current USDT balance = %s, trade size = %s", balance, trade_size)
 
@@ -3,6 +3,7 @@ import requests
 import time
 import typing
 import collections
+import datetime
 
 from urllib.parse import urlencode
 
@@ -19,12 +20,21 @@ import threading
 from models import *
 
 from strategies import TechnicalStrategy, BreakoutStrategy
+from candle_aggregator import CandleAggregator
+from positions import PositionTable
+from feed_handler import FeedHandler, FeedReader
+from events import dispatcher, TradeEvent, QuoteEvent, LogEvent
+from orders import OrderManager
+from risk import portfolio_risk
+
+if typing.TYPE_CHECKING:
+    from workers import StrategyWorkerPool
 
 
 logger = logging.getLogger()
 
 class BitmexClient:
-    def __init__(self, public_key: str, secret_key: str, testnet: bool):
+    def __init__(self, public_key: str, secret_key: str, testnet: bool, feed_process: bool = False):
 
         if testnet:
             self._base_url = "https://testnet.bitmex.com"
@@ -43,26 +53,54 @@ class BitmexClient:
         self.contracts = self.get_contracts()
         self.balances = self.get_balances()
 
+        server_time = self._get_server_time()
+        self.server_time_offset = server_time - int(time.time() * 1000) if server_time is not None else 0
+
         self.prices = dict()
         self.strategies: typing.Dict[int, typing.Union[TechnicalStrategy, BreakoutStrategy]] = dict()
+        self.aggregators: typing.Dict[str, CandleAggregator] = dict()
+        self.worker_pool: typing.Optional["StrategyWorkerPool"] = None  # Set to run the strategies in processes
+        self.unrealized_pnl = 0.0  # Of all the open trades of the strategies, in XBT
+
+        self.orders = OrderManager(self, risk=portfolio_risk)
+
+        # The positions opened before the start count in the exposure of the risk checks
+        positions = self.get_positions()
+        if positions is not None:
+            portfolio_risk.set_positions(self.platform, positions, self.contracts)
 
         self.logs = []
 
-        t = threading.Thread(target=self._start_ws)
-        t.start()
+        # The market data can be received by a separate feed handler process, that writes it to shared memory
+        self.feed: typing.Optional[FeedHandler] = None
+
+        # The market data is processed in the dispatcher thread, the websocket or feed thread only decodes it
+        dispatcher.subscribe(QuoteEvent, self._on_quote, self.platform)
+        dispatcher.subscribe(TradeEvent, self._on_trade, self.platform)
+
+        if feed_process:
+            self.feed = FeedHandler(self.platform, self._wss_url, list(self.contracts.keys()))
+            self._feed_reader = FeedReader(self.feed.directory, on_trade=self._publish_trade,
+                                           on_quote=self._publish_quote)
+        else:
+            t = threading.Thread(target=self._start_ws)
+            t.start()
 
         logger.info("Bitmex Client successful")
 
     def _add_log(self, msg: str):
         logger.info("%s", msg)
         self.logs.append({"log": msg, "displayed": False})
+        dispatcher.publish(LogEvent(self.platform, msg))
 
-    def _generate_signature(self, method: str, endpoint: str, expires: str, data: typing.Dict) -> str:
+    def _generate_signature(self, method: str, endpoint: str, expires: str,
+                            data: typing.Union[typing.Dict, str]) -> str:
 
-        message = method + endpoint + "?" + urlencode(data) + expires if len(data) > 0 else method + endpoint + expires
+        query = data if isinstance(data, str) else urlencode(data)
+        message = method + endpoint + "?" + query + expires if len(data) > 0 else method + endpoint + expires
         return hmac.new(self._secret_key.encode(), message.encode(), hashlib.sha256).hexdigest()
 
-    def _make_request(self, method: str, endpoint: str, data: typing.Dict):
+    def _make_request(self, method: str, endpoint: str, data: typing.Union[typing.Dict, str]):
 
         headers = dict()
         expires = str(int(time.time()) + 5)
@@ -112,6 +150,10 @@ class BitmexClient:
 
         return collections.OrderedDict(sorted(contracts.items()))  # Sort keys of the dictionary alphabetically
 
+    def _get_server_time(self) -> typing.Optional[int]:
+        api_info = self._make_request("GET", "/api/v1", dict())
+        return int(dateutil.parser.isoparse(api_info['timestamp']).timestamp() * 1000) if api_info else None
+
     def get_balances(self) -> typing.Dict[str, Balance]:
         data = dict()
         data['currency'] = "all"
@@ -126,7 +168,35 @@ class BitmexClient:
 
         return balances
 
-    def get_historical_candles(self, contract: Contract, timeframe: str) -> typing.List[Candle]:
+    def get_aggregator(self, contract: Contract) -> CandleAggregator:
+
+        """
+        Get the CandleAggregator building the candles of the contract, shared by all the strategies running on it.
+        :param contract:
+        :return:
+        """
+
+        if contract.symbol not in self.aggregators:
+            self.aggregators[contract.symbol] = CandleAggregator(self.platform, contract.symbol,
+                                                                 clock_offset=self.server_time_offset)
+
+        return self.aggregators[contract.symbol]
+
+    def position_table(self, contract: Contract) -> PositionTable:
+
+        """
+        Open trades of the live strategies on the contract, marked to market on its quotes.
+        """
+
+        return self.get_aggregator(contract).positions
+
+    def get_historical_candles(self, contract: Contract, timeframe: str,
+                               start_time: typing.Optional[int] = None) -> typing.List[Candle]:
+
+        """
+        :param start_time: Open time in milliseconds of the first candle, the last 500 candles if None
+        """
+
         data = dict()
 
         data['symbol'] = contract.symbol
@@ -135,33 +205,50 @@ class BitmexClient:
         data['count'] = 500
         data['reverse'] = True
 
+        if start_time is not None:  # The Bitmex timestamps are the close times of the candles
+            close_time = start_time + BITMEX_TF_MINUTES[timeframe] * 60 * 1000
+            data['startTime'] = datetime.datetime.utcfromtimestamp(close_time / 1000).isoformat()
+            data['reverse'] = False
+
         raw_candles = self._make_request("GET", "/api/v1/trade/bucketed", data)
 
         candles = []
 
         if raw_candles is not None:
-            for c in reversed(raw_candles):
+            for c in reversed(raw_candles) if data['reverse'] else raw_candles:
                 if c['open'] is None or c['close'] is None:  # Some candles returned by Bitmex miss data
                     continue
                 candles.append(Candle(c, timeframe, "bitmex"))
 
         return candles
 
-    def place_order(self, contract: Contract, order_type: str, quantity: int, side: str, price=None,
-                    tif=None) -> OrderStatus:
+    def _order_params(self, contract: Contract, order_type: str, quantity: int, side: str, price=None, tif=None,
+                      client_order_id: typing.Optional[str] = None, reduce_only: bool = False) -> typing.Dict:
         data = dict()
 
         data['symbol'] = contract.symbol
         data['side'] = side.capitalize()
-        data['orderQty'] = round(quantity / contract.lot_size) * contract.lot_size
+        data['orderQty'] = contract.round_quantity(quantity)
         data['ordType'] = order_type.capitalize()
 
         if price is not None:
-            data['price'] = round(round(price / contract.tick_size) * contract.tick_size, 8)
+            data['price'] = contract.round_price(price)
 
         if tif is not None:
             data['timeInForce'] = tif
 
+        if client_order_id is not None:
+            data['clOrdID'] = client_order_id
+
+        if reduce_only:
+            data['execInst'] = "ReduceOnly"
+
+        return data
+
+    def place_order(self, contract: Contract, order_type: str, quantity: int, side: str, price=None,
+                    tif=None, client_order_id: typing.Optional[str] = None) -> OrderStatus:
+        data = self._order_params(contract, order_type, quantity, side, price, tif, client_order_id)
+
         order_status = self._make_request("POST", "/api/v1/order", data)
 
         if order_status is not None:
@@ -169,6 +256,44 @@ class BitmexClient:
 
         return order_status
 
+    def order_template(self, contract: Contract, order_type: str, quantity: int, side: str, price=None,
+                       tif=None) -> str:
+
+        """
+        Encode an order in advance, place_order_template() only adds the client order id and the signature.
+        """
+
+        return urlencode(self._order_params(contract, order_type, quantity, side, price, tif))
+
+    def place_order_template(self, template: str, client_order_id: str) -> OrderStatus:
+        order_status = self._make_request("POST", "/api/v1/order", f"{template}&clOrdID={client_order_id}")
+
+        if order_status is not None:
+            order_status = OrderStatus(order_status, "bitmex")
+
+        return order_status
+
+    def place_orders(self, orders: typing.List[typing.Dict]) -> typing.List[typing.Optional[OrderStatus]]:
+
+        """
+        Place several orders in one request with the bulk order endpoint.
+        :param orders: The arguments of place_order() for each order, with a client_order_id
+        :return: The status of each order. None when the request failed: the order may or may not have been placed
+        """
+
+        data = dict()
+        data['orders'] = json.dumps([self._order_params(**o) for o in orders])
+
+        response = self._make_request("POST", "/api/v1/order/bulk", data)
+
+        if response is None:
+            return [None] * len(orders)
+
+        by_client_id = {order['clOrdID']: order for order in response}
+
+        return [OrderStatus(by_client_id[o['client_order_id']], "bitmex") if o['client_order_id'] in by_client_id
+                else None for o in orders]
+
     def cancel_order(self, order_id: str) -> OrderStatus:
         data = dict()
         data['orderID'] = order_id
@@ -180,18 +305,96 @@ class BitmexClient:
 
         return order_status
 
-    def get_order_status(self, contract: Contract, order_id: str) -> OrderStatus:
+    def cancel_all_orders(self, symbols: typing.List[str]) -> bool:
+
+        """
+        Cancel the open orders of all the symbols, in one request.
+        :param symbols: Unused, for the same arguments as the Binance client
+        :return: False if the request failed, orders may still be open
+        """
+
+        cancelled = self._make_request("DELETE", "/api/v1/order/all", dict())
+
+        if cancelled is None:
+            logger.warning("Bitmex: the open orders could not be cancelled")
+            return False
+
+        logger.info("Bitmex: %s orders cancelled", len(cancelled))
+        return True
+
+    def get_positions(self) -> typing.Optional[typing.Dict[str, float]]:
+
+        """
+        :return: Symbol -> position quantity, negative when short, for the open positions. None if the request failed
+        """
+
+        data = dict()
+        data['filter'] = json.dumps({"isOpen": True})
+
+        positions = self._make_request("GET", "/api/v1/position", data)
+
+        if positions is None:
+            return None
+
+        return {p['symbol']: p['currentQty'] for p in positions if p['currentQty'] != 0}
+
+    def close_all_positions(self, positions: typing.Optional[typing.Dict[str, float]] = None
+                            ) -> typing.List[typing.Optional[OrderStatus]]:
+
+        """
+        Close the open positions with reduce-only market orders, sent in one bulk request.
+        :param positions: Symbol -> quantity, as tracked by the program. Requested from the exchange first if None
+        """
+
+        if positions is None:
+            positions = self.get_positions()
+        if positions is None:
+            return [None]  # Unknown positions, reported as not closed
+
+        orders = [{"contract": self.contracts[symbol], "order_type": "MARKET", "quantity": abs(quantity),
+                   "side": "sell" if quantity > 0 else "buy", "reduce_only": True,
+                   "client_order_id": f"kill{symbol}{int(time.time() * 1000)}"}
+                  for symbol, quantity in positions.items() if symbol in self.contracts]
+
+        return self.place_orders(orders) if len(orders) > 0 else []
+
+    def get_order_status(self, contract: Contract, order_id: typing.Optional[str],
+                         client_order_id: typing.Optional[str] = None) -> OrderStatus:
 
         data = dict()
         data['symbol'] = contract.symbol
-        data['reverse'] = True
+        # Filtered by the exchange, the default page of the most recent orders may not contain it
+        if order_id is not None:
+            data['filter'] = json.dumps({"orderID": order_id})
+        else:
+            data['filter'] = json.dumps({"clOrdID": client_order_id})
 
         order_status = self._make_request("GET", "/api/v1/order", data)
 
-        if order_status is not None:
-            for order in order_status:
-                if order['orderID'] == order_id:
-                    return OrderStatus(order, "bitmex")
+        if order_status is not None and len(order_status) > 0:
+            return OrderStatus(order_status[0], "bitmex")
+
+    def find_order(self, contract: Contract,
+                   client_order_id: str) -> typing.Tuple[typing.Optional[bool], typing.Optional[OrderStatus]]:
+
+        """
+        Look up an order whose placement response was lost.
+        :return: (True, status) if the order exists, (False, None) if BitMEX has no order with this client order id,
+        (None, None) if the lookup itself failed
+        """
+
+        data = dict()
+        data['symbol'] = contract.symbol
+        data['filter'] = json.dumps({"clOrdID": client_order_id})
+
+        orders = self._make_request("GET", "/api/v1/order", data)
+
+        if orders is None:
+            return None, None
+        if len(orders) == 0:
+            return False, None
+
+        return True, OrderStatus(orders[0], "bitmex")
 
     def _start_ws(self):
         self.ws = websocket.WebSocketApp(self._wss_url, on_open=self._on_open, on_close=self._on_close,
@@ -229,57 +432,55 @@ class BitmexClient:
 
                 for d in data['data']:
 
-                    symbol = d['symbol']
-
-                    if symbol not in self.prices:
-                        self.prices[symbol] = {'bid': None, 'ask': None}
-
-                    if 'bidPrice' in d:
-                        self.prices[symbol]['bid'] = d['bidPrice']
-                    if 'askPrice' in d:
-                        self.prices[symbol]['ask'] = d['askPrice']
-
-                    # PNL Calculation
-
-                    try:
-                        for b_index, strat in self.strategies.items():
-                            if strat.contract.symbol == symbol:
-                                for trade in strat.trades:
-                                    if trade.status == "open" and trade.entry_price is not None:
-
-                                        if trade.side == "long":
-                                            price = self.prices[symbol]['bid']
-                                        else:
-                                            price = self.prices[symbol]['ask']
-                                        multiplier = trade.contract.multiplier
-
-                                        if trade.contract.inverse:
-                                            if trade.side == "long":
-                                                trade.pnl = (
-                                                                        1 / trade.entry_price - 1 / price) * multiplier * trade.quantity
-                                            elif trade.side == "short":
-                                                trade.pnl = (
-                                                                        1 / price - 1 / trade.entry_price) * multiplier * trade.quantity
-                                        else:
-                                            if trade.side == "long":
-                                                trade.pnl = (price - trade.entry_price) * multiplier * trade.quantity
-                                            elif trade.side == "short":
-                                                trade.pnl = (trade.entry_price - price) * multiplier * trade.quantity
-                    except RuntimeError as e:
-                        logger.error("Error while looping through the Bitmex strategies: %s", e)
+                    # The updates only contain the fields that changed, None for the other one
+                    if 'bidPrice' in d or 'askPrice' in d:
+                        self._publish_quote(d['symbol'], d.get('bidPrice'), d.get('askPrice'))
 
             if data['table'] == "trade":
 
                 for d in data['data']:
 
-                    symbol = d['symbol']
-
                     ts = int(dateutil.parser.isoparse(d['timestamp']).timestamp() * 1000)
 
-                    for key, strat in self.strategies.items():
-                        if strat.contract.symbol == symbol:
-                            res = strat.parse_trades(float(d['price']), float(d['size']), ts)
-                            strat.check_trade(res)
+                    self._publish_trade(d['symbol'], float(d['price']), float(d['size']), ts)
+
+    def _publish_quote(self, symbol: str, bid: typing.Optional[float], ask: typing.Optional[float]):
+        dispatcher.publish(QuoteEvent(self.platform, symbol, bid, ask))
+
+    def _publish_trade(self, symbol: str, price: float, quantity: float, timestamp: int):
+        dispatcher.publish(TradeEvent(self.platform, symbol, price, quantity, timestamp))
+
+    def _on_quote(self, event: QuoteEvent):
+        symbol = event.symbol
+
+        if symbol not in self.prices:
+            self.prices[symbol] = {'bid': None, 'ask': None}
+
+        # Partial update, keep the side that did not change
+        if event.bid is not None:
+            self.prices[symbol]['bid'] = event.bid
+        if event.ask is not None:
+            self.prices[symbol]['ask'] = event.ask
+
+        bid, ask = self.prices[symbol]['bid'], self.prices[symbol]['ask']
+
+        # PNL Calculation
+
+        if bid is None or ask is None:
+            return
+
+        if symbol in self.aggregators:
+            self.unrealized_pnl += self.aggregators[symbol].positions.revalue(bid, ask)
+
+        if self.worker_pool is not None:
+            self.worker_pool.publish_quote(symbol, bid, ask)
+
+    def _on_trade(self, event: TradeEvent):
+        if event.symbol in self.aggregators:
+            self.aggregators[event.symbol].parse_trade(event.price, event.quantity, event.timestamp)
+
+        if self.worker_pool is not None:
+            self.worker_pool.publish_trade(event.symbol, event.price, event.quantity, event.timestamp)
 
     def subscribe_channel(self, topic: str):
         data = dict()
@@ -303,15 +504,25 @@ class BitmexClient:
         :return:
         """
 
-        balance = self.get_balances()
-        if balance is not None:
-            if 'XBt' in balance:
-                balance = balance['XBt'].wallet_balance
-            else:
-                return None
-        else:
+        balance = self.get_trade_balance()
+        if balance is None:
+            return None
+
+        return self.trade_size_from_balance(contract, price, balance_pct, balance)
+
+    def get_trade_balance(self) -> typing.Optional[float]:
+
+        """
+        :return: The XBT wallet balance the trades are sized on, None if the request failed
+        """
+
+        balances = self.get_balances()
+        if balances is None or 'XBt' not in balances:
             return None
 
+        return balances['XBt'].wallet_balance
+
+    def trade_size_from_balance(self, contract: Contract, price: float, balance_pct: float, balance: float) -> int:
         xbt_size = balance * balance_pct / 100
 
         # The trade size calculation depends on the type of contract
@@ -0,0 +1,360 @@
+import logging
+import itertools
+import math
+import threading
+import time
+import typing
+
+from models import *
+from orders import OrderManager
+from positions import PositionTable
+from events import dispatcher, QuoteEvent, TradeEvent
+
+if typing.TYPE_CHECKING:
+    from connectors.binance_futures import BinanceFuturesClient
+    from connectors.bitmex import BitmexClient
+
+logger = logging.getLogger()
+
+
+class PaperOrder:
+    def __init__(self, order_id: int, contract: Contract, order_type: str, lots: int, side: str,
+                 price: typing.Optional[float], submit_time: int, client_order_id: typing.Optional[str] = None):
+        self.order_id = order_id
+        self.client_order_id = client_order_id
+        self.contract = contract
+        self.order_type = order_type.upper()
+        self.lots = lots
+        self.side = side.lower()
+        self.price = price
+        self.submit_time = submit_time
+
+        self.filled_lots = 0
+        self.filled_value = 0.0  # Sum of the fill prices weighted by the lots, for the average price
+        self.status = "new"
+
+    @property
+    def avg_price(self) -> float:
+        return self.filled_value / self.filled_lots if self.filled_lots > 0 else 0.0
+
+
+class PaperPosition:
+    def __init__(self):
+
+        """
+        Net position of a contract. The entry is averaged on the price for linear contracts and on 1 / price for
+        inverse contracts, so the realized PnL uses the same formulas as the PositionTable.
+        """
+
+        self.quantity = 0.0  # Signed, negative when short
+        self.entry_value = 0.0  # Average entry price, or average 1 / entry price for inverse contracts
+
+
+class PaperClient:
+    def __init__(self, client: typing.Union["BinanceFuturesClient", "BitmexClient"], initial_balance: float = 1000,
+                 latency_ms: int = 100, fee_rate: float = 0.0004, fill_ratio: float = 1.0,
+                 clock: typing.Optional[typing.Callable[[], int]] = None):
+
+        """
+        Simulated execution with the same order methods as the exchange clients, filling against the top of book of
+        the wrapped client (live prices, or replayed ones with a replay clock).
+        The open orders are evaluated on the quotes and trades of their symbol, in the dispatcher thread, and once when
+        the latency has elapsed: they fill at the top of book of that moment, whenever their status is queried.
+        Every other attribute (contracts, prices, aggregators, strategies...) is the one of the wrapped client.
+        :param client: Provides the market data, no order is ever sent to it
+        :param initial_balance: In USDT for Binance, in XBT for Bitmex
+        :param latency_ms: Delay between the order submission and its first fill, then between two partial fills
+        :param fee_rate: Taker fee, as a fraction of the notional value
+        :param fill_ratio: Fraction of the order quantity filled at each step, 1 fills the whole order at once
+        :param clock: Returns the current time in milliseconds, the local time by default
+        """
+
+        self._client = client
+
+        self.latency_ms = latency_ms
+        self.fee_rate = fee_rate
+        self.fill_ratio = fill_ratio
+        self._clock = clock or (lambda: int(time.time() * 1000))
+
+        self._asset = "XBt" if client.platform == "bitmex" else "USDT"
+        self.wallet_balance = initial_balance
+        self.fees_paid = 0.0
+
+        self._orders: typing.Dict[int, PaperOrder] = dict()
+        self._client_order_ids: typing.Dict[str, int] = dict()
+        self._open_orders: typing.Dict[int, PaperOrder] = dict()
+        self.positions: typing.Dict[str, PaperPosition] = dict()
+
+        # Open trades of the paper strategies, not counted in the unrealized PnL of the wrapped client
+        self._position_tables: typing.Dict[str, PositionTable] = dict()
+        self.unrealized_pnl = 0.0
+
+        self._order_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+        self.orders = OrderManager(self)  # Not the one of the wrapped client, it would send the orders to the exchange
+
+        # After the handlers of the wrapped client, its prices are up to date
+        dispatcher.subscribe(QuoteEvent, self._on_market_data, client.platform)
+        dispatcher.subscribe(TradeEvent, self._on_market_data, client.platform)
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+    def get_balances(self) -> typing.Dict[str, Balance]:
+        with self._lock:
+            for order in list(self._open_orders.values()):
+                self._update_order(order)
+
+            unrealized_pnl = sum(self._unrealized_pnl(symbol, position) for symbol, position in self.positions.items())
+
+            info = {'initialMargin': 0, 'maintMargin': 0, 'marginBalance': self.wallet_balance + unrealized_pnl,
+                    'walletBalance': self.wallet_balance, 'unrealizedProfit': unrealized_pnl}
+
+        return {self._asset: Balance(info, "binance")}
+
+    def get_trade_size(self, contract: Contract, price: float, balance_pct: float):
+
+        """
+        Same sizing as the wrapped client, on the paper wallet balance.
+        """
+
+        return self.trade_size_from_balance(contract, price, balance_pct, self.wallet_balance)
+
+    def get_trade_balance(self) -> float:
+        return self.wallet_balance
+
+    def trade_size_from_balance(self, contract: Contract, price: float, balance_pct: float, balance: float):
+        amount = balance * balance_pct / 100
+
+        if self._client.platform == "bitmex":
+            if contract.inverse:
+                trade_size = int(amount / (contract.multiplier / price))
+            else:
+                trade_size = int(amount / (contract.multiplier * price))
+        else:
+            trade_size = contract.round_quantity(amount / price)
+
+        logger.info("Paper %s balance = %s, trade size = %s", self._asset, balance, trade_size)
+
+        return trade_size
+
+    def place_order(self, contract: Contract, order_type: str, quantity: float, side: str, price=None,
+                    tif=None, client_order_id: typing.Optional[str] = None) -> OrderStatus:
+
+        lots = contract.quantity_to_lots(quantity)
+        if lots <= 0:
+            logger.error("Paper %s order on %s rejected: quantity %s", side, contract.symbol, quantity)
+            return None
+
+        with self._lock:
+            order = PaperOrder(next(self._order_ids), contract, order_type, lots, side,
+                               contract.round_price(price) if price is not None else None, self._clock(),
+                               client_order_id)
+
+            self._orders[order.order_id] = order
+            self._open_orders[order.order_id] = order
+            if client_order_id is not None:
+                self._client_order_ids[client_order_id] = order.order_id
+
+            self._update_order(order)
+
+            if order.order_id in self._open_orders:  # Filled at the end of the latency even if no quote comes
+                dispatcher.call_later(self.latency_ms / 1000, lambda: self._evaluate(order))
+
+            return self._order_status(order)
+
+    def _evaluate(self, order: PaperOrder):
+        with self._lock:
+            self._update_order(order)
+
+    def position_table(self, contract: Contract) -> PositionTable:
+        if contract.symbol not in self._position_tables:
+            self._position_tables[contract.symbol] = PositionTable()
+
+        return self._position_tables[contract.symbol]
+
+    def _on_market_data(self, event: typing.Union[QuoteEvent, TradeEvent]):
+        if isinstance(event, QuoteEvent) and event.symbol in self._position_tables:
+            # A Bitmex quote only has the side that changed, the wrapped client has merged it with the other side
+            prices = self._client.prices.get(event.symbol)
+            if prices is not None and prices['bid'] is not None and prices['ask'] is not None:
+                self.unrealized_pnl += self._position_tables[event.symbol].revalue(prices['bid'], prices['ask'])
+
+        if len(self._open_orders) == 0:
+            return
+
+        with self._lock:
+            for order in list(self._open_orders.values()):
+                if order.contract.symbol == event.symbol:
+                    self._update_order(order)
+
+    def place_orders(self, orders: typing.List[typing.Dict]) -> typing.List[typing.Optional[OrderStatus]]:
+        return [self.place_order(**o) for o in orders]
+
+    def order_template(self, contract: Contract, order_type: str, quantity: float, side: str, price=None,
+                       tif=None) -> typing.Dict:
+        return {"contract": contract, "order_type": order_type, "quantity": quantity, "side": side, "price": price,
+                "tif": tif}
+
+    def place_order_template(self, template: typing.Dict, client_order_id: str) -> OrderStatus:
+        return self.place_order(**template, client_order_id=client_order_id)
+
+    def get_order_status(self, contract: Contract, order_id: typing.Optional[int],
+                         client_order_id: typing.Optional[str] = None) -> OrderStatus:
+        with self._lock:
+            if order_id is None:
+                order_id = self._client_order_ids.get(client_order_id)
+
+            return self._current_status(order_id)
+
+    def find_order(self, contract: Contract,
+                   client_order_id: str) -> typing.Tuple[typing.Optional[bool], typing.Optional[OrderStatus]]:
+        with self._lock:
+            if client_order_id not in self._client_order_ids:
+                return False, None
+
+            return True, self._current_status(self._client_order_ids[client_order_id])
+
+    def _current_status(self, order_id: typing.Optional[int]) -> OrderStatus:
+
+        """
+        The lock must be held.
+        """
+
+        order = self._orders.get(order_id)
+        if order is None:
+            return None
+
+        self._update_order(order)
+
+        return self._order_status(order)
+
+    def cancel_order(self, contract_or_order_id, order_id=None) -> OrderStatus:
+
+        """
+        Same arguments as the wrapped client: (contract, order_id) for Binance, (order_id) for Bitmex.
+        """
+
+        if order_id is None:
+            order_id = contract_or_order_id
+
+        with self._lock:
+            order = self._orders.get(order_id)
+            if order is None:
+                return None
+
+            self._update_order(order)
+
+            if order.order_id in self._open_orders:
+                order.status = "canceled"
+                del self._open_orders[order.order_id]
+
+            return self._order_status(order)
+
+    @staticmethod
+    def _order_status(order: PaperOrder) -> OrderStatus:
+        return OrderStatus({'orderId': order.order_id, 'status': order.status, 'avgPrice': order.avg_price,
+                            'clientOrderId': order.client_order_id,
+                            'executedQty': order.contract.lots_to_quantity(order.filled_lots)}, "binance")
+
+    def _update_order(self, order: PaperOrder):
+
+        """
+        Apply the fills due since the last evaluation of the order: after the latency, one step of fill_ratio of the
+        order quantity per latency period, at the current top of book.
+        A limit order only fills when the top of book crosses its price, and then fills at its price.
+        """
+
+        if order.order_id not in self._open_orders:
+            return
+
+        elapsed = self._clock() - order.submit_time - self.latency_ms
+        if elapsed < 0:
+            return
+
+        prices = self._client.prices.get(order.contract.symbol)
+        if prices is None or prices['bid'] is None or prices['ask'] is None:
+            return
+
+        market_price = prices['ask'] if order.side == "buy" else prices['bid']
+
+        if order.order_type == "LIMIT":
+            if order.side == "buy" and market_price > order.price:
+                return
+            if order.side == "sell" and market_price < order.price:
+                return
+            fill_price = order.price
+        else:
+            fill_price = market_price
+
+        steps = 1 + elapsed // self.latency_ms if self.latency_ms > 0 else math.inf
+        step_lots = max(1, math.ceil(order.lots * self.fill_ratio))
+        lots = min(order.lots, steps * step_lots) - order.filled_lots
+
+        if lots <= 0:
+            return
+
+        order.filled_lots += lots
+        order.filled_value += lots * fill_price
+
+        if order.filled_lots == order.lots:
+            order.status = "filled"
+            del self._open_orders[order.order_id]
+        else:
+            order.status = "partially_filled"
+
+        quantity = order.contract.lots_to_quantity(lots)
+        self._apply_fill(order.contract, quantity if order.side == "buy" else -quantity, fill_price)
+
+    def _apply_fill(self, contract: Contract, quantity: float, price: float):
+
+        """
+        Update the position of the contract and the wallet balance with the realized PnL and the fee of a fill.
+        :param contract:
+        :param quantity: Signed, negative for a sell
+        :param price:
+        :return:
+        """
+
+        value = 1 / price if contract.inverse else price
+
+        notional = abs(quantity) * contract.multiplier * value
+        fee = notional * self.fee_rate
+        self.wallet_balance -= fee
+        self.fees_paid += fee
+
+        position = self.positions.setdefault(contract.symbol, PaperPosition())
+
+        if position.quantity * quantity < 0:  # Reduces the position, the closed part realizes its PnL
+            closed = min(abs(quantity), abs(position.quantity))
+            side = 1 if position.quantity > 0 else -1
+
+            if contract.inverse:
+                pnl = side * (position.entry_value - value) * closed * contract.multiplier
+            else:
+                pnl = side * (value - position.entry_value) * closed * contract.multiplier
+            self.wallet_balance += pnl
+
+            position.quantity += side * -closed
+            quantity += side * closed
+
+            if position.quantity == 0:
+                position.entry_value = 0.0
+
+        if quantity != 0:  # Opens or increases the position
+            total = abs(position.quantity) + abs(quantity)
+            position.entry_value = (position.entry_value * abs(position.quantity) + value * abs(quantity)) / total
+            position.quantity += quantity
+
+    def _unrealized_pnl(self, symbol: str, position: PaperPosition) -> float:
+        prices = self._client.prices.get(symbol)
+        if position.quantity == 0 or prices is None or prices['bid'] is None or prices['ask'] is None:
+            return 0.0
+
+        contract = self._client.contracts[symbol]
+        price = prices['bid'] if position.quantity > 0 else prices['ask']
+
+        if contract.inverse:
+            return (position.entry_value - 1 / price) * position.quantity * contract.multiplier
+        return (price - position.entry_value) * position.quantity * contract.multiplier
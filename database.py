@@ -1,49 +1,214 @@
+import logging
+import os
+import queue
 import sqlite3
+import threading
 import typing
 
+logger = logging.getLogger()
+
+
+# Next to the code, not in the directory the program is started from
+DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database.db")
+
+# Columns of each table, and the columns of its primary key. The rows of the ordered tables have no natural key, they
+# are identified by their position in the interface.
+TABLES = {
+    "watchlist": {"columns": ["symbol", "exchange"], "key": ["symbol", "exchange"], "ordered": False},
+    "strategies": {"columns": ["position", "strategy_type", "contract", "timeframe", "balance_pct", "take_profit",
+                               "stop_loss", "extra_params", "mode", "uid"], "key": ["position"], "ordered": True},
+}
+
+SCHEMA = {
+    "watchlist": "CREATE TABLE IF NOT EXISTS watchlist (symbol TEXT NOT NULL, exchange TEXT NOT NULL, "
+                 "PRIMARY KEY (symbol, exchange))",
+    "strategies": "CREATE TABLE IF NOT EXISTS strategies (position INTEGER PRIMARY KEY, strategy_type TEXT, "
+                  "contract TEXT, timeframe TEXT, balance_pct REAL, take_profit REAL, stop_loss REAL, "
+                  "extra_params TEXT, mode TEXT, uid TEXT)",
+}
+
+
+def _migrate_primary_keys(conn: sqlite3.Connection):
+
+    """
+    Version 1: primary keys. The tables of the previous versions had none, and no mode column before the Live / Paper
+    mode was added: their rows are copied to the new tables.
+    """
+
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    if "watchlist" in existing:
+        conn.execute("ALTER TABLE watchlist RENAME TO watchlist_v0")
+    if "strategies" in existing:
+        conn.execute("ALTER TABLE strategies RENAME TO strategies_v0")
+
+    for statement in SCHEMA.values():
+        conn.execute(statement)
+
+    if "watchlist" in existing:
+        conn.execute("INSERT OR IGNORE INTO watchlist (symbol, exchange) SELECT symbol, exchange FROM watchlist_v0 "
+                     "WHERE symbol IS NOT NULL AND exchange IS NOT NULL ORDER BY rowid")
+        conn.execute("DROP TABLE watchlist_v0")
+
+    if "strategies" in existing:
+        columns = [c[1] for c in conn.execute("PRAGMA table_info(strategies_v0)")]
+        mode = "mode" if "mode" in columns else "NULL"
+        conn.execute(f"INSERT INTO strategies (position, strategy_type, contract, timeframe, balance_pct, take_profit, "
+                     f"stop_loss, extra_params, mode) SELECT rowid - 1, strategy_type, contract, timeframe, "
+                     f"balance_pct, take_profit, stop_loss, extra_params, {mode} FROM strategies_v0 ORDER BY rowid")
+        conn.execute("DROP TABLE strategies_v0")
+
+
+def _add_strategy_ids(conn: sqlite3.Connection):
+
+    """
+    Version 2: uid of the strategy rows, the key of their trades in the journal. The existing rows get a random one.
+    """
+
+    columns = [c[1] for c in conn.execute("PRAGMA table_info(strategies)")]
+    if "uid" not in columns:
+        conn.execute("ALTER TABLE strategies ADD COLUMN uid TEXT")
+
+    conn.execute("UPDATE strategies SET uid = lower(hex(randomblob(16))) WHERE uid IS NULL")
+
+
+# Migration to each version, applied in order to the databases created by the previous versions of the program
+MIGRATIONS = [_migrate_primary_keys, _add_strategy_ids]
+
 
 class WorkspaceData:
-    def __init__(self):
-        self.conn = sqlite3.connect("database.db")
-        self.conn.row_factory = sqlite3.Row  # Makes the data retrieved from the database accessible by their column name
-        self.cursor = self.conn.cursor()
+    def __init__(self, path: str = DATABASE_PATH):
+
+        """
+        Watchlist and strategies of the interface, one store shared by all the components.
+        save() only queues the rows: a background thread compares them with the rows last saved and writes the
+        differences (upserts and deletes by primary key) in one transaction, so saving never blocks the interface and
+        costs nothing when nothing changed.
+        The database is in WAL mode and its schema is versioned with PRAGMA user_version, see MIGRATIONS.
+        :param path:
+        """
 
-        self.cursor.execute("CREATE TABLE IF NOT EXISTS watchlist (symbol TEXT, exchange TEXT)")
-        self.cursor.execute("CREATE TABLE IF NOT EXISTS strategies (strategy_type TEXT, contract TEXT,"
-                            "timeframe TEXT, balance_pct REAL, take_profit REAL, stop_loss REAL, extra_params TEXT)")
+        self.path = path
 
-        self.conn.commit()  # Saves the changes
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row  # Makes the data retrieved from the database accessible by column name
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+        self._lock = threading.Lock()  # One connection for all the threads
+
+        self._migrate()
+
+        # Rows as last written, by primary key: the next save only writes what changed
+        self._saved: typing.Dict[str, typing.Dict[typing.Tuple, typing.Tuple]] = {
+            table: {self._key(table, tuple(row)): tuple(row) for row in self.get(table)} for table in TABLES}
+
+        self._queue = queue.SimpleQueue()
+
+        t = threading.Thread(target=self._write, daemon=True)
+        t.start()
+
+    def _migrate(self):
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(MIGRATIONS):
+            return
+
+        self._conn.execute("BEGIN")  # The table renames are part of the transaction, a failed migration leaves nothing
+
+        with self._lock, self._conn:
+            for new_version in range(version + 1, len(MIGRATIONS) + 1):
+                MIGRATIONS[new_version - 1](self._conn)
+                self._conn.execute(f"PRAGMA user_version = {new_version}")
+                logger.info("Database migrated to version %s", new_version)
+
+    @staticmethod
+    def _key(table: str, row: typing.Tuple) -> typing.Tuple:
+        columns = TABLES[table]["columns"]
+        return tuple(row[columns.index(column)] for column in TABLES[table]["key"])
 
     def save(self, table: str, data: typing.List[typing.Tuple]):
 
         """
-        Erase the previous table content and record new data to it.
+        Record the new content of the table, the rows not in data are deleted. Returns immediately.
         :param table: The table name
-        :param data: A list of tuples, the tuples elements must be ordered like the table columns
+        :param data: A list of tuples, the tuples elements must be ordered like the table columns (without the position
+        for the ordered tables, it is the index of the tuple in the list)
         :return:
         """
 
-        self.cursor.execute(f"DELETE FROM {table}")
+        if TABLES[table]["ordered"]:
+            data = [(position, *row) for position, row in enumerate(data)]
+
+        self._queue.put((table, list(data)))
+
+    def flush(self, timeout: typing.Optional[float] = 5.0) -> bool:
+
+        """
+        Wait until the saves queued so far are written, e.g. before closing the program.
+        """
+
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def _write(self):
+        while True:
+            saves = dict()  # Only the last save of each table matters
+            flushes = []
+
+            item = self._queue.get()
+            while True:
+                if item[0] == "flush":
+                    flushes.append(item[1])
+                else:
+                    saves[item[0]] = item[1]
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            for table, data in saves.items():
+                try:
+                    self._write_table(table, data)
+                except sqlite3.Error as e:
+                    logger.error("Error while saving the %s table: %s", table, e)
+
+            for done in flushes:
+                done.set()
+
+    def _write_table(self, table: str, data: typing.List[typing.Tuple]):
+        rows = {self._key(table, row): row for row in data}
+        saved = self._saved[table]
+
+        deleted = [key for key in saved if key not in rows]
+        changed = [row for key, row in rows.items() if saved.get(key) != row]
+
+        if len(deleted) == 0 and len(changed) == 0:
+            return
 
-        table_data = self.cursor.execute(f"SELECT * FROM {table}")
+        columns = TABLES[table]["columns"]
+        key_columns = TABLES[table]["key"]
 
-        columns = [description[0] for description in table_data.description]  # Lists the columns of the table
+        with self._lock, self._conn:  # One transaction
+            self._conn.executemany(f"DELETE FROM {table} WHERE {' AND '.join(c + ' = ?' for c in key_columns)}",
+                                   deleted)
+            self._conn.executemany(f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) "
+                                   f"VALUES ({', '.join(['?'] * len(columns))})", changed)
 
-        # Creates the SQL insert statement dynamically
-        sql_statement = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+        self._saved[table] = rows
 
-        self.cursor.executemany(sql_statement, data)
-        self.conn.commit()
+        logger.info("Workspace %s saved: %s rows changed, %s deleted", table, len(changed), len(deleted))
 
     def get(self, table: str) -> typing.List[sqlite3.Row]:
 
         """
         Get all the rows recorded for the table.
         :param table: The table name to get the rows from. e.g: strategies, watchlist
-        :return: A list of sqlite3.Rows accessible like Python dictionaries.
+        :return: A list of sqlite3.Rows accessible like Python dictionaries, in the order of the interface.
         """
 
-        self.cursor.execute(f"SELECT * FROM {table}")
-        data = self.cursor.fetchall()
+        order = "position" if TABLES[table]["ordered"] else "rowid"
 
-        return data
+        with self._lock:
+            return self._conn.execute(f"SELECT {', '.join(TABLES[table]['columns'])} FROM {table} "
+                                      f"ORDER BY {order}").fetchall()
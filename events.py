@@ -0,0 +1,236 @@
+import collections
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+import typing
+
+from models import *
+from scheduler import Timer, scheduler
+
+if typing.TYPE_CHECKING:
+    from strategies import Strategy
+
+logger = logging.getLogger()
+
+
+class Event:
+    def __init__(self, source: typing.Optional[str]):
+
+        """
+        :param source: Platform of the exchange the event comes from (binance_futures, bitmex...), None if global
+        """
+
+        self.source = source
+        self.created = 0  # time.perf_counter_ns() when published, to measure the dispatch latency
+
+
+class TradeEvent(Event):
+    def __init__(self, source: str, symbol: str, price: float, quantity: float, timestamp: int):
+        super().__init__(source)
+        self.symbol = symbol
+        self.price = price
+        self.quantity = quantity
+        self.timestamp = timestamp
+
+
+class QuoteEvent(Event):
+    def __init__(self, source: str, symbol: str, bid: typing.Optional[float], ask: typing.Optional[float]):
+        super().__init__(source)
+        self.symbol = symbol
+        self.bid = bid
+        self.ask = ask
+
+
+class CandleCloseEvent(Event):
+    def __init__(self, source: str, symbol: str, timeframe: str, candle: Candle):
+        super().__init__(source)
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self.candle = candle
+
+
+class OrderUpdateEvent(Event):
+    def __init__(self, source: str, strategy: "Strategy", trade: Trade):
+
+        """
+        A trade of a strategy was opened, got its entry price, or was closed.
+        """
+
+        super().__init__(source)
+        self.strategy = strategy
+        self.trade = trade
+
+
+class LogEvent(Event):
+    def __init__(self, source: typing.Optional[str], message: str):
+        super().__init__(source)
+        self.message = message
+
+
+class TimerEvent(Event):
+    def __init__(self, callback: typing.Callable):
+        super().__init__(None)
+        self.callback = callback
+
+
+class EventDispatcher:
+    def __init__(self, blocking_workers: int = 4):
+
+        """
+        All the events of the bot go through one queue and are processed in order by one thread: the market data of
+        the websockets, the timers and the results of the REST requests. The handlers never run concurrently, so they
+        can share state without locks.
+        The handlers must not block: slow calls go through run_blocking(), which runs them in a small thread pool and
+        queues their result as an event.
+        :param blocking_workers: Size of the thread pool of run_blocking()
+        """
+
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+
+        # (event type, source) -> handlers, the lists are replaced, never modified, so the thread reads them freely
+        self._handlers: typing.Dict[typing.Tuple[type, typing.Optional[str]], typing.List[typing.Callable]] = dict()
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=blocking_workers)
+
+        # Time spent in the queue by the last events of each type, in microseconds
+        self.latencies: typing.Dict[str, typing.Deque[int]] = collections.defaultdict(
+            lambda: collections.deque(maxlen=1000))
+
+        self._lock = threading.Lock()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def subscribe(self, event_type: type, handler: typing.Callable, source: typing.Optional[str] = None):
+
+        """
+        :param event_type: TradeEvent, QuoteEvent...
+        :param handler: Called with the event, in the dispatcher thread
+        :param source: Only receive the events of this exchange, all of them if None
+        :return:
+        """
+
+        with self._lock:
+            key = (event_type, source)
+            self._handlers[key] = self._handlers.get(key, []) + [handler]
+
+    def unsubscribe(self, event_type: type, handler: typing.Callable, source: typing.Optional[str] = None):
+        with self._lock:
+            key = (event_type, source)
+            self._handlers[key] = [h for h in self._handlers.get(key, []) if h != handler]
+
+    def publish(self, event: Event):
+
+        """
+        Queue an event, from any thread.
+        """
+
+        event.created = time.perf_counter_ns()
+        self._queue.put(event)
+
+        if self._thread is None:
+            self._start()
+
+    def call_at(self, timestamp: int, callback: typing.Callable, clock_offset: int = 0) -> Timer:
+
+        """
+        Like scheduler.call_at(), but the callback runs in the dispatcher thread.
+        """
+
+        return scheduler.call_at(timestamp, lambda: self.publish(TimerEvent(callback)), clock_offset)
+
+    def call_later(self, delay: float, callback: typing.Callable) -> Timer:
+
+        """
+        :param delay: In seconds
+        :param callback: Runs in the dispatcher thread
+        :return:
+        """
+
+        return scheduler.call_later(delay, lambda: self.publish(TimerEvent(callback)))
+
+    def run_blocking(self, function: typing.Callable, on_result: typing.Callable):
+
+        """
+        Run a blocking function (e.g. a REST request) in the thread pool, then its result is passed to on_result in
+        the dispatcher thread.
+        :param function: Called without argument
+        :param on_result: Called with the return value of the function, or None if it raised an exception
+        :return:
+        """
+
+        def done(future: concurrent.futures.Future):
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error("Error in %s: %s", function, e)
+                result = None
+            self.publish(TimerEvent(lambda: on_result(result)))
+
+        self._executor.submit(function).add_done_callback(done)
+
+    def latency_report(self) -> typing.Dict[str, typing.Dict[str, int]]:
+
+        """
+        :return: Median, 99th percentile and maximum time spent in the queue by the last events of each type, in
+        microseconds
+        """
+
+        report = dict()
+
+        for event_type, latencies in list(self.latencies.items()):
+            values = sorted(latencies)
+            if len(values) > 0:
+                report[event_type] = {"median": values[len(values) // 2], "p99": values[int(len(values) * 0.99)],
+                                      "max": values[-1]}
+
+        return report
+
+    def _after_fork(self):
+
+        """
+        The dispatcher thread and the thread pool do not exist in a child process (strategy workers), the child starts
+        its own when it publishes its first event. The subscriptions are kept.
+        """
+
+        self._queue = queue.SimpleQueue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._executor._max_workers)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            event_type = type(event)
+
+            self.latencies[event_type.__name__].append((time.perf_counter_ns() - event.created) // 1000)
+
+            if event_type is TimerEvent:
+                try:
+                    event.callback()
+                except Exception as e:
+                    logger.error("Error in timer callback %s: %s", event.callback, e)
+                continue
+
+            handlers = self._handlers.get((event_type, event.source), []) + self._handlers.get((event_type, None), [])
+
+            for handler in handlers:
+                try:
+                    handler(event)
+                except Exception as e:
+                    logger.error("Error while handling %s from %s: %s", event_type.__name__, event.source, e)
+
+
+dispatcher = EventDispatcher()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=dispatcher._after_fork)
@@ -0,0 +1,268 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import typing
+
+import dateutil.parser
+import websocket
+
+from ring_buffer import RingBuffer, TRADE_DTYPE, QUOTE_DTYPE, CANDLE_DTYPE
+
+logger = logging.getLogger()
+
+
+BUFFERS = {"trades": TRADE_DTYPE, "quotes": QUOTE_DTYPE, "candles": CANDLE_DTYPE}
+CANDLE_MS = 60000  # The feed builds the 1m candles, the strategies roll up the higher timeframes themselves
+
+
+def feed_directory(data_dir: str, platform: str) -> str:
+    return os.path.join(data_dir, platform)
+
+
+def load_symbols(directory: str) -> typing.List[str]:
+
+    """
+    The symbol table of a feed: the "symbol" field of the records is an index in this list.
+    """
+
+    with open(os.path.join(directory, "symbols.json")) as f:
+        return json.load(f)
+
+
+class FeedHandler:
+    def __init__(self, platform: str, wss_url: str, symbols: typing.List[str], data_dir: str = "feed_data",
+                 capacity: int = 1 << 16):
+
+        """
+        Starts a process that owns the websocket connection of an exchange, decodes the messages and writes the
+        normalized trades, quotes and 1m candles into memory-mapped ring buffers, one file per stream in
+        data_dir/platform. Any process can read them at the same time with a FeedReader, without locks.
+        :param platform: binance_futures, binance_spot or bitmex
+        :param wss_url:
+        :param symbols: Symbol table, all the contracts of the exchange
+        :param data_dir:
+        :param capacity: Number of records of each ring buffer
+        """
+
+        self.platform = platform
+        self.directory = feed_directory(data_dir, platform)
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(os.path.join(self.directory, "symbols.json"), "w") as f:
+            json.dump(symbols, f)
+
+        # Created here so they exist before the readers open them, the feed process writes to them
+        buffers = {stream: RingBuffer(dtype, capacity, path=os.path.join(self.directory, stream + ".buf"))
+                   for stream, dtype in BUFFERS.items()}
+        descriptors = {stream: buffer.descriptor() for stream, buffer in buffers.items()}
+        for buffer in buffers.values():
+            buffer.close()
+
+        self._commands = multiprocessing.Queue()
+
+        self._process = multiprocessing.Process(target=_feed_main, daemon=True,
+                                                args=(platform, wss_url, symbols, descriptors, self._commands))
+        self._process.start()
+
+        logger.info("%s feed handler process started, writing to %s", platform, self.directory)
+
+    def subscribe(self, symbols: typing.List[str], channel: str):
+
+        """
+        Binance only, the Bitmex feed receives all the symbols.
+        :param symbols:
+        :param channel: aggTrade or bookTicker
+        :return:
+        """
+
+        self._commands.put(("subscribe", symbols, channel))
+
+    def stop(self):
+        self._commands.put(("exit",))
+        self._process.join(timeout=2)
+
+
+class FeedReader:
+    def __init__(self, directory: str, on_trade: typing.Optional[typing.Callable] = None,
+                 on_quote: typing.Optional[typing.Callable] = None,
+                 on_candle: typing.Optional[typing.Callable] = None):
+
+        """
+        Follows the ring buffers of a feed in a thread and calls the callbacks of the streams it is interested in.
+        Only the records published after the reader started are read.
+        :param directory: data_dir/platform
+        :param on_trade: on_trade(symbol, price, quantity, timestamp)
+        :param on_quote: on_quote(symbol, bid, ask)
+        :param on_candle: on_candle(symbol, timestamp, open, high, low, close, volume, closed)
+        """
+
+        self.symbols = load_symbols(directory)
+
+        self._streams = []
+
+        for stream, callback in [("trades", on_trade), ("quotes", on_quote), ("candles", on_candle)]:
+            if callback is not None:
+                buffer = RingBuffer.open_file(os.path.join(directory, stream + ".buf"), BUFFERS[stream])
+                self._streams.append([stream, buffer, buffer.write_seq, callback])
+
+        self.running = True
+
+        t = threading.Thread(target=self._run, daemon=True)
+        t.start()
+
+    def _run(self):
+        symbols = self.symbols
+
+        while self.running:
+            new_records = False
+
+            for stream_state in self._streams:
+                stream, buffer, seq, callback = stream_state
+                records, stream_state[2] = buffer.read_copy(seq)
+
+                if len(records) == 0:
+                    continue
+                new_records = True
+
+                for r in records.tolist():  # Tuples of Python numbers: seq, symbol, timestamp, ...
+                    try:
+                        if stream == "trades":
+                            callback(symbols[r[1]], r[3], r[4], r[2])
+                        elif stream == "quotes":
+                            callback(symbols[r[1]], r[3], r[4])
+                        else:
+                            callback(symbols[r[1]], *r[2:])
+                    except Exception as e:
+                        logger.error("Error while processing the %s feed: %s", stream, e)
+
+            if not new_records:
+                time.sleep(0.0005)
+
+    def stop(self):
+        self.running = False
+
+
+def _feed_main(platform: str, wss_url: str, symbols: typing.List[str], descriptors: typing.Dict,
+               commands: multiprocessing.Queue):
+
+    """
+    Feed process: websocket connection, decoding and publication of the market data.
+    """
+
+    buffers = {stream: RingBuffer(*descriptor) for stream, descriptor in descriptors.items()}
+    trades, quotes, candles = buffers["trades"], buffers["quotes"], buffers["candles"]
+
+    symbol_index = {symbol: i for i, symbol in enumerate(symbols)}
+
+    prices: typing.Dict[int, typing.List] = dict()  # Last bid / ask, Bitmex sends partial updates
+    last_candles: typing.Dict[int, typing.List] = dict()  # Forming 1m candle: timestamp, open, high, low, close, volume
+
+    subscriptions = {"aggTrade": set(), "bookTicker": set()}
+
+    def publish_trade(symbol: str, price: float, quantity: float, timestamp: int):
+        index = symbol_index.get(symbol)
+        if index is None:
+            return
+
+        trades.publish(index, timestamp, price, quantity)
+
+        candle_ts = timestamp - timestamp % CANDLE_MS
+        candle = last_candles.get(index)
+
+        if candle is not None and candle_ts > candle[0]:
+            candles.publish(index, *candle, 1)
+            candle = None
+
+        if candle is None:
+            candle = last_candles[index] = [candle_ts, price, price, price, price, 0.0]
+
+        candle[2] = max(candle[2], price)
+        candle[3] = min(candle[3], price)
+        candle[4] = price
+        candle[5] += quantity
+
+        candles.publish(index, *candle, 0)
+
+    def publish_quote(symbol: str, bid: typing.Optional[float], ask: typing.Optional[float]):
+        index = symbol_index.get(symbol)
+        if index is None:
+            return
+
+        last = prices.setdefault(index, [None, None])
+        if bid is not None:
+            last[0] = bid
+        if ask is not None:
+            last[1] = ask
+
+        if last[0] is not None and last[1] is not None:
+            quotes.publish(index, int(time.time() * 1000), last[0], last[1])
+
+    def on_message(ws, msg: str):
+        data = json.loads(msg)
+
+        if platform == "bitmex":
+            if data.get('table') == "instrument":
+                for d in data['data']:
+                    publish_quote(d['symbol'], d.get('bidPrice'), d.get('askPrice'))
+            elif data.get('table') == "trade":
+                for d in data['data']:
+                    ts = int(dateutil.parser.isoparse(d['timestamp']).timestamp() * 1000)
+                    publish_trade(d['symbol'], float(d['price']), float(d['size']), ts)
+
+        elif data.get('e') == "bookTicker":
+            publish_quote(data['s'], float(data['b']), float(data['a']))
+        elif data.get('e') == "aggTrade":
+            publish_trade(data['s'], float(data['p']), float(data['q']), data['T'])
+
+    def send_subscription(ws, symbols_to_add: typing.List[str], channel: str):
+        params = [s.lower() + "@" + channel for s in symbols_to_add]
+        if len(params) == 0:
+            return
+        try:
+            ws.send(json.dumps({"method": "SUBSCRIBE", "params": params, "id": int(time.time() * 1000)}))
+        except Exception as e:
+            logger.error("Feed handler: error while subscribing to %s %s: %s", len(params), channel, e)
+
+    def on_open(ws):
+        logger.info("%s feed handler connection opened", platform)
+
+        if platform == "bitmex":
+            for topic in ["instrument", "trade"]:
+                ws.send(json.dumps({"op": "subscribe", "args": [topic]}))
+        else:
+            for channel, channel_symbols in subscriptions.items():
+                send_subscription(ws, list(channel_symbols), channel)
+
+    ws = websocket.WebSocketApp(wss_url, on_open=on_open, on_message=on_message,
+                                on_error=lambda ws, msg: logger.error("%s feed handler error: %s", platform, msg))
+
+    def run_ws():
+        while True:
+            try:
+                ws.run_forever()
+            except Exception as e:
+                logger.error("%s feed handler error in run_forever() method: %s", platform, e)
+            time.sleep(2)
+
+    t = threading.Thread(target=run_ws, daemon=True)
+    t.start()
+
+    while True:
+        command = commands.get()
+
+        if command[0] == "exit":
+            ws.close()
+            for buffer in buffers.values():
+                buffer.close()
+            return
+
+        elif command[0] == "subscribe":
+            channel = command[2]
+            new_symbols = [s for s in command[1] if s not in subscriptions[channel]]
+            subscriptions[channel].update(new_symbols)
+
+            if ws.sock is not None and ws.sock.connected:
+                send_subscription(ws, new_symbols, channel)
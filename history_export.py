@@ -0,0 +1,300 @@
+import datetime
+import json
+import logging
+import os
+import shutil
+import time
+import typing
+
+import numpy as np
+
+from models import *
+from backtester import CandleData
+from market_store import MarketDataStore, market_store
+from tick_history import TickData, TickHistory, load_ticks, int_type
+
+logger = logging.getLogger()
+
+
+CANDLE_COLUMNS = ["timestamp", "open", "high", "low", "close", "volume"]
+DAY_MS = 24 * 3600 * 1000
+
+
+# Layout, shared with TickHistory: data_dir/platform/symbol/meta.json, the trades in one directory per day with its own
+# meta.json and the candles in one directory per year, candles_<timeframe>/YYYY. A directory has one .npy file per
+# column, prices and quantities as integer numbers of ticks / lots, so a file can be memory-mapped and is about half the
+# size of float64 columns. Opening a file costs more than reading a year of 1m candles from it, hence the yearly candle
+# partitions.
+
+def symbol_directory(data_dir: str, platform: str, symbol: str) -> str:
+    return os.path.join(data_dir, platform, symbol)
+
+
+def candle_directory(data_dir: str, platform: str, symbol: str, timeframe: str) -> str:
+    return os.path.join(symbol_directory(data_dir, platform, symbol), "candles_" + timeframe)
+
+
+def _to_ms(day: datetime.date) -> int:
+    return int(datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def _years(start: int, end: int) -> typing.List[str]:
+    first, last = np.array([start, end - 1], dtype="datetime64[ms]").astype("datetime64[Y]")
+    return [str(y) for y in np.arange(first, last + 1)]
+
+
+def _save_meta(directory: str, contract: Contract):
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump({'price_scale': contract.price_scale, 'tick_units': contract.tick_units,
+                   'quantity_scale': contract.quantity_scale, 'lot_units': contract.lot_units}, f)
+
+
+def _read_meta(directory: str) -> typing.Dict:
+    with open(os.path.join(directory, "meta.json")) as f:
+        return json.load(f)
+
+
+def _save_columns(directory: str, columns: typing.Dict[str, np.ndarray]):
+    os.makedirs(directory, exist_ok=True)
+
+    # The timestamp file is written last, it marks the partition as complete
+    for name in sorted(columns, key=lambda n: n == "timestamp"):
+        np.save(os.path.join(directory, name + ".npy"), columns[name])
+
+
+# Export
+
+def save_candles(data_dir: str, platform: str, contract: Contract, timeframe: str, candles: CandleData) -> int:
+
+    """
+    Write candles to their yearly partitions, merged with the candles already exported: a candle of the same
+    timestamp is replaced.
+    :return: Number of candles written
+    """
+
+    if len(candles) == 0:
+        return 0
+
+    _save_meta(symbol_directory(data_dir, platform, contract.symbol), contract)
+    directory = candle_directory(data_dir, platform, contract.symbol, timeframe)
+
+    price_factor = contract.price_scale / contract.tick_units
+    volume_factor = contract.quantity_scale / contract.lot_units
+
+    new = {"timestamp": candles.timestamp}
+    for name in ["open", "high", "low", "close"]:
+        new[name] = np.rint(getattr(candles, name) * price_factor)
+    new["volume"] = np.rint(candles.volume * volume_factor)
+
+    years = candles.timestamp.astype("datetime64[ms]").astype("datetime64[Y]")
+    starts = np.r_[0, np.flatnonzero(years[1:] != years[:-1]) + 1, len(years)]
+
+    for i, j in zip(starts[:-1], starts[1:]):
+        partition = os.path.join(directory, str(years[i]))
+        columns = {name: values[i:j] for name, values in new.items()}
+
+        if os.path.exists(os.path.join(partition, "timestamp.npy")):
+            old = {name: np.load(os.path.join(partition, name + ".npy")) for name in CANDLE_COLUMNS}
+            keep = ~np.isin(old["timestamp"], columns["timestamp"])
+            columns = {name: np.concatenate([old[name][keep], columns[name]]) for name in CANDLE_COLUMNS}
+
+        order = np.argsort(columns["timestamp"], kind="stable")
+        columns = {name: values[order] for name, values in columns.items()}
+        for name in CANDLE_COLUMNS[1:]:
+            columns[name] = columns[name].astype(int_type(columns[name]))
+
+        _save_columns(partition, columns)
+
+    return len(candles)
+
+
+def export_candles(client, contract: Contract, timeframe: str, start: datetime.date, end: datetime.date,
+                   data_dir: str = "history_data", source: str = "exchange", cache_dir: str = "tick_data",
+                   store: MarketDataStore = market_store) -> int:
+
+    """
+    Export the candles of a contract from start to end (included).
+    :param client: BinanceFuturesClient or BitmexClient
+    :param contract:
+    :param timeframe:
+    :param start:
+    :param end:
+    :param data_dir:
+    :param source: exchange (historical candles requests), cache (rebuilt from the trades downloaded by
+    TickHistory to cache_dir), store (the candles recorded by the MarketDataStore)
+    :param cache_dir:
+    :param store:
+    :return: Number of candles exported
+    """
+
+    start_ms, end_ms = _to_ms(start), _to_ms(end + datetime.timedelta(days=1))
+    tf_ms = TF_EQUIV[timeframe] * 1000
+
+    if source == "exchange":
+        candles = []
+        now = int(time.time() * 1000) + client.server_time_offset
+        next_time = start_ms
+
+        while next_time < end_ms:
+            page = client.get_historical_candles(contract, timeframe, next_time)
+            page = [c for c in page if next_time <= c.timestamp < end_ms and c.timestamp + tf_ms <= now]
+            if len(page) == 0:
+                break
+            candles.extend(page)
+            next_time = page[-1].timestamp + tf_ms
+
+        data = CandleData.from_candles(candles)
+
+    elif source == "cache":
+        directory = symbol_directory(cache_dir, client.platform, contract.symbol)
+        days = []
+
+        day = start
+        while day <= end:  # Day by day, a month of trades doesn't always fit in memory
+            if os.path.exists(os.path.join(directory, day.isoformat(), "timestamp.npy")):
+                days.append(load_ticks(directory, day, day).candles(timeframe))
+            day += datetime.timedelta(days=1)
+
+        data = CandleData(*[np.concatenate([getattr(d, name) for d in days] or [np.empty(0)])
+                            for name in CANDLE_COLUMNS])
+
+    elif source == "store":
+        data = store.candles(client.platform, contract.symbol, timeframe, start_ms, end_ms)
+
+    else:
+        raise ValueError(f"Unknown source {source}")
+
+    n = save_candles(data_dir, client.platform, contract, timeframe, data)
+
+    logger.info("%s %s: %s %s candles exported from the %s to %s", client.platform, contract.symbol, n, timeframe,
+                source, data_dir)
+
+    return n
+
+
+def export_trades(client, contract: Contract, start: datetime.date, end: datetime.date,
+                  data_dir: str = "history_data", source: str = "exchange", cache_dir: str = "tick_data",
+                  store: MarketDataStore = market_store) -> int:
+
+    """
+    Export the trades of a contract from start to end (included), in the format of TickHistory.
+    :param source: exchange (downloaded by TickHistory), cache (the days already downloaded to cache_dir), store (the
+    trades recorded by the MarketDataStore)
+    :return: Number of days exported
+    """
+
+    directory = symbol_directory(data_dir, client.platform, contract.symbol)
+
+    if source == "exchange":
+        TickHistory(client, contract, data_dir).download(start, end)
+
+    elif source not in ["cache", "store"]:
+        raise ValueError(f"Unknown source {source}")
+
+    _save_meta(directory, contract)
+
+    days = 0
+
+    day = start
+    while day <= end:
+        day_directory = os.path.join(directory, day.isoformat())
+
+        if source == "cache":
+            cache_day = os.path.join(symbol_directory(cache_dir, client.platform, contract.symbol), day.isoformat())
+            if os.path.exists(os.path.join(cache_day, "timestamp.npy")):
+                shutil.copytree(cache_day, day_directory, dirs_exist_ok=True)
+
+        elif source == "store":
+            ticks = store.trades(client.platform, contract.symbol, _to_ms(day), _to_ms(day) + DAY_MS)
+            if len(ticks) > 0:
+                price_ticks = np.rint(ticks.price * contract.price_scale / contract.tick_units)
+                quantity_lots = np.rint(ticks.quantity * contract.quantity_scale / contract.lot_units)
+                _save_meta(day_directory, contract)
+                _save_columns(day_directory, {"timestamp": ticks.timestamp,
+                                              "price": price_ticks.astype(int_type(price_ticks)),
+                                              "quantity": quantity_lots.astype(int_type(quantity_lots)),
+                                              "buyer_maker": ticks.buyer_maker})
+
+        if os.path.exists(os.path.join(day_directory, "timestamp.npy")):
+            days += 1
+
+        day += datetime.timedelta(days=1)
+
+    logger.info("%s %s: %s days of trades exported from the %s to %s", client.platform, contract.symbol, days, source,
+                data_dir)
+
+    return days
+
+
+# Import
+
+def load_candles(data_dir: str, platform: str, symbol: str, timeframe: str, start: int, end: int) -> CandleData:
+
+    """
+    Read exported candles whose open time is from start (included) to end (excluded).
+    Only the yearly partitions of the range are opened, memory-mapped, and only the candles of the range are read
+    from them: the range is found by a binary search on the sorted timestamps.
+    :param start: Unix timestamp in milliseconds
+    :param end: Unix timestamp in milliseconds
+    :return: Ready for the Backtester and the Optimizer
+    """
+
+    meta = _read_meta(symbol_directory(data_dir, platform, symbol))
+    directory = candle_directory(data_dir, platform, symbol, timeframe)
+
+    partitions = []
+
+    for year in _years(start, end):
+        partition = os.path.join(directory, year)
+        if not os.path.exists(os.path.join(partition, "timestamp.npy")):
+            continue
+
+        timestamp = np.load(os.path.join(partition, "timestamp.npy"), mmap_mode="r")
+        i, j = np.searchsorted(timestamp, [start, end])
+        if j > i:
+            partitions.append((partition, timestamp, i, j))
+
+    n = sum(j - i for _, _, i, j in partitions)
+    columns = {name: np.empty(n, dtype=np.int64 if name == "timestamp" else np.float64) for name in CANDLE_COLUMNS}
+
+    position = 0
+
+    for partition, timestamp, i, j in partitions:
+        rows = slice(position, position + j - i)
+        columns["timestamp"][rows] = timestamp[i:j]
+
+        for name in CANDLE_COLUMNS[1:]:
+            units, scale = (meta['lot_units'], meta['quantity_scale']) if name == "volume" else \
+                (meta['tick_units'], meta['price_scale'])
+            values = columns[name][rows]
+            stored = np.load(os.path.join(partition, name + ".npy"), mmap_mode="r")[i:j]
+            if units == 1:  # A tick of one unit of the last decimal, the usual case: one pass
+                np.divide(stored, scale, out=values)
+            else:
+                np.multiply(stored, units, out=values)
+                np.divide(values, scale, out=values)
+
+        position += j - i
+
+    return CandleData(*[columns[name] for name in CANDLE_COLUMNS])
+
+
+def load_trades(data_dir: str, platform: str, symbol: str, start: int, end: int) -> TickData:
+
+    """
+    Read exported trades from start (included) to end (excluded), only the days of the range are opened.
+    :param start: Unix timestamp in milliseconds
+    :param end: Unix timestamp in milliseconds
+    :return:
+    """
+
+    first_day = datetime.datetime.fromtimestamp(start / 1000, datetime.timezone.utc).date()
+    last_day = datetime.datetime.fromtimestamp((end - 1) / 1000, datetime.timezone.utc).date()
+
+    ticks = load_ticks(symbol_directory(data_dir, platform, symbol), first_day, last_day)
+    i, j = np.searchsorted(ticks.timestamp, [start, end])
+
+    return TickData(ticks.timestamp[i:j], ticks.price_ticks[i:j], ticks.quantity_lots[i:j], ticks.buyer_maker[i:j],
+                    ticks.meta)
@@ -0,0 +1,299 @@
+import math
+import threading
+import typing
+
+
+class Ema:
+    def __init__(self, alpha: float, min_periods: int = 0):
+
+        """
+        Exponential moving average updated in O(1) per value.
+        Same result as pandas .ewm(alpha=alpha, min_periods=min_periods).mean() (adjust=True): the weighted sum and
+        the sum of the weights are both kept, instead of recomputing them over the whole history.
+        :param alpha: Smoothing factor, 2 / (span + 1) for a span, 1 / (com + 1) for a center of mass
+        :param min_periods: Number of values needed before the average is defined (NaN before)
+        """
+
+        self._decay = 1 - alpha
+        self._min_periods = min_periods
+
+        self._weighted_sum = 0.0
+        self._weights = 0.0
+        self.count = 0
+
+        self.value = math.nan
+
+    @classmethod
+    def from_span(cls, span: int, min_periods: int = 0) -> "Ema":
+        return cls(2 / (span + 1), min_periods)
+
+    def _compute(self, weighted_sum: float, weights: float, count: int) -> float:
+        if count < max(self._min_periods, 1):
+            return math.nan
+        return weighted_sum / weights
+
+    def update(self, value: float) -> float:
+
+        """
+        Add a closed value to the average.
+        :param value:
+        :return: The new average
+        """
+
+        self._weighted_sum = value + self._decay * self._weighted_sum
+        self._weights = 1 + self._decay * self._weights
+        self.count += 1
+
+        self.value = self._compute(self._weighted_sum, self._weights, self.count)
+
+        return self.value
+
+    def peek(self, value: float) -> float:
+
+        """
+        Provisional average if the value was added, the state is not modified (used for the forming candle).
+        :param value:
+        :return:
+        """
+
+        return self._compute(value + self._decay * self._weighted_sum, 1 + self._decay * self._weights, self.count + 1)
+
+
+class Macd:
+    def __init__(self, ema_fast: int, ema_slow: int, ema_signal: int):
+        self._fast = Ema.from_span(ema_fast)
+        self._slow = Ema.from_span(ema_slow)
+        self._signal = Ema.from_span(ema_signal)
+
+        self.macd_line = math.nan
+        self.macd_signal = math.nan
+
+    def update(self, close: float) -> typing.Tuple[float, float]:
+        self.macd_line = self._fast.update(close) - self._slow.update(close)
+        self.macd_signal = self._signal.update(self.macd_line)
+
+        return self.macd_line, self.macd_signal
+
+    def peek(self, close: float) -> typing.Tuple[float, float]:
+        macd_line = self._fast.peek(close) - self._slow.peek(close)
+        return macd_line, self._signal.peek(macd_line)
+
+
+class Rsi:
+    def __init__(self, length: int):
+
+        """
+        Wilder RSI: averages of the gains and losses with com = length - 1, rounded to 2 decimals.
+        The first close only initializes the previous close, like the .diff().dropna() of the pandas version.
+        :param length:
+        """
+
+        self._avg_gain = Ema(1 / length, min_periods=length)
+        self._avg_loss = Ema(1 / length, min_periods=length)
+
+        self._last_close = None
+
+        self.value = math.nan
+
+    @staticmethod
+    def _compute(avg_gain: float, avg_loss: float) -> float:
+        if math.isnan(avg_gain) or math.isnan(avg_loss) or (avg_gain == 0 and avg_loss == 0):
+            return math.nan
+        if avg_loss == 0:
+            return 100.0
+
+        return round(100 - 100 / (1 + avg_gain / avg_loss), 2)
+
+    def update(self, close: float) -> float:
+        if self._last_close is not None:
+            delta = close - self._last_close
+            self.value = self._compute(self._avg_gain.update(max(delta, 0.0)), self._avg_loss.update(max(-delta, 0.0)))
+
+        self._last_close = close
+
+        return self.value
+
+    def peek(self, close: float) -> float:
+        if self._last_close is None:
+            return self.value
+
+        delta = close - self._last_close
+        return self._compute(self._avg_gain.peek(max(delta, 0.0)), self._avg_loss.peek(max(-delta, 0.0)))
+
+
+class SharedIndicator:
+    def __init__(self, key: typing.Tuple):
+
+        """
+        Indicator series shared by all the strategies running on the same exchange, symbol and timeframe.
+        Each value is computed once, by the first strategy that sees the candle close, the other strategies only read it.
+        :param key: (exchange, symbol, timeframe, indicator, params)
+        """
+
+        self.key = key
+
+        self.timestamps: typing.List[int] = []
+        self.values: typing.List[float] = []
+
+        self.ref_count = 0
+        self.dependencies: typing.List["SharedIndicator"] = []
+
+    def _compute(self, timestamp: int, close: float) -> float:
+        raise NotImplementedError()
+
+    def update(self, timestamp: int, close: float):
+
+        """
+        Add the value for a closed candle. Candles already added (by another strategy) are ignored.
+        :param timestamp: Open time of the closed candle
+        :param close:
+        :return:
+        """
+
+        if len(self.timestamps) > 0 and timestamp <= self.timestamps[-1]:
+            return
+
+        value = self._compute(timestamp, close)
+
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+
+    def value_at(self, timestamp: int) -> float:
+
+        """
+        Value of the series for the candle opened at timestamp, NaN if that candle was not added.
+        Strategies usually ask for the last candle, so the search starts from the end.
+        :param timestamp:
+        :return:
+        """
+
+        for i in range(len(self.timestamps) - 1, -1, -1):
+            if self.timestamps[i] == timestamp:
+                return self.values[i]
+            if self.timestamps[i] < timestamp:
+                break
+
+        return math.nan
+
+
+class EmaSeries(SharedIndicator):
+    def __init__(self, key: typing.Tuple, span: int):
+        super().__init__(key)
+        self._ema = Ema.from_span(span)
+
+    def _compute(self, timestamp: int, close: float) -> float:
+        return self._ema.update(close)
+
+
+class RsiSeries(SharedIndicator):
+    def __init__(self, key: typing.Tuple, length: int):
+        super().__init__(key)
+        self._rsi = Rsi(length)
+
+    def _compute(self, timestamp: int, close: float) -> float:
+        return self._rsi.update(close)
+
+
+class MacdSignalSeries(SharedIndicator):
+    def __init__(self, key: typing.Tuple, ema_fast: EmaSeries, ema_slow: EmaSeries, ema_signal: int):
+        super().__init__(key)
+        self.dependencies = [ema_fast, ema_slow]
+        self._ema = Ema.from_span(ema_signal)
+
+    def _compute(self, timestamp: int, close: float) -> float:
+        ema_fast, ema_slow = self.dependencies
+
+        ema_fast.update(timestamp, close)
+        ema_slow.update(timestamp, close)
+
+        return self._ema.update(ema_fast.value_at(timestamp) - ema_slow.value_at(timestamp))
+
+
+class IndicatorRegistry:
+    def __init__(self):
+        self._indicators: typing.Dict[typing.Tuple, SharedIndicator] = dict()
+        self._lock = threading.Lock()
+
+    def acquire(self, exchange: str, symbol: str, timeframe: str, indicator: str,
+                params: typing.Tuple) -> SharedIndicator:
+
+        """
+        Get the shared series for these parameters, created if no strategy uses it yet.
+        Every acquire() must be matched by a release() when the strategy stops.
+        :param exchange:
+        :param symbol:
+        :param timeframe:
+        :param indicator: ema (span,), rsi (length,) or macd_signal (ema_fast, ema_slow, ema_signal)
+        :param params:
+        :return:
+        """
+
+        with self._lock:
+            return self._acquire((exchange, symbol, timeframe, indicator, tuple(params)))
+
+    def _acquire(self, key: typing.Tuple) -> SharedIndicator:
+        exchange, symbol, timeframe, indicator, params = key
+
+        if key not in self._indicators:
+            if indicator == "ema":
+                self._indicators[key] = EmaSeries(key, params[0])
+            elif indicator == "rsi":
+                self._indicators[key] = RsiSeries(key, params[0])
+            elif indicator == "macd_signal":
+                ema_fast = self._acquire((exchange, symbol, timeframe, "ema", (params[0],)))
+                ema_slow = self._acquire((exchange, symbol, timeframe, "ema", (params[1],)))
+                self._indicators[key] = MacdSignalSeries(key, ema_fast, ema_slow, params[2])
+            else:
+                raise ValueError(f"Unknown indicator {indicator}")
+
+        series = self._indicators[key]
+        series.ref_count += 1
+
+        return series
+
+    def release(self, series: SharedIndicator):
+
+        """
+        Decrement the reference count of the series, it is dropped when the last strategy using it stops.
+        :param series:
+        :return:
+        """
+
+        with self._lock:
+            self._release(series)
+
+    def _release(self, series: SharedIndicator):
+        series.ref_count -= 1
+
+        if series.ref_count <= 0:
+            self._indicators.pop(series.key, None)
+            for dependency in series.dependencies:
+                self._release(dependency)
+
+    def series(self) -> typing.List[SharedIndicator]:
+        with self._lock:
+            return list(self._indicators.values())
+
+    def restore(self, series: typing.List[SharedIndicator]):
+
+        """
+        Add the series of a snapshot, the strategies acquiring them continue from their last value instead of
+        computing them from the first candle. Nothing is added if a series of the same symbol and timeframe exists,
+        a MACD signal and its EMAs must stay together.
+        :param series: All the series of one exchange, symbol and timeframe
+        :return:
+        """
+
+        with self._lock:
+            if any(s.key in self._indicators for s in series):
+                return
+
+            for s in series:
+                s.ref_count = 0
+                self._indicators[s.key] = s
+
+    def __len__(self) -> int:
+        return len(self._indicators)
+
+
+indicator_registry = IndicatorRegistry()
@@ -2,9 +2,18 @@ import tkinter as tk
 from tkinter.messagebox import askquestion
 import logging
 import json
+import queue
+import threading
+import typing
 
 from connectors.bitmex import BitmexClient
 from connectors.binance_futures import BinanceFuturesClient
+from events import dispatcher, LogEvent, OrderUpdateEvent, QuoteEvent
+from killswitch import KillSwitch
+from snapshot import snapshot_store
+from market_store import market_store
+from database import WorkspaceData
+from models import Trade
 
 from interface.styling import *
 from interface.logging_component import Logging
@@ -15,13 +24,16 @@ from interface.strategy_component import StrategyEditor
 
 logger = logging.getLogger()  # This will be the same logger object as the one configured in main.py
 
+AUTOSAVE_INTERVAL = 5000  # Milliseconds
+
 
 class Root(tk.Tk):
-    def __init__(self, binance: BinanceFuturesClient, bitmex: BitmexClient):
+    def __init__(self, binance: BinanceFuturesClient, bitmex: BitmexClient, workspace_data: WorkspaceData):
         super().__init__()
 
         self.binance = binance
         self.bitmex = bitmex
+        self.workspace_data = workspace_data
 
         self.title("Trading Bot")
         self.protocol("WM_DELETE_WINDOW", self._ask_before_close)
@@ -41,6 +53,8 @@ class Root(tk.Tk):
         self.main_menu.add_cascade(label="Workspace", menu=self.workspace_menu)
         self.workspace_menu.add_command(label="Save workspace", command=self._save_workspace)
 
+        self.main_menu.add_command(label="KILL SWITCH", foreground="red", command=self._ask_kill_switch)
+
         self.main_frame = tk.Frame(self, bg=BG_COLOR)
         self.main_frame.pack(side=tk.LEFT)
 
@@ -48,16 +62,38 @@ class Root(tk.Tk):
 
         self.logging_frame = Logging(self.main_frame, bg=BG_COLOR)
 
-        self._watchlist_frame = Watchlist(self.binance.contracts, self.bitmex.contracts, self.main_frame, bg=BG_COLOR)
+        self._watchlist_frame = Watchlist(self.binance.contracts, self.bitmex.contracts, workspace_data,
+                                          self.main_frame, bg=BG_COLOR)
         self._watchlist_frame.pack(side=tk.LEFT)
 
-        self._strategy_frame = StrategyEditor(self, self.binance, self.bitmex, self.main_frame, bg=BG_COLOR)
+        self._strategy_frame = StrategyEditor(self, self.binance, self.bitmex, workspace_data, self.main_frame,
+                                             bg=BG_COLOR)
         self._strategy_frame.pack(side=tk.LEFT, anchor=tk.N)
 
         self._trades_frame = TradesWatch(self.main_frame, bg=BG_COLOR)
         self._trades_frame.pack(side=tk.LEFT)
 
+        self.kill_switch = KillSwitch([self.binance, self.bitmex], list(self._strategy_frame.paper_clients.values()))
+
+        # The dispatcher thread can't update Tkinter, its events are queued and processed by the loop of _update_ui()
+
+        self._events: queue.SimpleQueue = queue.SimpleQueue()
+        self._open_trades: typing.Dict[int, Trade] = dict()  # Their PNL changes with the quotes
+
+        for event_type in [LogEvent, OrderUpdateEvent]:
+            dispatcher.subscribe(event_type, self._events.put)
+
+        # The quotes of every symbol of both exchanges would flood the queue, only the watchlist symbols quoted since
+        # the last interface update are kept
+        self._watched: typing.FrozenSet[typing.Tuple[str, str]] = frozenset()
+        self._quoted: typing.Set[typing.Tuple[str, str]] = set()
+        self._quoted_lock = threading.Lock()
+
+        dispatcher.subscribe(QuoteEvent, self._on_quote)
+
         self._update_ui()  # Starts the infinite interface update loop
+        self._update_watchlist()
+        self.after(AUTOSAVE_INTERVAL, self._autosave)
 
     def _ask_before_close(self):
 
@@ -69,120 +105,190 @@ class Root(tk.Tk):
 
         result = askquestion("Confirmation", "Do you really want to exit the application?")
         if result == "yes":
-            self.binance.reconnect = False  # Avoids the infinite reconnect loop in _start_ws()
-            self.bitmex.reconnect = False
-            self.binance.ws.close()
-            self.bitmex.ws.close()
+            self._save_workspace(popup=False)
+            self.workspace_data.flush()
+
+            snapshot_store.flush()  # The next start continues from the current candles and indicators
+            market_store.flush()
+
+            for client in [self.binance, self.bitmex]:
+                if client.orders.journal is not None:
+                    client.orders.journal.flush()  # Writes the last orders and trades
+
+                if client.worker_pool is not None:
+                    client.worker_pool.stop()  # Exits the worker processes and frees their shared memory
+
+                client.reconnect = False  # Avoids the infinite reconnect loop in _start_ws()
+                if client.feed is not None:
+                    client.feed.stop()
+                else:
+                    client.ws.close()
 
             self.destroy()  # Destroys the UI and terminates the program as no other thread is running
 
+    def _ask_kill_switch(self):
+        result = askquestion("Kill switch", "Cancel all the orders, close all the positions and stop all the "
+                                            "strategies on every exchange?")
+        if result == "yes":
+            self.trigger_kill_switch("interface")
+
+    def trigger_kill_switch(self, reason: str):
+
+        """
+        Runs the kill switch in another thread so the interface stays responsive, the result is logged.
+        Must be called from the Tkinter thread (menu command, signal handler).
+        :param reason:
+        :return:
+        """
+
+        t = threading.Thread(target=self.kill_switch.trigger, args=(reason,), daemon=True)
+        t.start()
+
+        self._strategy_frame.deactivate_all()
+
+    def _on_quote(self, event: QuoteEvent):
+
+        """
+        Called on the dispatcher thread, must not update Tkinter.
+        """
+
+        key = (event.source, event.symbol)
+        if key in self._watched:
+            with self._quoted_lock:
+                self._quoted.add(key)
+
     def _update_ui(self):
 
         """
-        Called by itself every 1500 seconds. It is similar to an infinite loop but runs within the same Thread
+        Called by itself every 200 milliseconds. It is similar to an infinite loop but runs within the same Thread
         as .mainloop() thanks to the .after() method, thus it is "thread-safe" to update elements of the interface
-        in this method. Do not update Tkinter elements from another Thread like the websocket thread.
+        in this method. Do not update Tkinter elements from another Thread like the dispatcher thread.
+        Processes the log and trade events and the quotes received since the last call.
         :return:
         """
 
-        # Logs
+        with self._quoted_lock:
+            quotes, self._quoted = self._quoted, set()
 
-        for log in self.bitmex.logs:
-            if not log['displayed']:
-                self.logging_frame.add_log(log['log'])
-                log['displayed'] = True
+        while True:
+            try:
+                event = self._events.get_nowait()
+            except queue.Empty:
+                break
 
-        for log in self.binance.logs:
-            if not log['displayed']:
-                self.logging_frame.add_log(log['log'])
-                log['displayed'] = True
+            if isinstance(event, LogEvent):
+                self.logging_frame.add_log(event.message)
 
-        # Trades and Logs
+            elif isinstance(event, OrderUpdateEvent):
+                trade = event.trade
+                if trade.id not in self._trades_frame.body_widgets['symbol']:
+                    self._trades_frame.add_trade(trade)
+                self._open_trades[trade.id] = trade
 
-        for client in [self.binance, self.bitmex]:
+        # Update the Trades component (change status/PNL), the closed trades are updated one last time
 
-            try:  # try...except statement to handle the case when a dictionary is updated during the following loops
+        for trade in list(self._open_trades.values()):
+            self._update_trade(trade)
+            if trade.status != "open":
+                del self._open_trades[trade.id]
 
-                for b_index, strat in client.strategies.items():
-                    for log in strat.logs:
-                        if not log['displayed']:
-                            self.logging_frame.add_log(log['log'])
-                            log['displayed'] = True
+        # Watchlist prices
 
-                    # Update the Trades component (add a new trade, change status/PNL)
+        watched = set()
 
-                    for trade in strat.trades:
-                        if trade.time not in self._trades_frame.body_widgets['symbol']:
-                            self._trades_frame.add_trade(trade)
+        for key in self._watchlist_frame.body_widgets['symbol']:
+            client = self._watchlist_client(key)
+            symbol = self._watchlist_frame.body_widgets['symbol'][key].cget("text")
 
-                        if "binance" in trade.contract.exchange:
-                            precision = trade.contract.price_decimals
-                        else:
-                            precision = 8  # The Bitmex PNL is always is BTC, thus 8 decimals
+            if client is None:
+                continue
 
-                        pnl_str = "{0:.{prec}f}".format(trade.pnl, prec=precision)
-                        self._trades_frame.body_widgets['pnl_var'][trade.time].set(pnl_str)
-                        self._trades_frame.body_widgets['status_var'][trade.time].set(trade.status.capitalize())
-                        self._trades_frame.body_widgets['quantity_var'][trade.time].set(trade.quantity)
+            watched.add((client.platform, symbol))
 
-            except RuntimeError as e:
-                logger.error("Error while looping through strategies dictionary: %s", e)
+            if (client.platform, symbol) in quotes:
+                self._update_watchlist_prices(key, client, symbol)
 
-        # Watchlist prices
+        self._watched = frozenset(watched)
 
-        try:
-            for key, value in self._watchlist_frame.body_widgets['symbol'].items():
+        self.after(200, self._update_ui)
 
-                symbol = self._watchlist_frame.body_widgets['symbol'][key].cget("text")
-                exchange = self._watchlist_frame.body_widgets['exchange'][key].cget("text")
+    def _update_watchlist(self):
 
-                if exchange == "Binance":
-                    if symbol not in self.binance.contracts:
-                        continue
+        """
+        Called by itself every 1500 milliseconds: subscribes to the prices of the symbols added to the Watchlist.
+        :return:
+        """
 
-                    if symbol not in self.binance.ws_subscriptions["bookTicker"] and self.binance.ws_connected:
-                        self.binance.subscribe_channel([self.binance.contracts[symbol]], "bookTicker")
+        for key in self._watchlist_frame.body_widgets['symbol']:
+            client = self._watchlist_client(key)
+            symbol = self._watchlist_frame.body_widgets['symbol'][key].cget("text")
 
-                    if symbol not in self.binance.prices:
-                        self.binance.get_bid_ask(self.binance.contracts[symbol])
-                        continue
+            if client is not self.binance or symbol not in self.binance.contracts:
+                continue
 
-                    precision = self.binance.contracts[symbol].price_decimals
+            if symbol not in self.binance.ws_subscriptions["bookTicker"] and self.binance.ws_connected:
+                self.binance.subscribe_channel([self.binance.contracts[symbol]], "bookTicker")
 
-                    prices = self.binance.prices[symbol]
+            if symbol not in self.binance.prices:
+                self.binance.get_bid_ask(self.binance.contracts[symbol])
+                self._update_watchlist_prices(key, self.binance, symbol)
 
-                elif exchange == "Bitmex":
-                    if symbol not in self.bitmex.contracts:
-                        continue
+        self.after(1500, self._update_watchlist)
 
-                    if symbol not in self.bitmex.prices:
-                        continue
+    def _watchlist_client(self, key: int) -> typing.Union[BinanceFuturesClient, BitmexClient, None]:
+        exchange = self._watchlist_frame.body_widgets['exchange'][key].cget("text")
 
-                    precision = self.bitmex.contracts[symbol].price_decimals
+        if exchange == "Binance":
+            return self.binance
+        elif exchange == "Bitmex":
+            return self.bitmex
+        return None
 
-                    prices = self.bitmex.prices[symbol]
+    def _update_watchlist_prices(self, key: int, client: typing.Union[BinanceFuturesClient, BitmexClient],
+                                 symbol: str):
+        if symbol not in client.contracts or symbol not in client.prices:
+            return
 
-                else:
-                    continue
+        contract = client.contracts[symbol]
+        prices = client.prices[symbol]
+
+        if prices['bid'] is not None:
+            self._watchlist_frame.body_widgets['bid_var'][key].set(contract.format_price(prices['bid']))
+        if prices['ask'] is not None:
+            self._watchlist_frame.body_widgets['ask_var'][key].set(contract.format_price(prices['ask']))
+
+    def _update_trade(self, trade: Trade):
+        if "binance" in trade.contract.exchange:
+            pnl_str = trade.contract.format_price(trade.pnl)
+        else:
+            pnl_str = "{0:.8f}".format(trade.pnl)  # The Bitmex PNL is always is BTC, thus 8 decimals
+
+        self._trades_frame.body_widgets['pnl_var'][trade.id].set(pnl_str)
+        self._trades_frame.body_widgets['status_var'][trade.id].set(trade.status.capitalize())
+        self._trades_frame.body_widgets['quantity_var'][trade.id].set(trade.quantity)
 
-                if prices['bid'] is not None:
-                    price_str = "{0:.{prec}f}".format(prices['bid'], prec=precision)
-                    self._watchlist_frame.body_widgets['bid_var'][key].set(price_str)
-                if prices['ask'] is not None:
-                    price_str = "{0:.{prec}f}".format(prices['ask'], prec=precision)
-                    self._watchlist_frame.body_widgets['ask_var'][key].set(price_str)
+    def _autosave(self):
 
-        except RuntimeError as e:
-            logger.error("Error while looping through watchlist dictionary: %s", e)
+        """
+        Called by itself every AUTOSAVE_INTERVAL. Saving only queues the rows, they are compared with the saved ones
+        and written in the background, so it doesn't slow down the interface.
+        :return:
+        """
+
+        try:
+            self._save_workspace(popup=False)
+        except Exception as e:
+            logger.error("Error while saving the workspace: %s", e)
 
-        self.after(1500, self._update_ui)
+        self.after(AUTOSAVE_INTERVAL, self._autosave)
 
-    def _save_workspace(self):
+    def _save_workspace(self, popup: bool = True):
 
         """
         Collect the current data on the interface and saves it to the SQLite database to avoid setting up everything
         again everytime you open the program.
-        Triggered from a Menu command.
+        Triggered from a Menu command, and periodically by _autosave().
+        :param popup: Confirm the save to the user
         :return:
         """
 
@@ -207,6 +313,7 @@ class Root(tk.Tk):
             strategy_type = strat_widgets['strategy_type_var'][b_index].get()
             contract = strat_widgets['contract_var'][b_index].get()
             timeframe = strat_widgets['timeframe_var'][b_index].get()
+            mode = strat_widgets['mode_var'][b_index].get()
             balance_pct = strat_widgets['balance_pct'][b_index].get()
             take_profit = strat_widgets['take_profit'][b_index].get()
             stop_loss = strat_widgets['stop_loss'][b_index].get()
@@ -221,8 +328,9 @@ class Root(tk.Tk):
                 extra_params[code_name] = self._strategy_frame.additional_parameters[b_index][code_name]
 
             strategies.append((strategy_type, contract, timeframe, balance_pct, take_profit, stop_loss,
-                               json.dumps(extra_params),))
+                               json.dumps(extra_params), mode, self._strategy_frame.row_ids[b_index],))
 
         self._strategy_frame.db.save("strategies", strategies)
 
-        self.logging_frame.show_popup("Workspace has been saved successfully! \n You may now exit the application.")
\ No newline at end of file
+        if popup:
+            self.logging_frame.show_popup("Workspace has been saved successfully! \n You may now exit the application.")
\ No newline at end of file
@@ -1,5 +1,6 @@
 import tkinter as tk
 import typing
+import uuid
 
 import json
 
@@ -8,8 +9,10 @@ from interface.scrollable_frame import ScrollableFrame
 
 from connectors.binance_futures import BinanceFuturesClient
 from connectors.bitmex import BitmexClient
+from connectors.paper import PaperClient
 
 from strategies import TechnicalStrategy, BreakoutStrategy
+from snapshot import snapshot_store
 from utils import *
 
 from database import WorkspaceData
@@ -21,18 +24,23 @@ if typing.TYPE_CHECKING:
 
 
 class StrategyEditor(tk.Frame):
-    def __init__(self, root: "Root", binance: BinanceFuturesClient, bitmex: BitmexClient, *args, **kwargs):
+    def __init__(self, root: "Root", binance: BinanceFuturesClient, bitmex: BitmexClient, db: WorkspaceData, *args,
+                 **kwargs):
         super().__init__(*args, **kwargs)
 
         self.root = root
 
-        self.db = WorkspaceData()
+        self.db = db
 
         self._valid_integer = self.register(check_integer_format)
         self._valid_float = self.register(check_float_format)
 
         self._exchanges = {"Binance": binance, "Bitmex": bitmex}
 
+        # Strategies in Paper mode send their orders to a simulated client that fills them on the live prices
+        self.paper_clients = {"Binance": PaperClient(binance, initial_balance=1000),
+                               "Bitmex": PaperClient(bitmex, initial_balance=1)}
+
         self._all_contracts = []
         self._all_timeframes = ["1m", "5m", "15m", "30m", "1h", "4h"]
 
@@ -67,6 +75,9 @@ class StrategyEditor(tk.Frame):
         self.additional_parameters = dict()
         self._extra_input = dict()
 
+        # Saved with the rows, identifies the trades of their strategy in the journal from one run to the next
+        self.row_ids: typing.Dict[int, str] = dict()
+
         common_ancestor = self
         while common_ancestor.master:
             common_ancestor = common_ancestor.master
@@ -83,6 +94,8 @@ class StrategyEditor(tk.Frame):
              "width": 13, "header": "Contract"},
             {"code_name": "timeframe", "widget": tk.OptionMenu, "data_type": str, "values": self._all_timeframes,
              "width": 13, "header": "Timeframe"},
+            {"code_name": "mode", "widget": tk.OptionMenu, "data_type": str, "values": ["Live", "Paper"],
+             "width": 13, "header": "Mode"},
             {"code_name": "balance_pct", "widget": tk.Entry, "data_type": float, "width": 12, "header": "Balance %"},
             {"code_name": "take_profit", "widget": tk.Entry, "data_type": float, "width": 12, "header": "TP %"},
             {"code_name": "stop_loss", "widget": tk.Entry, "data_type": float, "width": 12, "header": "SL %"},
@@ -122,7 +135,7 @@ class StrategyEditor(tk.Frame):
 
         for h in self._base_params:
             self.body_widgets[h['code_name']] = dict()
-            if h['code_name'] in ["strategy_type", "contract", "timeframe"]:
+            if h['code_name'] in ["strategy_type", "contract", "timeframe", "mode"]:
                 self.body_widgets[h['code_name'] + "_var"] = dict()
 
         self._body_index = 0
@@ -169,6 +182,7 @@ class StrategyEditor(tk.Frame):
             self.body_widgets[code_name][b_index].grid(row=b_index, column=col, padx=2)
 
         self.additional_parameters[b_index] = dict()
+        self.row_ids[b_index] = uuid.uuid4().hex
 
         for strat, params in self.extra_params.items():
             for param in params:
@@ -202,6 +216,8 @@ class StrategyEditor(tk.Frame):
                     var_name = element['code_name'] + "_var"
                     self.body_widgets[var_name][i - 1] = self.body_widgets[var_name][i]
 
+            self.row_ids[i - 1] = self.row_ids[i]
+
         self.body_widgets['delete'][b_index].config(bg="darkred")
 
         # Decrement the body index since a row is deleted
@@ -310,28 +326,73 @@ class StrategyEditor(tk.Frame):
 
         contract = self._exchanges[exchange].contracts[symbol]
 
+        if self.body_widgets['mode_var'][b_index].get() == "Paper":
+            order_client = self.paper_clients[exchange]
+        else:
+            order_client = self._exchanges[exchange]
+
         balance_pct = float(self.body_widgets['balance_pct'][b_index].get())
         take_profit = float(self.body_widgets['take_profit'][b_index].get())
         stop_loss = float(self.body_widgets['stop_loss'][b_index].get())
 
         if self.body_widgets['activation'][b_index].cget("text") == "OFF":
-            if strat_selected == "Technical":
-                new_strategy = TechnicalStrategy(self._exchanges[exchange], contract, exchange, timeframe, balance_pct,
-                                                 take_profit, stop_loss, self.additional_parameters[b_index])
-            elif strat_selected == "Breakout":
-                new_strategy = BreakoutStrategy(self._exchanges[exchange], contract, exchange, timeframe, balance_pct,
-                                                take_profit, stop_loss, self.additional_parameters[b_index])
-            else:
-                return
+            order_client.orders.resume()  # After the kill switch, starting a strategy allows orders again
 
-            # Collects historical data. It is just one API call so that is ok, but be careful not to call methods
-            # that would lock the UI for too long.
-            # For example don't make a query to a database containing billions of rows, your interface would freeze.
-            new_strategy.candles = self._exchanges[exchange].get_historical_candles(contract, timeframe)
+            worker_pool = self._exchanges[exchange].worker_pool
 
-            if len(new_strategy.candles) == 0:
-                self.root.logging_frame.add_log(f"No historical data retrieved for {contract.symbol}")
-                return
+            if worker_pool is not None and order_client is self._exchanges[exchange]:
+                # The strategy runs in the worker process of its symbol, which collects the historical data itself
+                if strat_selected not in ["Technical", "Breakout"]:
+                    return
+
+                new_strategy = worker_pool.start_strategy(b_index, strat_selected, contract, exchange, timeframe,
+                                                          balance_pct, take_profit, stop_loss,
+                                                          self.additional_parameters[b_index])
+                new_strategy.uid = self.row_ids[b_index]
+            else:
+                if strat_selected == "Technical":
+                    new_strategy = TechnicalStrategy(order_client, contract, exchange, timeframe, balance_pct,
+                                                     take_profit, stop_loss, self.additional_parameters[b_index])
+                elif strat_selected == "Breakout":
+                    new_strategy = BreakoutStrategy(order_client, contract, exchange, timeframe, balance_pct,
+                                                    take_profit, stop_loss, self.additional_parameters[b_index])
+                else:
+                    return
+
+                new_strategy.uid = self.row_ids[b_index]
+
+                # The candles are shared by all the strategies running on the same contract, so the historical data
+                # is only collected for the first strategy on this contract / timeframe.
+                # It is just one API call so that is ok, but be careful not to call methods
+                # that would lock the UI for too long.
+                # For example don't make a query to a database containing billions of rows, your interface would
+                # freeze.
+                aggregator = self._exchanges[exchange].get_aggregator(contract)
+
+                if not aggregator.has_timeframe(timeframe):
+                    # From the snapshot of the previous run when possible, only the candles since then are requested
+                    historical_candles = snapshot_store.restore_candles(self._exchanges[exchange], contract, exchange,
+                                                                        timeframe)
+                    if historical_candles is None:
+                        historical_candles = self._exchanges[exchange].get_historical_candles(contract, timeframe)
+
+                    if len(historical_candles) == 0:
+                        self.root.logging_frame.add_log(f"No historical data retrieved for {contract.symbol}")
+                        return
+
+                    aggregator.add_timeframe(timeframe, historical_candles)
+
+                aggregator.subscribe(new_strategy)
+
+                journal = order_client.orders.journal
+                if journal is not None:  # Open trades of the previous run of this strategy, checked with the exchange
+                    new_strategy.recover_trades(journal.recover(new_strategy))
+                elif order_client is self._exchanges[exchange]:
+                    new_strategy.recover_trades(snapshot_store.open_trades(order_client.platform, new_strategy,
+                                                                           contract))
+
+            if order_client.orders.risk is not None:  # Its quotes are tracked before the first order of the strategy
+                order_client.orders.risk.watch(order_client.platform, contract)
 
             if exchange == "Binance":
                 self._exchanges[exchange].subscribe_channel([contract], "aggTrade")
@@ -349,16 +410,31 @@ class StrategyEditor(tk.Frame):
             self.root.logging_frame.add_log(f"{strat_selected} strategy on {symbol} / {timeframe} started")
 
         else:
+            self._exchanges[exchange].strategies[b_index].stop()
             del self._exchanges[exchange].strategies[b_index]
 
-            for param in self._base_params:
-                code_name = param['code_name']
+            self._unlock_row(b_index)
+            self.root.logging_frame.add_log(f"{strat_selected} strategy on {symbol} / {timeframe} stopped")
 
-                if code_name != "activation" and "_var" not in code_name:
-                    self.body_widgets[code_name][b_index].config(state=tk.NORMAL)
+    def _unlock_row(self, b_index: int):
+        for param in self._base_params:
+            code_name = param['code_name']
 
-            self.body_widgets['activation'][b_index].config(bg="darkred", text="OFF")
-            self.root.logging_frame.add_log(f"{strat_selected} strategy on {symbol} / {timeframe} stopped")
+            if code_name != "activation" and "_var" not in code_name:
+                self.body_widgets[code_name][b_index].config(state=tk.NORMAL)
+
+        self.body_widgets['activation'][b_index].config(bg="darkred", text="OFF")
+
+    def deactivate_all(self):
+
+        """
+        Switch all the rows OFF after the kill switch stopped their strategies.
+        :return:
+        """
+
+        for b_index, button in self.body_widgets['activation'].items():
+            if button.cget("text") == "ON":
+                self._unlock_row(b_index)
 
     def _load_workspace(self):
 
@@ -374,6 +450,9 @@ class StrategyEditor(tk.Frame):
 
             b_index = self._body_index - 1  # -1 to select the row that was just added
 
+            if row['uid'] is not None:
+                self.row_ids[b_index] = row['uid']
+
             for base_param in self._base_params:
                 code_name = base_param['code_name']
 
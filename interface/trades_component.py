@@ -54,7 +54,7 @@ class TradesWatch(tk.Frame):
 
         b_index = self._body_index
 
-        t_index = trade.time  # This is the trade row identifier, Unix Timestamp in milliseconds, so should be unique.
+        t_index = trade.id  # The trade row identifier, the time is shared by the trades netted in the same order
 
         dt_str = datetime.datetime.fromtimestamp(trade.time / 1000).strftime("%b %d %H:%M")
 
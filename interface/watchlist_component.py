@@ -12,10 +12,10 @@ from database import WorkspaceData
 
 class Watchlist(tk.Frame):
     def __init__(self, binance_contracts: typing.Dict[str, Contract], bitmex_contracts: typing.Dict[str, Contract],
-                 *args, **kwargs):
+                 db: WorkspaceData, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.db = WorkspaceData()
+        self.db = db
 
         self.binance_symbols = list(binance_contracts.keys())
         self.bitmex_symbols = list(bitmex_contracts.keys())
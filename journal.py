@@ -0,0 +1,258 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import typing
+
+from models import *
+
+if typing.TYPE_CHECKING:
+    from orders import Order
+    from strategies import Strategy
+
+logger = logging.getLogger()
+
+
+ORDER_COLUMNS = ["time", "platform", "client_order_id", "order_id", "symbol", "side", "quantity", "price", "state",
+                 "filled_quantity", "avg_price"]
+TRADE_COLUMNS = ["time", "platform", "strategy", "trade_time", "symbol", "side", "status", "entry_price", "quantity",
+                 "entry_id", "pnl"]
+
+
+def strategy_key(strategy) -> str:
+
+    """
+    Identifies a strategy from one run to the next: the uid of its row in the workspace, so two rows with the same
+    type, symbol and timeframe keep separate trades. The strategies started outside the interface have none.
+    """
+
+    if strategy.uid is not None:
+        return strategy.uid
+
+    return f"{strategy.stat_name} {strategy.contract.symbol} {strategy.tf}"
+
+
+class Journal:
+    def __init__(self, path: str = "journal.db", batch_size: int = 1000):
+
+        """
+        Append-only record of the orders (intents, acknowledgements, fills, final states) and of the trades of the live
+        strategies, in a SQLite database in WAL mode.
+        The record methods only put a tuple in a queue, a background thread writes everything queued since its last
+        write in one transaction (group commit), so the websocket and dispatcher threads never wait for the disk.
+        With synchronous=NORMAL a committed batch survives a crash of the program, only the rows queued in the last
+        milliseconds before it can be lost.
+        :param path:
+        :param batch_size: Maximum number of rows written in one transaction
+        """
+
+        self.path = path
+        self.batch_size = batch_size
+
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")  # Persistent, the readers don't block the writer
+        conn.execute("CREATE TABLE IF NOT EXISTS orders (seq INTEGER PRIMARY KEY, time INTEGER, platform TEXT, "
+                     "client_order_id TEXT, order_id TEXT, symbol TEXT, side TEXT, quantity REAL, price REAL, "
+                     "state TEXT, filled_quantity REAL, avg_price REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS trades (seq INTEGER PRIMARY KEY, time INTEGER, platform TEXT, "
+                     "strategy TEXT, trade_time INTEGER, symbol TEXT, side TEXT, status TEXT, entry_price REAL, "
+                     "quantity REAL, entry_id TEXT, pnl REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS orders_ids ON orders (platform, order_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS trades_strategy ON trades (platform, strategy, trade_time)")
+        conn.commit()
+        conn.close()
+
+        self._queue = queue.SimpleQueue()
+
+        self.batches = 0  # Number of transactions, and of rows written, for the logs
+        self.rows = 0
+
+        t = threading.Thread(target=self._write, daemon=True)
+        t.start()
+
+    def record_order(self, platform: str, order: "Order"):
+        self._queue.put(("orders", (int(time.time() * 1000), platform, order.client_order_id,
+                                    None if order.order_id is None else str(order.order_id), order.contract.symbol,
+                                    order.side.lower(), order.quantity, order.price, order.state,
+                                    order.filled_quantity, order.avg_price)))
+
+    def record_trade(self, platform: str, strategy, trade: Trade):
+
+        """
+        :param platform:
+        :param strategy: Strategy or RemoteStrategy
+        :param trade:
+        :return:
+        """
+
+        self._queue.put(("trades", (int(time.time() * 1000), platform, strategy_key(strategy), trade.time,
+                                    trade.contract.symbol, trade.side, trade.status, trade.entry_price, trade.quantity,
+                                    None if trade.entry_id is None else str(trade.entry_id), trade.pnl)))
+
+    def flush(self, timeout: typing.Optional[float] = 5.0) -> bool:
+
+        """
+        Wait until everything recorded so far is written, e.g. before reading the journal or closing the program.
+        :param timeout: In seconds
+        :return: False if the writer didn't catch up in time
+        """
+
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def _write(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+
+        statements = {table: f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+                      for table, columns in [("orders", ORDER_COLUMNS), ("trades", TRADE_COLUMNS)]}
+
+        while True:
+            items = [self._queue.get()]
+
+            try:
+                while len(items) < self.batch_size:
+                    items.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            rows = {"orders": [], "trades": []}
+            flushes = []
+
+            for kind, item in items:
+                if kind == "flush":
+                    flushes.append(item)
+                else:
+                    rows[kind].append(item)
+
+            try:
+                with conn:  # One transaction for the whole batch
+                    for table, table_rows in rows.items():
+                        if len(table_rows) > 0:
+                            conn.executemany(statements[table], table_rows)
+                self.batches += 1
+                self.rows += len(items) - len(flushes)
+            except sqlite3.Error as e:
+                logger.error("Error while writing %s rows to the journal: %s", len(items) - len(flushes), e)
+
+            for done in flushes:
+                done.set()
+
+    def _read(self, sql: str, params: typing.Tuple) -> typing.List[sqlite3.Row]:
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def open_trades(self, platform: str, key: typing.Optional[str] = None) -> typing.List[sqlite3.Row]:
+
+        """
+        Last state of the trades that were still open when the program stopped.
+        :param platform:
+        :param key: strategy_key() of a strategy, all the strategies of the platform if None
+        :return:
+        """
+
+        self.flush()
+
+        strategy_filter = "" if key is None else " AND strategy = ?"
+        params = (platform,) if key is None else (platform, key)
+
+        return self._read(f"SELECT * FROM trades WHERE seq IN (SELECT MAX(seq) FROM trades WHERE platform = ?"
+                          f"{strategy_filter} GROUP BY strategy, trade_time) AND status = 'open' ORDER BY trade_time",
+                          params)
+
+    def last_order_state(self, platform: str, order_id: str) -> typing.Optional[sqlite3.Row]:
+        rows = self._read("SELECT * FROM orders WHERE platform = ? AND order_id = ? ORDER BY seq DESC LIMIT 1",
+                          (platform, order_id))
+        return rows[0] if len(rows) > 0 else None
+
+    def recover(self, strategy: "Strategy") -> typing.List[Trade]:
+
+        """
+        Rebuild the open trades of a strategy from the journal and reconcile them with the exchange:
+        an entry whose fill was not recorded is looked up on the exchange, and when the exchange has no position on
+        the symbol the trades were closed while the program was not running (stop, liquidation, manual close).
+        Makes requests to the exchange, called once when the strategy starts.
+        :param strategy:
+        :return: The trades still open, the closed ones are recorded as closed
+        """
+
+        client = strategy.client
+        platform = client.platform
+        contract = strategy.contract
+
+        rows = self.open_trades(platform, strategy_key(strategy))
+        if len(rows) == 0:
+            return []
+
+        trades = []
+
+        for row in rows:
+            trade = Trade({"time": row['trade_time'], "contract": contract, "strategy": strategy.stat_name,
+                           "side": row['side'], "entry_price": row['entry_price'], "status": "open",
+                           "pnl": row['pnl'], "quantity": row['quantity'], "entry_id": row['entry_id']})
+
+            if trade.entry_price is None:
+                trade.entry_price, trade.quantity = self._entry_fill(client, contract, row)
+
+            if trade.entry_price is None:
+                trade.status = "canceled"
+                self.record_trade(platform, strategy, trade)
+            else:
+                trades.append(trade)
+
+        positions = client.get_positions()  # None when the request failed, nothing is closed then
+
+        if positions is not None:
+            position = positions.get(contract.symbol, 0)
+
+            # All the strategies of the symbol share the position of the exchange
+            journaled = sum(row['quantity'] * (1 if row['side'] == "long" else -1)
+                            for row in self.open_trades(platform) if row['symbol'] == contract.symbol)
+
+            if position == 0:
+                for trade in trades:
+                    trade.status = "closed"
+                    self.record_trade(platform, strategy, trade)
+                logger.warning("%s %s: no position on the exchange, %s trades of %s recovered as closed", platform,
+                               contract.symbol, len(trades), strategy_key(strategy))
+                return []
+
+            if abs(position - journaled) > contract.lot_size / 2:
+                logger.warning("%s %s: position of %s on the exchange, %s in the journal", platform, contract.symbol,
+                               position, journaled)
+
+        logger.info("%s: %s open trades of %s recovered from the journal", platform, len(trades),
+                    strategy_key(strategy))
+
+        return trades
+
+    def _entry_fill(self, client, contract: Contract,
+                    row: sqlite3.Row) -> typing.Tuple[typing.Optional[float], float]:
+
+        """
+        Entry price and quantity of a trade whose entry was acknowledged but not recorded as filled.
+        """
+
+        if row['entry_id'] is None:
+            return None, row['quantity']
+
+        order = self.last_order_state(client.platform, row['entry_id'])
+
+        if order is not None and order['state'] == "filled" and order['avg_price']:
+            return order['avg_price'], row['quantity']  # Of a netted order, the trade keeps its allocated quantity
+
+        order_status = client.get_order_status(contract, row['entry_id'],
+                                               order['client_order_id'] if order is not None else None)
+
+        if order_status is not None and order_status.executed_qty > 0 and order_status.avg_price:
+            quantity = row['quantity'] if order_status.status == "filled" else order_status.executed_qty
+            return order_status.avg_price, min(quantity, row['quantity'])
+
+        return None, row['quantity']
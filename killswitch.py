@@ -0,0 +1,131 @@
+import concurrent.futures
+import logging
+import time
+import typing
+
+from events import dispatcher, LogEvent
+
+if typing.TYPE_CHECKING:
+    from connectors.binance_futures import BinanceFuturesClient
+    from connectors.bitmex import BitmexClient
+
+logger = logging.getLogger()
+
+
+class KillSwitch:
+    def __init__(self, clients: typing.List[typing.Union["BinanceFuturesClient", "BitmexClient"]],
+                 paper_clients: typing.Optional[typing.List] = None):
+
+        """
+        Emergency stop: disables all the strategies, then cancels all the open orders and closes all the open
+        positions of every exchange. The positions closed first are the ones the program tracks from the fills, so the
+        closing orders go out in the first round trip, at the same time as the cancellations, on all the exchanges.
+        A positions request per exchange then finds the positions still open, e.g. opened manually or by a previous
+        run, which are closed and checked again.
+        :param clients: The exchange connectors
+        :param paper_clients: Their orders are refused too, they have nothing to close on the exchanges
+        """
+
+        self.clients = clients
+        self.paper_clients = paper_clients or []
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * len(clients))
+
+    def trigger(self, reason: str = "manual") -> typing.Dict:
+
+        """
+        Can be called from any thread, blocks until the exchanges answered.
+        :param reason: For the logs
+        :return: Duration in milliseconds, and for each platform whether the orders were cancelled, the number of
+        positions closed and of positions still open (None if they couldn't be checked)
+        """
+
+        start = time.perf_counter()
+
+        logger.warning("Kill switch triggered (%s)", reason)
+
+        for client in self.clients + self.paper_clients:
+            client.orders.halt()
+
+        symbols = dict()
+
+        for client in self.clients:
+            # Binance cancels the orders symbol by symbol: the ones the program trades or has orders on
+            symbols[client.platform] = {strategy.contract.symbol for strategy in client.strategies.values()}
+            symbols[client.platform].update(order.contract.symbol for order in list(client.orders.orders.values()))
+            symbols[client.platform].update(client.aggregators)
+
+            for strategy in list(client.strategies.values()):  # Including the paper and worker process strategies
+                strategy.stop()
+            client.strategies.clear()
+
+        futures = dict()
+
+        for client in self.clients:
+            risk = client.orders.risk
+            positions = risk.positions(client.platform) if risk is not None else None  # Else requested first
+            symbols[client.platform].update(positions or dict())
+
+            futures[(client.platform, "cancel")] = self._executor.submit(client.cancel_all_orders,
+                                                                         sorted(symbols[client.platform]))
+            futures[(client.platform, "close")] = self._executor.submit(client.close_all_positions, positions)
+
+        closed = {client.platform: self._result(futures[(client.platform, "close")], client.platform)
+                  for client in self.clients}
+
+        # The closing orders are market orders, the positions are checked once they are all acknowledged
+        checks = {client.platform: self._executor.submit(client.get_positions) for client in self.clients}
+
+        remaining = {client.platform: self._result(checks[client.platform], client.platform) for client in self.clients}
+
+        # Reduce-only, a position closed by the first orders but still reported can't be reversed
+        untracked = [client for client in self.clients if remaining[client.platform]]
+
+        second_closes = {client.platform: self._executor.submit(client.close_all_positions, remaining[client.platform])
+                         for client in untracked}
+        for client in untracked:
+            statuses = self._result(second_closes[client.platform], client.platform)
+            closed[client.platform] = (closed[client.platform] or []) + (statuses or [])
+
+        checks = {client.platform: self._executor.submit(client.get_positions) for client in untracked}
+        for client in untracked:
+            remaining[client.platform] = self._result(checks[client.platform], client.platform)
+
+        report = {"reason": reason}
+
+        for client in self.clients:
+            cancelled = self._result(futures[(client.platform, "cancel")], client.platform)
+            remaining_positions = remaining[client.platform]
+
+            report[client.platform] = {"cancelled": bool(cancelled),
+                                       "closed": sum(1 for status in closed[client.platform] or []
+                                                     if status is not None),
+                                       "not_closed": len(remaining_positions) if remaining_positions is not None
+                                       else None}
+
+            if remaining_positions is not None and client.orders.risk is not None:
+                client.orders.risk.set_positions(client.platform, remaining_positions, client.contracts)
+
+        report["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+        message = f"Kill switch done in {report['duration_ms']} ms: " + ", ".join(
+            f"{client.platform} orders {'cancelled' if report[client.platform]['cancelled'] else 'NOT CANCELLED'} / "
+            f"{report[client.platform]['closed']} positions closed" for client in self.clients)
+
+        if any(report[client.platform]["not_closed"] is None for client in self.clients):
+            message += " - THE POSITIONS COULD NOT BE CHECKED"
+        elif any(report[client.platform]["not_closed"] > 0 for client in self.clients):
+            message += " - SOME POSITIONS COULD NOT BE CLOSED"
+
+        logger.warning("%s", message)
+        dispatcher.publish(LogEvent(None, message))
+
+        return report
+
+    @staticmethod
+    def _result(future: concurrent.futures.Future, platform: str):
+        try:
+            return future.result()
+        except Exception as e:
+            logger.error("Kill switch error on %s: %s", platform, e)
+            return None
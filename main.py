@@ -1,12 +1,37 @@
+import argparse
+import datetime
 import logging
+import signal
 
 from connectors.binance_futures import BinanceFuturesClient
 from connectors.bitmex import BitmexClient
 
+from database import WorkspaceData
+from history_export import export_candles, export_trades
 from interface.root_component import Root
+from journal import Journal
+from killswitch import KillSwitch
+from risk import portfolio_risk
+from market_store import market_store
+from snapshot import snapshot_store
+from workers import StrategyWorkerPool
 
 logger = logging.getLogger()
 
+# Number of worker processes running the live strategies of each exchange, 0 runs them in the websocket threads
+STRATEGY_WORKERS = 0
+
+# Receive the market data in a separate feed handler process, that also makes it readable by other programs
+FEED_PROCESS = False
+
+# Pre-trade checks of the orders of the live strategies, None for no limit. Notional values in USDT / USD.
+MAX_EXPOSURE = None
+MAX_OPEN_TRADES = None
+SYMBOL_CAPS = {}  # e.g. {"BTCUSDT": 5000, "XBTUSD": 5000}
+
+# Record the trades, quotes and closed candles received, to market_data/, for the backtester
+RECORD_MARKET_DATA = False
+
 logger.setLevel(logging.INFO)
 
 stream_handler = logging.StreamHandler()
@@ -22,13 +47,89 @@ logger.addHandler(stream_handler)
 logger.addHandler(file_handler)
 
 
+def stop_clients(clients):
+    for client in clients:
+        client.reconnect = False  # Avoids the infinite reconnect loop in _start_ws()
+        if client.feed is not None:
+            client.feed.stop()
+        else:
+            client.ws.close()
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--kill-switch", action="store_true",
+                        help="Cancel all the orders and close all the positions on every exchange, then exit")
+
+    # History export for the research notebooks, read back with history_export.load_candles() / load_trades()
+    parser.add_argument("--export", choices=["candles", "trades"], help="Export the history of the symbols, then exit")
+    parser.add_argument("--source", choices=["exchange", "cache", "store"], default="exchange",
+                        help="exchange, cache (tick_data/ of the tick history downloads), store (market_data/)")
+    parser.add_argument("--platform", choices=["binance_futures", "bitmex"], default="binance_futures")
+    parser.add_argument("--symbols", default="BTCUSDT", help="Comma-separated")
+    parser.add_argument("--timeframe", default="1m")
+    parser.add_argument("--start", type=datetime.date.fromisoformat, help="YYYY-MM-DD")
+    parser.add_argument("--end", type=datetime.date.fromisoformat, help="YYYY-MM-DD, included, today by default")
+    parser.add_argument("--output", default="history_data")
+    args = parser.parse_args()
+
+    portfolio_risk.max_exposure = MAX_EXPOSURE
+    portfolio_risk.max_open_trades = MAX_OPEN_TRADES
+    portfolio_risk.symbol_caps = SYMBOL_CAPS
+
     binance = BinanceFuturesClient("3e574effb792bb8bdf3b0460c6fb7ef9326bbc6754a4ddacd5720e083ba0ba40",
                                    "ff20681594618ce5cb1d44de805e2670d20d1d02ea0662866e3620adb406d483",
-                                   testnet = True, futures=True)
+                                   testnet = True, futures=True, feed_process=FEED_PROCESS)
+
+    bitmex = BitmexClient("uHXdtitZKBe2ET8UgnSjyTJa", "1bN-ILBxWEWVD9yzEbrMRhjGgfWYuxYjVCC-vG0M7Mg3m_q8", True,
+                          feed_process=FEED_PROCESS)
+
+    if args.kill_switch:  # Headless emergency stop, e.g. from a script or another machine through ssh
+        report = KillSwitch([binance, bitmex]).trigger("command line")
+        logger.info("Kill switch report: %s", report)
+
+        stop_clients([binance, bitmex])
+        raise SystemExit(0)
+
+    if args.export is not None:
+        client = binance if args.platform == binance.platform else bitmex
+        end = args.end if args.end is not None else datetime.datetime.utcnow().date()
+        start = args.start if args.start is not None else end - datetime.timedelta(days=30)
+
+        for symbol in args.symbols.split(","):
+            if symbol not in client.contracts:
+                logger.error("Unknown %s symbol: %s", client.platform, symbol)
+            elif args.export == "candles":
+                export_candles(client, client.contracts[symbol], args.timeframe, start, end, args.output, args.source)
+            else:
+                export_trades(client, client.contracts[symbol], start, end, args.output, args.source)
+
+        stop_clients([binance, bitmex])
+        raise SystemExit(0)
+
+    # Orders and trades of the live strategies, to recover their open trades after a restart
+    journal = Journal("journal.db")
+    binance.orders.journal = journal
+    bitmex.orders.journal = journal
+
+    # The strategies started in the next minutes continue from the candles and indicators of the previous run
+    snapshot_store.load()
+    snapshot_store.start([binance, bitmex])
+
+    if RECORD_MARKET_DATA:
+        market_store.start()
+
+    if STRATEGY_WORKERS > 0:
+        binance.worker_pool = StrategyWorkerPool(binance, STRATEGY_WORKERS)
+        bitmex.worker_pool = StrategyWorkerPool(bitmex, STRATEGY_WORKERS)
+
+    # Watchlist and strategies of the interface, only opened by the main process, not by the worker processes
+    workspace_data = WorkspaceData()
+
+    root = Root(binance, bitmex, workspace_data)
 
-    bitmex = BitmexClient("uHXdtitZKBe2ET8UgnSjyTJa", "1bN-ILBxWEWVD9yzEbrMRhjGgfWYuxYjVCC-vG0M7Mg3m_q8", True)
+    if hasattr(signal, "SIGUSR1"):  # kill -USR1 <pid> triggers the kill switch of a running interface
+        signal.signal(signal.SIGUSR1, lambda signum, frame: root.trigger_kill_switch("signal"))
 
-    root = Root(binance, bitmex)
     root.geometry("2250x350")
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
@@ -0,0 +1,308 @@
+import collections
+import datetime
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import typing
+
+import numpy as np
+import pandas as pd
+
+from events import dispatcher, TradeEvent, QuoteEvent, CandleCloseEvent
+from backtester import CandleData
+from tick_history import TickData
+
+logger = logging.getLogger()
+
+
+DAY_MS = 24 * 3600 * 1000
+
+# Each partition is a SQLite database: data_dir/platform/symbol/YYYY-MM-DD.db, like the days of TickHistory
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS trades (timestamp INTEGER NOT NULL, price REAL, quantity REAL)",
+    "CREATE TABLE IF NOT EXISTS quotes (timestamp INTEGER NOT NULL, bid REAL, ask REAL)",
+    "CREATE TABLE IF NOT EXISTS candles (timestamp INTEGER NOT NULL, timeframe TEXT NOT NULL, open REAL, high REAL, "
+    "low REAL, close REAL, volume REAL, PRIMARY KEY (timeframe, timestamp))",
+    "CREATE INDEX IF NOT EXISTS trades_timestamp ON trades (timestamp)",
+    "CREATE INDEX IF NOT EXISTS quotes_timestamp ON quotes (timestamp)",
+]
+
+INSERTS = {
+    "trades": "INSERT INTO trades (timestamp, price, quantity) VALUES (?, ?, ?)",
+    "quotes": "INSERT INTO quotes (timestamp, bid, ask) VALUES (?, ?, ?)",
+    "candles": "INSERT OR REPLACE INTO candles (timestamp, timeframe, open, high, low, close, volume) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?)",  # The candle of a timeframe is stored once, even if closed again
+}
+
+TRADE_DTYPE = np.dtype([("timestamp", np.int64), ("price", np.float64), ("quantity", np.float64)])
+CANDLE_DTYPE = np.dtype([("timestamp", np.int64), ("open", np.float64), ("high", np.float64), ("low", np.float64),
+                         ("close", np.float64), ("volume", np.float64)])
+
+# The live prints are stored as floats, TickData reads them with unit scales
+FLOAT_META = {'price_scale': 1, 'tick_units': 1, 'quantity_scale': 1, 'lot_units': 1}
+
+
+def _day(day: int) -> str:
+    return (datetime.date(1970, 1, 1) + datetime.timedelta(days=day)).isoformat()
+
+
+class MarketDataStore:
+    def __init__(self, data_dir: str = "market_data", flush_interval: float = 1.0, max_buffered: int = 1000000,
+                 max_open: int = 256):
+
+        """
+        Optional record of the market data received by the bot: the trades, the quotes and the closed candles of each
+        exchange and symbol, partitioned by day in SQLite databases indexed by timestamp.
+        The dispatcher handlers only append a tuple to a buffer, a background thread writes the buffer every
+        flush_interval, one transaction per partition. The buffer is bounded: if the disk can't keep up the new rows
+        are dropped and counted, the bot is never slowed down.
+        The range queries can be made from any thread (interface, backtester, another program), they read the
+        partitions with their own connection and see the rows written up to the last flush.
+        :param data_dir:
+        :param flush_interval: In seconds, between two writes
+        :param max_buffered: Maximum number of rows waiting to be written
+        :param max_open: Number of partitions kept open by the writer
+        """
+
+        self.data_dir = data_dir
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.max_open = max_open
+
+        self._buffer: typing.Deque[typing.Tuple[str, str, str, typing.Tuple]] = collections.deque()
+        self._flushes: queue.SimpleQueue = queue.SimpleQueue()
+        self._wake = threading.Event()
+
+        self._connections: typing.OrderedDict[str, sqlite3.Connection] = collections.OrderedDict()
+        self._thread: typing.Optional[threading.Thread] = None
+
+        self.rows = 0  # Written and dropped rows, for the logs
+        self.dropped = 0
+
+    # Recording, in the dispatcher thread
+
+    def start(self, platforms: typing.Optional[typing.List[str]] = None, trades: bool = True, quotes: bool = True,
+              candles: bool = True):
+
+        """
+        Start recording the market data published to the dispatcher.
+        :param platforms: binance_futures, bitmex... All of them if None
+        :param trades:
+        :param quotes:
+        :param candles: The candles closed by the aggregators, only the timeframes of the running strategies
+        :return:
+        """
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write, daemon=True)
+            self._thread.start()
+
+        handlers = [(TradeEvent, self._on_trade, trades), (QuoteEvent, self._on_quote, quotes),
+                    (CandleCloseEvent, self._on_candle, candles)]
+
+        for platform in platforms if platforms is not None else [None]:
+            for event_type, handler, enabled in handlers:
+                if enabled:
+                    dispatcher.subscribe(event_type, handler, platform)
+
+        logger.info("Recording the market data of %s to %s", "all the exchanges" if platforms is None else platforms,
+                    self.data_dir)
+
+    def _add(self, kind: str, platform: str, symbol: str, row: typing.Tuple):
+        if len(self._buffer) < self.max_buffered:
+            self._buffer.append((kind, platform, symbol, row))
+        else:
+            self.dropped += 1
+
+    def _on_trade(self, event: TradeEvent):
+        self._add("trades", event.source, event.symbol, (event.timestamp, event.price, event.quantity))
+
+    def _on_quote(self, event: QuoteEvent):
+        self._add("quotes", event.source, event.symbol, (int(time.time() * 1000), event.bid, event.ask))
+
+    def _on_candle(self, event: CandleCloseEvent):
+        c = event.candle
+        self._add("candles", event.source, event.symbol,
+                  (c.timestamp, event.timeframe, c.open, c.high, c.low, c.close, c.volume))
+
+    def flush(self, timeout: typing.Optional[float] = 5.0) -> bool:
+
+        """
+        Write the buffer now and wait until it is written, e.g. before a query that needs the last rows or before
+        closing the program.
+        """
+
+        if self._thread is None:
+            return True
+
+        done = threading.Event()
+        self._flushes.put(done)
+        self._wake.set()
+        return done.wait(timeout)
+
+    # Writing, in the background thread
+
+    def _path(self, platform: str, symbol: str, day: str) -> str:
+        return os.path.join(self.data_dir, platform, symbol, day + ".db")
+
+    def _connection(self, path: str) -> sqlite3.Connection:
+        conn = self._connections.get(path)
+
+        if conn is not None:
+            self._connections.move_to_end(path)
+            return conn
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")  # The queries don't block the writer
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+
+        self._connections[path] = conn
+
+        if len(self._connections) > self.max_open:  # The partitions of the previous days are not written anymore
+            self._connections.popitem(last=False)[1].close()
+
+        return conn
+
+    def _write(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+
+            flushes = []
+            while True:
+                try:
+                    flushes.append(self._flushes.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Group the rows by partition, only the rows buffered so far: the dispatcher keeps appending
+
+            partitions: typing.Dict[typing.Tuple[str, str, int], typing.Dict[str, typing.List]] = dict()
+
+            for _ in range(len(self._buffer)):
+                kind, platform, symbol, row = self._buffer.popleft()
+                key = (platform, symbol, row[0] // DAY_MS)
+                if key not in partitions:
+                    partitions[key] = {"trades": [], "quotes": [], "candles": []}
+                partitions[key][kind].append(row)
+
+            for (platform, symbol, day), tables in partitions.items():
+                path = self._path(platform, symbol, _day(day))
+                n_rows = sum(len(rows) for rows in tables.values())
+
+                try:
+                    conn = self._connection(path)
+                    with conn:  # One transaction per partition
+                        for table, rows in tables.items():
+                            if len(rows) > 0:
+                                conn.executemany(INSERTS[table], rows)
+                    self.rows += n_rows
+                except sqlite3.Error as e:
+                    logger.error("Error while writing %s rows of market data to %s: %s", n_rows, path, e)
+
+            if self.dropped > 0:
+                logger.warning("Market data store: %s rows dropped, the writer can't keep up", self.dropped)
+                self.dropped = 0
+
+            for done in flushes:
+                done.set()
+
+    # Range queries, from any thread
+
+    def _read(self, platform: str, symbol: str, start: int, end: int, sql: str,
+              params: typing.Tuple = ()) -> typing.List[typing.Tuple]:
+
+        """
+        Run a query on the partitions of the days from start to end, the rows are concatenated in the order of the days.
+        """
+
+        rows = []
+
+        for day in range(start // DAY_MS, (end - 1) // DAY_MS + 1):
+            path = self._path(platform, symbol, _day(day))
+            if not os.path.exists(path):
+                continue
+
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                rows.extend(conn.execute(sql, params + (start, end)).fetchall())
+            except sqlite3.Error as e:
+                logger.error("Error while reading the market data of %s: %s", path, e)
+            finally:
+                conn.close()
+
+        return rows
+
+    def trades(self, platform: str, symbol: str, start: int, end: int) -> TickData:
+
+        """
+        The trades recorded from start (included) to end (excluded), in the order they were received.
+        candles() and prints() of the result rebuild the candles and the intrabar path for the backtester.
+        The aggressor side is not in the live trade events, buyer_maker is False.
+        :param platform:
+        :param symbol:
+        :param start: Unix timestamp in milliseconds
+        :param end: Unix timestamp in milliseconds
+        :return:
+        """
+
+        rows = self._read(platform, symbol, start, end, "SELECT timestamp, price, quantity FROM trades "
+                                                        "WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp")
+
+        array = np.fromiter(rows, dtype=TRADE_DTYPE, count=len(rows))
+
+        return TickData(array["timestamp"], array["price"], array["quantity"], np.zeros(len(array), dtype=bool),
+                        FLOAT_META)
+
+    def quotes(self, platform: str, symbol: str, start: int, end: int) -> pd.DataFrame:
+
+        """
+        Best bid and ask recorded from start (included) to end (excluded). The timestamps are the local reception
+        times, a Bitmex update with only one side changed has None for the other one.
+        :return: DataFrame with the timestamp, bid and ask columns
+        """
+
+        rows = self._read(platform, symbol, start, end, "SELECT timestamp, bid, ask FROM quotes "
+                                                        "WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp")
+
+        return pd.DataFrame(rows, columns=["timestamp", "bid", "ask"])
+
+    def candles(self, platform: str, symbol: str, timeframe: str, start: int, end: int) -> CandleData:
+
+        """
+        The closed candles recorded for a timeframe, whose open time is from start (included) to end (excluded).
+        Only the timeframes of the strategies that were running are recorded, the other ones can be rebuilt from
+        trades().
+        :return: Ready for the Backtester
+        """
+
+        rows = self._read(platform, symbol, start, end, "SELECT timestamp, open, high, low, close, volume FROM "
+                                                        "candles WHERE timeframe = ? AND timestamp >= ? AND "
+                                                        "timestamp < ? ORDER BY timestamp", (timeframe,))
+
+        array = np.fromiter(rows, dtype=CANDLE_DTYPE, count=len(rows))
+
+        return CandleData(*[array[name] for name in CANDLE_DTYPE.names])
+
+    def symbols(self, platform: str) -> typing.List[str]:
+
+        """
+        The symbols with recorded data, e.g. to fill a selection list of the interface.
+        """
+
+        directory = os.path.join(self.data_dir, platform)
+        if not os.path.isdir(directory):
+            return []
+
+        return sorted(os.listdir(directory))
+
+
+market_store = MarketDataStore()
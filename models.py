@@ -1,8 +1,17 @@
 import dateutil.parser
 import datetime
+import decimal
+import itertools
+import typing
+
+if typing.TYPE_CHECKING:
+    from positions import PositionTable
 
 BITMEX_MULTIPLIER = 0.00000001
 BITMEX_TF_MINUTES = {"1m": 1, "5m": 5, "1h": 60, "1d": 1440}
+TF_EQUIV = {"1m": 60, "5m": 300, "15m": 900, "30m": 1800, "1h": 3600, "4h": 14400}
+
+_trade_ids = itertools.count(1)
 
 class Balance:
     def __init__(self, info, exchange):
@@ -49,16 +58,8 @@ class Candle:
             self.volume = candle_info['volume']
 
 def tick_to_decimals(tick_size: float) -> int:
-    tick_size_str = "{0:.8f}".format(tick_size)
-    while tick_size_str[-1] == "0":
-        tick_size_str = tick_size_str[:-1]
-
-    split_tick = tick_size_str.split(".")
-
-    if len(split_tick) > 1:
-        return len(split_tick[1])
-    else:
-        return 0
+    exponent = decimal.Decimal(str(tick_size)).normalize().as_tuple().exponent
+    return max(-exponent, 0)
 
 class Contract:
     def __init__(self, contract_info, exchange):
@@ -71,6 +72,15 @@ class Contract:
             self.tick_size = 1 / pow(10, contract_info['pricePrecision'])
             self.lot_size = 1 / pow(10, contract_info['quantityPrecision'])
 
+            # The precision fields are only display hints, the real tick size and lot size are in the 'filters'
+            for b_filter in contract_info.get('filters', []):
+                if b_filter['filterType'] == 'PRICE_FILTER':
+                    self.tick_size = float(b_filter['tickSize'])
+                    self.price_decimals = tick_to_decimals(self.tick_size)
+                if b_filter['filterType'] == 'LOT_SIZE':
+                    self.lot_size = float(b_filter['stepSize'])
+                    self.quantity_decimals = tick_to_decimals(self.lot_size)
+
         elif exchange == "binance_spot":
             self.symbol = contract_info['symbol']
             self.base_asset = contract_info['baseAsset']
@@ -103,27 +113,96 @@ class Contract:
             if self.inverse:
                 self.multiplier *= -1
 
+        if exchange in ["binance", "binance_spot"]:  # Linear contracts, the PnL is in the quote asset
+            self.quanto = False
+            self.inverse = False
+            self.multiplier = 1
+
         self.exchange = exchange
 
+        # Prices and quantities are handled as integers (a number of ticks / lots) scaled by a power of ten,
+        # so the rounding to the tick size and lot size is exact and does not accumulate float errors.
+
+        self.price_scale = pow(10, self.price_decimals)
+        self.quantity_scale = pow(10, self.quantity_decimals)
+        self.tick_units = round(self.tick_size * self.price_scale)
+        self.lot_units = round(self.lot_size * self.quantity_scale)
+
+        self.price_format = "{0:.%df}" % self.price_decimals
+        self.quantity_format = "{0:.%df}" % self.quantity_decimals
+
+    def price_to_ticks(self, price: float) -> int:
+        return round(price * self.price_scale / self.tick_units)
+
+    def ticks_to_price(self, ticks: int) -> float:
+        return ticks * self.tick_units / self.price_scale
+
+    def quantity_to_lots(self, quantity: float) -> int:
+        return round(quantity * self.quantity_scale / self.lot_units)
+
+    def lots_to_quantity(self, lots: int) -> typing.Union[int, float]:
+        if self.quantity_scale == 1:
+            return lots * self.lot_units  # Integer quantities, e.g. Bitmex contracts
+        return lots * self.lot_units / self.quantity_scale
+
+    def round_price(self, price: float) -> float:
+        return self.ticks_to_price(self.price_to_ticks(price))
+
+    def round_quantity(self, quantity: float) -> typing.Union[int, float]:
+        return self.lots_to_quantity(self.quantity_to_lots(quantity))
+
+    def format_price(self, price: float) -> str:
+        return self.price_format.format(price)
+
+    def format_quantity(self, quantity: float) -> str:
+        return self.quantity_format.format(quantity)
+
 class OrderStatus:
     def __init__(self, order_info, exchange):
         if exchange == "binance":
             self.order_id = order_info['orderId']
+            self.client_order_id = order_info.get('clientOrderId')
             self.status = order_info['status'].lower()
             self.avg_price = float(order_info['avgPrice'])
+            self.executed_qty = float(order_info.get('executedQty', 0))
         elif exchange == "bitmex":
             self.order_id = order_info['orderID']
+            self.client_order_id = order_info.get('clOrdID')
             self.status = order_info['ordStatus'].lower()
             self.avg_price = order_info['avgPx']
+            self.executed_qty = order_info.get('cumQty') or 0
 
 class Trade:
     def __init__(self, trade_info):
+        self.id = next(_trade_ids)  # Unique in the process, the netted trades of several strategies have the same time
         self.time: int = trade_info['time']
         self.contract: Contract = trade_info['contract']
         self.strategy: str = trade_info['strategy']
         self.side: str = trade_info['side']
         self.entry_price: float = trade_info['entry_price']
         self.status: str = trade_info['status']
-        self.pnl: float = trade_info['pnl']
         self.quantity = trade_info['quantity']
-        self.entry_id = trade_info['entry_id']
\ No newline at end of file
+        self.entry_id = trade_info['entry_id']
+
+        self.position_table: typing.Optional["PositionTable"] = None  # Set while the trade is open
+        self._pnl: float = trade_info['pnl']
+
+    @property
+    def pnl(self) -> float:
+
+        """
+        While the trade is open the PnL is read from the position table of its symbol, revalued on every quote.
+        :return:
+        """
+
+        position_table = self.position_table
+        if position_table is not None:
+            pnl = position_table.pnl_of(self)
+            if pnl is not None:
+                return pnl
+
+        return self._pnl
+
+    @pnl.setter
+    def pnl(self, value: float):
+        self._pnl = value
@@ -0,0 +1,221 @@
+import concurrent.futures
+import itertools
+import logging
+import math
+import os
+import random
+import typing
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from backtester import Backtester, CandleData, Prints
+
+logger = logging.getLogger()
+
+
+CANDLE_COLUMNS = ["timestamp", "open", "high", "low", "close", "volume"]
+METRICS = ["net_pnl", "trade_count", "win_rate", "profit_factor", "max_drawdown", "sharpe"]
+
+
+class SharedCandles:
+    def __init__(self, candles: CandleData):
+
+        """
+        Copy the candles once into a shared memory block, the worker processes map the same block instead of
+        receiving a pickled copy of the data with every task.
+        :param candles:
+        """
+
+        self.size = len(candles)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(len(CANDLE_COLUMNS) * self.size * 8, 1))
+
+        for i, column in enumerate(CANDLE_COLUMNS):
+            view = np.ndarray(self.size, dtype=np.int64 if column == "timestamp" else np.float64, buffer=self._shm.buf,
+                              offset=i * self.size * 8)
+            view[:] = getattr(candles, column)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
+
+
+# Worker process side. The initializer attaches the shared block once per process.
+
+_worker_shm: typing.Optional[shared_memory.SharedMemory] = None
+_worker_candles: typing.Optional[CandleData] = None
+_worker_prints: typing.Dict[typing.Tuple[int, int], Prints] = dict()
+
+
+def _init_worker(shm_name: str, size: int):
+    global _worker_shm, _worker_candles
+
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+
+    columns = [np.ndarray(size, dtype=np.int64 if column == "timestamp" else np.float64, buffer=_worker_shm.buf,
+                          offset=i * size * 8) for i, column in enumerate(CANDLE_COLUMNS)]
+    _worker_candles = CandleData(*columns)
+
+
+def _run_backtest(task: typing.Tuple[str, typing.Dict, int, int, typing.Dict]) -> typing.Dict:
+
+    """
+    :param task: (strategy, parameters, start candle, end candle, backtester keyword arguments)
+    :return: The parameters and the metrics of the backtest
+    """
+
+    strategy, params, start, end, backtest_kwargs = task
+
+    candles = _worker_candles.slice(start, end)
+
+    # The 4 prints per candle path only depends on the period, it is reused by the following tasks
+    if (start, end) not in _worker_prints:
+        if len(_worker_prints) > 8:
+            _worker_prints.clear()
+        _worker_prints[(start, end)] = Prints.from_candles(candles)
+
+    other_params = {k: v for k, v in params.items() if k not in ["take_profit", "stop_loss"]}
+
+    result = Backtester(candles, strategy, other_params, params.get("take_profit"), params.get("stop_loss"),
+                        prints=_worker_prints[(start, end)], **backtest_kwargs).run()
+
+    return {"params": params, "start": start, "end": end, **{m: result.metric(m) for m in METRICS}}
+
+
+class Optimizer:
+    def __init__(self, candles: CandleData, strategy: str, param_grid: typing.Dict[str, typing.List],
+                 metric: str = "net_pnl", maximize: bool = True, workers: typing.Optional[int] = None,
+                 backtest_kwargs: typing.Optional[typing.Dict] = None):
+
+        """
+        Grid / random search and walk-forward analysis of the strategy parameters, each backtest running in a pool
+        of worker processes that share the candles through shared memory.
+        :param candles:
+        :param strategy: Technical or Breakout
+        :param param_grid: Values to try for each parameter, e.g. {"ema_fast": [8, 12], "take_profit": [1, 2], ...}
+        :param metric: Used to rank the results, one of METRICS
+        :param maximize: False for metrics where lower is better, like max_drawdown
+        :param workers: Number of processes, all the cores by default
+        :param backtest_kwargs: Other Backtester arguments (balance_pct, fee_rate, slippage...)
+        """
+
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}, must be one of {METRICS}")
+
+        self.candles = candles
+        self.strategy = strategy
+        self.param_grid = param_grid
+        self.metric = metric
+        self.maximize = maximize
+        self.workers = workers or os.cpu_count()
+        self.backtest_kwargs = backtest_kwargs or dict()
+
+    def _grid(self) -> typing.List[typing.Dict]:
+        names = list(self.param_grid.keys())
+        return [dict(zip(names, values)) for values in itertools.product(*self.param_grid.values())]
+
+    def _run(self, runs: typing.List[typing.Tuple[typing.Dict, int, int]]) -> typing.List[typing.Dict]:
+
+        """
+        :param runs: (parameters, start candle, end candle) of each backtest
+        :return: The results, in the same order
+        """
+
+        tasks = [(self.strategy, params, start, end, self.backtest_kwargs) for params, start, end in runs]
+
+        shared_candles = SharedCandles(self.candles)
+
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                        initargs=(shared_candles.name, shared_candles.size)) as pool:
+                # Tasks are sent in batches to limit the inter-process overhead
+                chunk_size = max(1, len(tasks) // (self.workers * 4))
+                results = list(pool.map(_run_backtest, tasks, chunksize=chunk_size))
+        finally:
+            shared_candles.close()
+
+        return results
+
+    def _rank(self, results: typing.List[typing.Dict]) -> typing.List[typing.Dict]:
+        # NaN compares as neither lower nor higher and would break the order, e.g. the sharpe ratio of a flat equity
+        undefined = [r for r in results if math.isnan(r[self.metric])]
+        ranked = sorted([r for r in results if not math.isnan(r[self.metric])], key=lambda r: r[self.metric],
+                        reverse=self.maximize)
+
+        return ranked + undefined
+
+    def grid_search(self, start: int = 0, end: typing.Optional[int] = None) -> typing.List[typing.Dict]:
+
+        """
+        Backtest every combination of the parameter grid.
+        :param start: First candle index of the period
+        :param end: Last candle index (excluded), the end of the data by default
+        :return: The results, best first
+        """
+
+        if end is None:
+            end = len(self.candles)
+
+        return self._rank(self._run([(params, start, end) for params in self._grid()]))
+
+    def random_search(self, n_samples: int, seed: typing.Optional[int] = None, start: int = 0,
+                      end: typing.Optional[int] = None) -> typing.List[typing.Dict]:
+
+        """
+        Backtest n_samples combinations drawn at random from the parameter grid.
+        """
+
+        grid = self._grid()
+        params_list = random.Random(seed).sample(grid, min(n_samples, len(grid)))
+        if end is None:
+            end = len(self.candles)
+
+        return self._rank(self._run([(params, start, end) for params in params_list]))
+
+    def walk_forward(self, n_splits: int, anchored: bool = False,
+                     n_samples: typing.Optional[int] = None) -> typing.List[typing.Dict]:
+
+        """
+        The data is cut in n_splits + 1 periods. For each split, the parameters are optimized on one period (or all
+        the previous ones if anchored) and the best parameters are evaluated on the next period.
+        :param n_splits:
+        :param anchored: The training period always starts at the beginning of the data
+        :param n_samples: Random search with this number of samples instead of the whole grid
+        :return: One result per split: training period and result of the best parameters, test result
+        """
+
+        period = len(self.candles) // (n_splits + 1)
+        train_periods = [(0 if anchored else k * period, (k + 1) * period) for k in range(n_splits)]
+
+        params_list = self._grid()
+        if n_samples is not None:
+            params_list = random.Random(0).sample(params_list, min(n_samples, len(params_list)))
+
+        # All the training backtests run in the same pool, then all the test backtests
+
+        train_results = self._run([(params, start, end) for start, end in train_periods for params in params_list])
+
+        best_results = []
+        for start, end in train_periods:
+            period_results = [r for r in train_results if r['start'] == start and r['end'] == end]
+            best_results.append(self._rank(period_results)[0])
+
+        test_periods = [((k + 1) * period, (k + 2) * period if k < n_splits - 1 else len(self.candles))
+                        for k in range(n_splits)]
+        test_results = self._run([(best['params'], start, end) for best, (start, end)
+                                  in zip(best_results, test_periods)])
+
+        splits = []
+
+        for k, (best, test_result) in enumerate(zip(best_results, test_results)):
+            splits.append({"train": best, "test": test_result})
+
+            logger.info("Walk-forward split %s: %s = %s in training, %s in test with %s", k, self.metric,
+                        best[self.metric], test_result[self.metric], best['params'])
+
+        return splits
@@ -0,0 +1,500 @@
+import collections
+import itertools
+import logging
+import os
+import threading
+import time
+import typing
+
+from models import *
+from events import dispatcher, TimerEvent
+
+if typing.TYPE_CHECKING:
+    from journal import Journal
+    from risk import PortfolioRisk
+
+logger = logging.getLogger()
+
+
+# States an order can go to from each state. The terminal states (filled, canceled, rejected, expired, failed) have
+# no transition, a late update received after them is ignored.
+TRANSITIONS = {
+    "pending": {"submitted", "failed"},
+    "submitted": {"submitted", "new", "partially_filled", "filled", "canceled", "rejected", "expired", "failed"},
+    "new": {"partially_filled", "filled", "canceled", "expired"},
+    "partially_filled": {"partially_filled", "filled", "canceled", "expired"},
+}
+
+# Order statuses of the exchanges (lower case) -> state
+EXCHANGE_STATUSES = {"new": "new", "partially_filled": "partially_filled", "partiallyfilled": "partially_filled",
+                     "filled": "filled", "canceled": "canceled", "cancelled": "canceled", "rejected": "rejected",
+                     "expired": "expired"}
+
+# Unique in the process, and from one process to the other. Binance and Bitmex accept up to 36 characters.
+_client_ids = itertools.count(1)
+_client_id_prefix = f"tb{os.getpid()}x{int(time.time()) % 100000000}x"
+
+
+class Order:
+    def __init__(self, contract: Contract, order_type: str, quantity: float, side: str,
+                 price: typing.Optional[float] = None, tif: typing.Optional[str] = None,
+                 on_update: typing.Optional[typing.Callable[["Order"], None]] = None, template=None,
+                 signal_time: typing.Optional[int] = None):
+
+        """
+        :param template: Order encoded in advance by client.order_template(), only the client order id, the timestamp
+        and the signature are added when it is sent
+        :param signal_time: time.perf_counter_ns() when the strategy decided to trade, for the latency statistics
+        """
+
+        self.client_order_id = _client_id_prefix + str(next(_client_ids))
+        self.contract = contract
+        self.order_type = order_type
+        self.quantity = quantity
+        self.side = side
+        self.price = price
+        self.tif = tif
+        self.on_update = on_update
+        self.template = template
+        self.signal_time = signal_time if signal_time is not None else time.perf_counter_ns()
+
+        self.state = "pending"
+        self.order_id = None  # Exchange order id, known once the order is acknowledged
+        self.avg_price: typing.Optional[float] = None
+        self.filled_quantity = 0.0
+        self.attempts = 0
+
+        self.created = int(time.time() * 1000)
+
+    @property
+    def open(self) -> bool:
+        return self.state in ("submitted", "new", "partially_filled")
+
+    def params(self) -> typing.Dict:
+
+        """
+        The arguments of place_order() / place_orders() of the clients.
+        """
+
+        return {"contract": self.contract, "order_type": self.order_type, "quantity": self.quantity,
+                "side": self.side, "price": self.price, "tif": self.tif, "client_order_id": self.client_order_id}
+
+
+class OrderTicket:
+    def __init__(self, contract: Contract, quantity: float, price: float, templates: typing.Dict[str, typing.Any]):
+
+        """
+        Entry order prepared by a strategy before its signal: the trade size computed with the balance, and the order
+        of each side encoded by the client, ready to be signed.
+        :param contract:
+        :param quantity:
+        :param price: The trade size was computed at this price
+        :param templates: buy / sell -> client.order_template()
+        """
+
+        self.contract = contract
+        self.quantity = quantity
+        self.price = price
+        self.templates = templates
+
+        self.armed = int(time.time() * 1000)
+
+
+class OrderManager:
+    def __init__(self, client, max_retries: int = 3, retry_delay: float = 0.5, poll_interval: float = 2.0,
+                 netting_window: float = 0.0, risk: typing.Optional["PortfolioRisk"] = None,
+                 journal: typing.Optional["Journal"] = None):
+
+        """
+        Places the orders of the strategies of one client and follows each of them through the states of TRANSITIONS.
+        The orders submitted while the dispatcher processes an event (e.g. several exits triggered by the same print)
+        are placed together with client.place_orders(), which uses the batch endpoints of the exchanges.
+        Every order has a client order id: when the exchange response is lost, the order is looked up by that id and
+        only sent again if the exchange doesn't know it, so a retry never places an order twice.
+        :param client: BinanceFuturesClient, BitmexClient, PaperClient or WorkerClient
+        :param max_retries: Number of times an order is sent again before it is considered failed
+        :param retry_delay: In seconds, multiplied by the number of attempts
+        :param poll_interval: In seconds, how often the status of the open orders is requested
+        :param netting_window: In seconds, how long the market orders submitted with submit_netted() are collected,
+        0 for the orders submitted while the dispatcher processes the same event
+        :param risk: Pre-trade checks of the orders, and positions updated with their fills. None for no check
+        :param journal: Records the orders sent and their updates, None for no record
+        """
+
+        self.client = client
+
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+
+        self.orders: typing.Dict[str, Order] = dict()  # Client order id -> order, the open ones
+
+        self._pending: typing.List[Order] = []
+        self._polling = False
+        self.halted = False  # Set by the kill switch, the orders are refused until resume()
+
+        self.risk = risk
+        self.journal = journal
+
+        self.netting_window = netting_window
+        self._intents: typing.Dict[str, typing.List[Order]] = dict()  # Symbol -> orders waiting to be netted
+
+        # Time between the signal of a strategy and the request to the exchange, in microseconds, for the orders
+        # sent from an OrderTicket and for the others
+        self.latencies: typing.Dict[str, typing.Deque[int]] = {"ticket": collections.deque(maxlen=1000),
+                                                                "no_ticket": collections.deque(maxlen=1000)}
+
+        self._lock = threading.Lock()
+
+    def submit(self, contract: Contract, order_type: str, quantity: float, side: str,
+               price: typing.Optional[float] = None, tif: typing.Optional[str] = None,
+               on_update: typing.Optional[typing.Callable[[Order], None]] = None, template=None,
+               signal_time: typing.Optional[int] = None) -> Order:
+
+        """
+        Queue an order, it is sent with the other orders submitted before the dispatcher thread is free again.
+        Can be called from any thread.
+        :param contract:
+        :param order_type: MARKET, LIMIT...
+        :param quantity:
+        :param side: buy or sell
+        :param price:
+        :param tif:
+        :param on_update: Called with the order in the dispatcher thread every time its state changes
+        :param template: See Order
+        :param signal_time: See Order
+        :return:
+        """
+
+        order = Order(contract, order_type, quantity, side, price, tif, on_update, template, signal_time)
+        self._queue(order)
+
+        return order
+
+    def submit_netted(self, contract: Contract, quantity: float, side: str,
+                      on_update: typing.Optional[typing.Callable[[Order], None]] = None, template=None,
+               signal_time: typing.Optional[int] = None) -> Order:
+
+        """
+        Queue a market order that is netted with the other market orders submitted on the contract during the netting
+        window (e.g. several strategies signaling on the same candle close): one order for the net quantity is placed,
+        the buys and sells cancel each other out at its fill price.
+        With a netting window of 0, the orders submitted while the dispatcher processes an event are netted.
+        An order alone in the window is sent as is, from its template if it has one.
+        The order returned is not sent itself, its quantity is updated with its part of the fill when it is filled.
+        :param contract:
+        :param quantity:
+        :param side: buy or sell
+        :param on_update: Called with the order in the dispatcher thread every time its state changes
+        :param template: See Order
+        :param signal_time: See Order
+        :return:
+        """
+
+        order = Order(contract, "MARKET", quantity, side, on_update=on_update, template=template,
+                      signal_time=signal_time)
+
+        with self._lock:
+            intents = self._intents.setdefault(contract.symbol, [])
+            intents.append(order)
+            first = len(intents) == 1
+
+        if first:
+            if self.netting_window > 0:
+                dispatcher.call_later(self.netting_window, lambda: self._net(contract.symbol))
+            else:
+                dispatcher.publish(TimerEvent(lambda: self._net(contract.symbol)))
+
+        return order
+
+    def _net(self, symbol: str):
+        with self._lock:
+            intents = self._intents.pop(symbol, [])
+
+        if len(intents) == 0:
+            return
+
+        if len(intents) == 1:
+            self._queue(intents[0])
+            return
+
+        for order in intents:
+            self._set_state(order, "submitted")
+
+        net_quantity = sum(o.quantity if o.side.lower() == "buy" else -o.quantity for o in intents)
+        contract = intents[0].contract
+
+        if contract.round_quantity(abs(net_quantity)) == 0:  # Nothing to send, the orders offset each other
+            self._allocate(intents, 0, self._mid_price(contract), "rejected")
+            return
+
+        logger.info("%s %s: %s orders netted into one order of %s", self.client.platform, symbol, len(intents),
+                    net_quantity)
+
+        self._queue(Order(contract, "MARKET", abs(net_quantity), "buy" if net_quantity > 0 else "sell",
+                          on_update=lambda net_order: self._on_net_update(net_order, intents),
+                          signal_time=min(o.signal_time for o in intents)))
+
+    def _on_net_update(self, net_order: Order, intents: typing.List[Order]):
+        for order in intents:
+            order.order_id = net_order.order_id
+
+        if net_order.open:
+            for order in intents:
+                self._set_state(order, net_order.state)
+            return
+
+        filled = net_order.quantity if net_order.state == "filled" else net_order.filled_quantity
+        price = net_order.avg_price or self._mid_price(net_order.contract)
+
+        self._allocate(intents, filled, price, net_order.state)
+
+    def _allocate(self, intents: typing.List[Order], filled: float, price: typing.Optional[float],
+                  final_state: str):
+
+        """
+        Split the fill of a net order between the orders netted into it. The side with the smaller total is filled
+        completely against the other side, the other side shares the rest of the fill in proportion to the quantities.
+        :param intents:
+        :param filled: Quantity filled by the net order
+        :param price: Fill price of the net order, the mid price when no order was sent
+        :param final_state: State of the orders that get nothing
+        :return:
+        """
+
+        buys = sum(o.quantity for o in intents if o.side.lower() == "buy")
+        sells = sum(o.quantity for o in intents if o.side.lower() == "sell")
+
+        crossed = min(buys, sells)
+        majority_side = "buy" if buys >= sells else "sell"
+        majority_ratio = (crossed + filled) / max(buys, sells)
+
+        for order in intents:
+            if order.side.lower() == majority_side:
+                quantity = order.contract.round_quantity(order.quantity * majority_ratio)
+            else:
+                quantity = order.quantity
+
+            if quantity > 0 and price is not None:
+                order.quantity = order.filled_quantity = quantity
+                order.avg_price = price
+                if order.order_id is None:
+                    order.order_id = order.client_order_id
+                self._set_state(order, "filled")
+            else:
+                self._set_state(order, final_state if final_state != "filled" else "canceled")
+
+    def _mid_price(self, contract: Contract) -> typing.Optional[float]:
+        prices = self.client.prices.get(contract.symbol) if hasattr(self.client, "prices") else None
+        if prices is None or prices['bid'] is None or prices['ask'] is None:
+            return None
+        return contract.round_price((prices['bid'] + prices['ask']) / 2)
+
+    def halt(self):
+
+        """
+        Refuse all the orders from now on, including the ones waiting to be sent or netted.
+        """
+
+        with self._lock:
+            self.halted = True
+            dropped = self._pending + [o for intents in self._intents.values() for o in intents]
+            self._pending, self._intents = [], dict()
+
+        for order in dropped:
+            dispatcher.publish(TimerEvent(lambda o=order: self._set_state(o, "failed")))
+
+    def resume(self):
+        self.halted = False
+
+    def _queue(self, order: Order):
+        if self.halted:
+            dispatcher.publish(TimerEvent(lambda: self._set_state(order, "failed")))
+            return
+
+        if self.risk is not None and order.attempts == 0:
+            price = order.price
+            if price is None:  # Market order, the checks need a price if no quote was tracked for the contract yet
+                quote = self.client.prices.get(order.contract.symbol, dict())
+                if quote.get('bid') is not None and quote.get('ask') is not None:
+                    price = (quote['bid'] + quote['ask']) / 2
+
+            refusal = self.risk.reserve(self.client.platform, order.contract, order.side, order.quantity,
+                                        order.client_order_id, price)
+            if refusal is not None:
+                logger.warning("%s order %s refused by the risk checks: %s", self.client.platform,
+                               order.client_order_id, refusal)
+                dispatcher.publish(TimerEvent(lambda: self._set_state(order, "failed")))
+                return
+
+        if self.journal is not None and order.attempts == 0:  # The intent is recorded before the order is sent
+            self.journal.record_order(self.client.platform, order)
+
+        with self._lock:
+            self._pending.append(order)
+            first = len(self._pending) == 1
+
+        if first:
+            dispatcher.publish(TimerEvent(self._flush))
+
+    def _flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+
+        for order in batch:
+            order.attempts += 1
+            self._set_state(order, "submitted")
+            self.orders[order.client_order_id] = order
+
+        # The orders prepared in advance are sent on their own, the others together
+
+        for order in batch:
+            if order.template is not None:
+                dispatcher.run_blocking(lambda o=order: self._send_template(o),
+                                        lambda order_status, o=order: self._on_placed([o], [order_status]))
+
+        batch = [order for order in batch if order.template is None]
+        if len(batch) == 0:
+            return
+
+        dispatcher.run_blocking(lambda: self._send_batch(batch), lambda statuses: self._on_placed(batch, statuses))
+
+    def _send_template(self, order: Order) -> typing.Optional[OrderStatus]:
+        if order.attempts == 1:
+            self.latencies["ticket"].append((time.perf_counter_ns() - order.signal_time) // 1000)
+        return self.client.place_order_template(order.template, order.client_order_id)
+
+    def _send_batch(self, batch: typing.List[Order]) -> typing.Optional[typing.List[OrderStatus]]:
+        now = time.perf_counter_ns()
+        for order in batch:
+            if order.attempts == 1:
+                self.latencies["no_ticket"].append((now - order.signal_time) // 1000)
+
+        return self.client.place_orders([order.params() for order in batch])
+
+    def latency_report(self) -> typing.Dict[str, typing.Dict[str, int]]:
+
+        """
+        :return: Median, 99th percentile and maximum signal-to-send latency of the last orders sent with and without
+        an OrderTicket, in microseconds. Only the first attempt of each order is counted.
+        """
+
+        report = dict()
+
+        for path, latencies in self.latencies.items():
+            values = sorted(latencies)
+            if len(values) > 0:
+                report[path] = {"median": values[len(values) // 2], "p99": values[int(len(values) * 0.99)],
+                                "max": values[-1]}
+
+        return report
+
+    def _on_placed(self, batch: typing.List[Order], statuses: typing.Optional[typing.List[OrderStatus]]):
+        if statuses is None:
+            statuses = [None] * len(batch)
+
+        for order, order_status in zip(batch, statuses):
+            if order_status is not None:
+                self._update(order, order_status)
+            else:
+                self._recover(order)
+
+        self._start_polling()
+
+    def _recover(self, order: Order):
+
+        """
+        The response for the order is lost: look it up with its client order id, send it again only if the exchange
+        answers that it doesn't exist. A failed lookup says nothing about the order, it is tried again.
+        """
+
+        def on_lookup(result: typing.Tuple[typing.Optional[bool], typing.Optional[OrderStatus]]):
+            exists, order_status = result
+
+            if exists:
+                self._update(order, order_status)
+            elif exists is None:
+                logger.warning("%s order %s: lookup failed, trying again", self.client.platform,
+                               order.client_order_id)
+                dispatcher.call_later(self.retry_delay, lambda: self._recover(order))
+            elif order.attempts > self.max_retries:
+                logger.error("%s order %s failed after %s attempts", self.client.platform, order.client_order_id,
+                             order.attempts)
+                self._set_state(order, "failed")
+            else:
+                logger.warning("%s order %s not placed, trying again", self.client.platform, order.client_order_id)
+                dispatcher.call_later(self.retry_delay * order.attempts, lambda: self._queue(order))
+
+        # A worker client returns None when the call fails in the main process
+        dispatcher.run_blocking(lambda: self.client.find_order(order.contract, order.client_order_id) or (None, None),
+                                on_lookup)
+
+    def _update(self, order: Order, order_status: OrderStatus):
+        state = EXCHANGE_STATUSES.get(order_status.status)
+        if state is None:
+            logger.warning("%s order %s: unknown status %s", self.client.platform, order.client_order_id,
+                           order_status.status)
+            return
+
+        if order_status.order_id is not None:
+            order.order_id = order_status.order_id
+        if order_status.avg_price:
+            order.avg_price = order_status.avg_price
+        order.filled_quantity = order_status.executed_qty
+
+        if self.risk is not None:
+            self.risk.on_fill(order.client_order_id, order.filled_quantity, order.avg_price)
+
+        self._set_state(order, state)
+
+    def _set_state(self, order: Order, state: str):
+        if state == order.state and state != "partially_filled":
+            return
+
+        if state not in TRANSITIONS.get(order.state, set()):
+            logger.warning("%s order %s: invalid transition from %s to %s", self.client.platform,
+                           order.client_order_id, order.state, state)
+            return
+
+        order.state = state
+
+        if self.journal is not None and order.attempts > 0:  # Not the orders netted into another one, never sent
+            self.journal.record_order(self.client.platform, order)
+
+        if not order.open:
+            self.orders.pop(order.client_order_id, None)
+            if self.risk is not None:
+                self.risk.release(order.client_order_id)
+
+        if order.on_update is not None and state != "submitted":
+            try:
+                order.on_update(order)
+            except Exception as e:
+                logger.error("Error in the update callback of order %s: %s", order.client_order_id, e)
+
+    def _start_polling(self):
+        if not self._polling and len(self.orders) > 0:
+            self._polling = True
+            dispatcher.call_later(self.poll_interval, self._poll)
+
+    def _poll(self):
+
+        """
+        Request the status of the acknowledged orders that are still open.
+        """
+
+        self._polling = False
+
+        for order in list(self.orders.values()):
+            if order.state in ("new", "partially_filled"):
+                self._request_status(order)
+
+        self._start_polling()
+
+    def _request_status(self, order: Order):
+        def on_status(order_status: typing.Optional[OrderStatus]):
+            if order_status is not None:
+                self._update(order, order_status)
+
+        dispatcher.run_blocking(lambda: self.client.get_order_status(order.contract, order.order_id,
+                                                                     order.client_order_id), on_status)
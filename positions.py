@@ -0,0 +1,167 @@
+import threading
+import typing
+
+import numpy as np
+
+from models import *
+
+if typing.TYPE_CHECKING:
+    from strategies import Strategy
+
+
+class PositionTable:
+    def __init__(self, capacity: int = 16):
+
+        """
+        Open trades of one symbol stored as columns, so all of them are marked to market with one vectorized
+        expression per quote, for linear and inverse contracts alike.
+        Rows are not ordered: a closed trade is replaced by the last row.
+        :param capacity: Initial number of rows, doubled when full
+        """
+
+        self._size = 0
+
+        self._side = np.zeros(capacity, dtype=np.int8)  # 1 long, -1 short
+        self._entry_price = np.zeros(capacity)
+        self._quantity = np.zeros(capacity)
+        self._multiplier = np.zeros(capacity)
+        self._inverse = np.zeros(capacity, dtype=bool)
+        self._strategy_index = np.zeros(capacity, dtype=np.int64)
+        self.pnl = np.zeros(capacity)
+
+        self._trades: typing.List[Trade] = []
+        self._rows: typing.Dict[int, int] = dict()  # id(trade) -> row
+
+        self._strategies: typing.List["Strategy"] = []
+
+        self.total_pnl = 0.0
+
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _grow(self):
+        for name in ["_side", "_entry_price", "_quantity", "_multiplier", "_inverse", "_strategy_index", "pnl"]:
+            column = getattr(self, name)
+            new_column = np.zeros(len(column) * 2, dtype=column.dtype)
+            new_column[:len(column)] = column
+            setattr(self, name, new_column)
+
+    def add(self, strategy: "Strategy", trade: Trade):
+
+        """
+        Add a trade whose entry price is known. From now on trade.pnl reads its row of the table.
+        :param strategy:
+        :param trade:
+        :return:
+        """
+
+        with self._lock:
+            if id(trade) in self._rows:
+                return
+
+            if self._size == len(self._side):
+                self._grow()
+
+            if strategy not in self._strategies:
+                self._strategies.append(strategy)
+
+            row = self._size
+
+            self._side[row] = 1 if trade.side == "long" else -1
+            self._entry_price[row] = trade.entry_price
+            self._quantity[row] = trade.quantity
+            self._multiplier[row] = trade.contract.multiplier
+            self._inverse[row] = trade.contract.inverse
+            self._strategy_index[row] = self._strategies.index(strategy)
+            self.pnl[row] = trade.pnl
+
+            self._trades.append(trade)
+            self._rows[id(trade)] = row
+            self._size += 1
+
+            trade.position_table = self
+
+    def remove(self, trade: Trade):
+
+        """
+        Remove a closed trade, its last PnL value is copied back to the trade.
+        :param trade:
+        :return:
+        """
+
+        with self._lock:
+            self._remove(trade)
+
+    def remove_strategy(self, strategy: "Strategy"):
+        with self._lock:
+            for trade in [t for t in self._trades if t in strategy.trades]:
+                self._remove(trade)
+
+            if strategy in self._strategies:
+                index = self._strategies.index(strategy)
+                self._strategies.pop(index)
+
+                strategy_index = self._strategy_index[:self._size]
+                strategy_index[strategy_index > index] -= 1
+
+    def _remove(self, trade: Trade):
+        row = self._rows.pop(id(trade), None)
+        if row is None:
+            return
+
+        trade.position_table = None
+        trade.pnl = float(self.pnl[row])
+
+        last = self._size - 1
+
+        if row != last:
+            for column in [self._side, self._entry_price, self._quantity, self._multiplier, self._inverse,
+                           self._strategy_index, self.pnl]:
+                column[row] = column[last]
+
+            self._trades[row] = self._trades[last]
+            self._rows[id(self._trades[row])] = row
+
+        self._trades.pop()
+        self._size -= 1
+
+    def pnl_of(self, trade: Trade) -> typing.Optional[float]:
+        with self._lock:  # A removal moves the last row
+            row = self._rows.get(id(trade))
+            return float(self.pnl[row]) if row is not None else None
+
+    def revalue(self, bid: float, ask: float) -> float:
+
+        """
+        Mark all the open trades to market: longs are valued at the bid and shorts at the ask.
+        The unrealized PnL of each strategy is updated in the same pass.
+        :param bid:
+        :param ask:
+        :return: Change of the total unrealized PnL of the table, to update the exchange total
+        """
+
+        with self._lock:
+            n = self._size
+
+            if n == 0 and self.total_pnl == 0:
+                return 0.0
+
+            side = self._side[:n]
+            entry_price = self._entry_price[:n]
+            price = np.where(side == 1, bid, ask)
+
+            pnl = np.where(self._inverse[:n], 1 / entry_price - 1 / price, price - entry_price)
+            self.pnl[:n] = side * pnl * self._multiplier[:n] * self._quantity[:n]
+
+            strategy_pnl = np.bincount(self._strategy_index[:n], weights=self.pnl[:n],
+                                       minlength=len(self._strategies))
+            for index, strategy in enumerate(self._strategies):
+                strategy.unrealized_pnl = float(strategy_pnl[index])
+
+            total_pnl = float(strategy_pnl.sum())
+            change = total_pnl - self.total_pnl
+            self.total_pnl = total_pnl
+
+        return change
@@ -0,0 +1,191 @@
+import logging
+import mmap
+import os
+import typing
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger()
+
+
+# Record layouts of the market data buffers. The symbol is the index of the contract in the symbol table shared by the
+# writer and the readers. Every record starts with its sequence number.
+
+TRADE_DTYPE = np.dtype([("seq", np.int64), ("symbol", np.int32), ("timestamp", np.int64), ("price", np.float64),
+                        ("quantity", np.float64)])
+
+QUOTE_DTYPE = np.dtype([("seq", np.int64), ("symbol", np.int32), ("timestamp", np.int64), ("bid", np.float64),
+                        ("ask", np.float64)])
+
+# The forming candle is published on every update, closed is 1 for its last version
+CANDLE_DTYPE = np.dtype([("seq", np.int64), ("symbol", np.int32), ("timestamp", np.int64), ("open", np.float64),
+                         ("high", np.float64), ("low", np.float64), ("close", np.float64), ("volume", np.float64),
+                         ("closed", np.int8)])
+
+HEADER_SIZE = 64  # Write sequence number, capacity and record size, alone on their cache line
+
+
+class RingBuffer:
+    def __init__(self, dtype: np.dtype, capacity: int, name: typing.Optional[str] = None,
+                 path: typing.Optional[str] = None):
+
+        """
+        Fixed-size records in shared memory, written by one process and read by any number of processes without
+        locks: the writer fills the record, then publishes it by incrementing the write sequence number in the header.
+        Each reader keeps its own read sequence number. A reader that falls more than `capacity` records behind has
+        lost the oldest ones, read() skips them and counts them in `lost`.
+        :param dtype: Numpy structured type of the records, its first field must be "seq"
+        :param capacity: Number of records, a power of 2
+        :param name: Name of an existing buffer to attach to, a new buffer is created when None
+        :param path: Memory-mapped file holding the buffer instead of an anonymous shared memory block, so other
+        programs can open it with open_file(). The file is created when name is None
+        """
+
+        if capacity & (capacity - 1) != 0:
+            raise ValueError(f"The capacity of a RingBuffer must be a power of 2, not {capacity}")
+
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self._mask = capacity - 1
+
+        self._owner = name is None
+        self._shm: typing.Optional[shared_memory.SharedMemory] = None
+        self._mmap: typing.Optional[mmap.mmap] = None
+        self.path = path
+
+        size = HEADER_SIZE + capacity * self.dtype.itemsize
+
+        if path is not None:
+            if self._owner:
+                with open(path, "wb") as f:
+                    f.truncate(size)
+            with open(path, "r+b") as f:
+                self._mmap = mmap.mmap(f.fileno(), size)
+            buffer = self._mmap
+        elif self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            buffer = self._shm.buf
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            buffer = self._shm.buf
+
+        self._header = np.ndarray(3, dtype=np.int64, buffer=buffer)
+        self._records = np.ndarray(capacity, dtype=self.dtype, buffer=buffer, offset=HEADER_SIZE)
+
+        if self._owner:
+            self._header[:] = [0, capacity, self.dtype.itemsize]
+
+        self.lost = 0
+
+    @classmethod
+    def open_file(cls, path: str, dtype: np.dtype) -> "RingBuffer":
+
+        """
+        Attach to a buffer created in a file by another process, the capacity is read from its header.
+        """
+
+        with open(path, "rb") as f:
+            capacity, itemsize = np.frombuffer(f.read(24), dtype=np.int64)[1:]
+
+        if itemsize != np.dtype(dtype).itemsize:
+            raise ValueError(f"{path} holds records of {itemsize} bytes, not {np.dtype(dtype).itemsize}")
+
+        return cls(dtype, int(capacity), name=os.path.basename(path), path=path)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name if self._shm is not None else os.path.basename(self.path)
+
+    def descriptor(self) -> typing.Tuple[np.dtype, int, str, typing.Optional[str]]:
+
+        """
+        What another process needs to attach to the buffer: RingBuffer(*descriptor)
+        """
+
+        return self.dtype, self.capacity, self.name, self.path
+
+    @property
+    def write_seq(self) -> int:
+        return int(self._header[0])
+
+    def publish(self, *values):
+
+        """
+        Write one record, only one process may write to a buffer.
+        :param values: The fields of the record after "seq"
+        :return:
+        """
+
+        seq = int(self._header[0])
+        self._records[seq & self._mask] = (seq, *values)
+        self._header[0] = seq + 1
+
+    def read(self, seq: int, max_records: typing.Optional[int] = None) -> typing.Tuple[np.ndarray, int]:
+
+        """
+        The records published since `seq`, as a view of the shared memory (no copy). When the new records wrap around
+        the end of the buffer only the part before the end is returned, the next call returns the rest.
+        The view is valid until the writer laps it, check overrun() if the records are kept.
+        :param seq: Read sequence number of the reader, 0 for the first call
+        :param max_records:
+        :return: The records and the next read sequence number
+        """
+
+        write_seq = int(self._header[0])
+
+        if write_seq - seq > self.capacity:
+            self.lost += write_seq - self.capacity - seq
+            logger.warning("Ring buffer %s: reader lapped, %s records lost", self.name, write_seq - self.capacity - seq)
+            seq = write_seq - self.capacity
+
+        count = write_seq - seq
+        if max_records is not None:
+            count = min(count, max_records)
+
+        start = seq & self._mask
+        count = min(count, self.capacity - start)
+
+        return self._records[start:start + count], seq + count
+
+    def read_copy(self, seq: int, max_records: typing.Optional[int] = None) -> typing.Tuple[np.ndarray, int]:
+
+        """
+        Like read() but the records are copied out of the shared memory, for a reader that may be lapped while it
+        processes them. The write sequence number is checked again after the copy: the records whose slot the writer
+        has reached in the meantime may be torn, they are dropped and counted in `lost`.
+        :param seq:
+        :param max_records:
+        :return: The records and the next read sequence number
+        """
+
+        records, next_seq = self.read(seq, max_records)
+        first_seq = next_seq - len(records)
+        records = records.copy()
+
+        # The slot of the record s is written again by the publish of s + capacity
+        torn = min(max(int(self._header[0]) - self.capacity - first_seq + 1, 0), len(records))
+        if torn > 0:
+            self.lost += torn
+            logger.warning("Ring buffer %s: reader lapped during the copy, %s records lost", self.name, torn)
+            records = records[torn:]
+
+        return records, next_seq
+
+    def overrun(self, seq: int) -> bool:
+
+        """
+        True if the record `seq` has been overwritten since it was read.
+        """
+
+        return int(self._header[0]) - seq > self.capacity
+
+    def close(self):
+        del self._header, self._records
+        if self._mmap is not None:
+            self._mmap.close()
+        else:
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
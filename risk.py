@@ -0,0 +1,455 @@
+import logging
+import threading
+import typing
+
+from models import *
+from events import dispatcher, QuoteEvent, OrderUpdateEvent
+
+if typing.TYPE_CHECKING:
+    from strategies import Strategy
+
+logger = logging.getLogger()
+
+
+# The same asset is not named the same way on every exchange
+ASSET_ALIASES = {"XBT": "BTC"}
+
+TOTALS = ["exposure", "gross_exposure", "margin", "unrealized_pnl"]
+
+# Contract giving the price of the settlement currency of the quanto and inverse contracts of an exchange (XBT)
+SETTLEMENT_SYMBOLS = {"bitmex": "XBTUSD"}
+
+
+class AssetRisk:
+    def __init__(self, platform: str, contract: Contract):
+
+        """
+        Net position of a contract on an exchange, made of the fills of the orders that went through the risk checks.
+        All the values are in USD / USDT, the reporting currency of the portfolio: the PnL of the inverse contracts
+        and the values of the quanto contracts, in XBT, are converted at the current XBT price.
+        """
+
+        self.platform = platform
+        self.contract = contract
+        self.asset = ASSET_ALIASES.get(contract.base_asset, contract.base_asset)
+
+        self.quantity = 0.0  # Filled, signed, negative when short
+        self.pending = 0.0  # Signed quantity of the orders sent and not filled yet
+        self.entry_value = 0.0  # Average entry price, or average 1 / entry price for inverse contracts
+
+        self.bid: typing.Optional[float] = None
+        self.ask: typing.Optional[float] = None
+        self.price: typing.Optional[float] = None  # Mid price
+
+        # Current contribution to the totals of the exchange and of the portfolio
+
+        self.exposure = 0.0  # Signed notional value of the position
+        self.gross_exposure = 0.0  # Notional value of the position and of the pending orders, for the checks
+        self.margin = 0.0
+        self.unrealized_pnl = 0.0
+
+    def notional(self, quantity: float, price: typing.Optional[float],
+                 settlement_price: typing.Optional[float]) -> float:
+
+        """
+        :param settlement_price: Price of the settlement currency, for the quanto contracts
+        """
+
+        if self.contract.inverse:
+            return quantity * self.contract.multiplier  # Contracts worth a fixed amount of the quote currency
+        if price is None:
+            return 0.0
+        if self.contract.quanto:
+            if settlement_price is None:
+                return 0.0
+            return quantity * price * self.contract.multiplier * settlement_price
+        return quantity * price * self.contract.multiplier
+
+    def pnl(self, price: typing.Optional[float], settlement_price: typing.Optional[float]) -> float:
+        if price is None or self.quantity == 0:
+            return 0.0
+        if self.contract.inverse:  # In the base currency, converted at the price of the contract
+            return (self.entry_value - 1 / price) * self.quantity * self.contract.multiplier * price
+        pnl = (price - self.entry_value) * self.quantity * self.contract.multiplier
+        if self.contract.quanto:
+            return pnl * settlement_price if settlement_price is not None else 0.0
+        return pnl
+
+
+class Reservation:
+    def __init__(self, asset: AssetRisk, quantity: float, opening: bool):
+
+        """
+        An order in flight: its quantity counts in the exposure of the checks until it is filled or done.
+        :param quantity: Signed
+        :param opening: The order increases the position, it counts as a new trade until the exchange acknowledges it
+        """
+
+        self.asset = asset
+        self.quantity = quantity
+        self.opening = opening
+
+        self.filled = 0.0
+        self.filled_value = 0.0  # Sum of the fill prices weighted by the quantities, for the price of each fill
+
+
+class PortfolioRisk:
+    def __init__(self, max_exposure: typing.Optional[float] = None, max_open_trades: typing.Optional[int] = None,
+                 symbol_caps: typing.Optional[typing.Dict[str, float]] = None,
+                 leverage: typing.Optional[typing.Dict[str, float]] = None):
+
+        """
+        Net exposure, margin usage and unrealized PnL of every contract, exchange and asset, maintained incrementally:
+        a fill or a quote only updates its contract and adds the differences to the totals, so the pre-trade checks
+        read a few numbers whatever the number of positions and strategies.
+        The orders of the OrderManagers created with this engine are checked before being sent, the orders that only
+        reduce a position (exits, kill switch) are always accepted.
+        :param max_exposure: Gross notional value of all the positions and pending orders, None for no limit
+        :param max_open_trades: Number of open trades of the live strategies, None for no limit
+        :param symbol_caps: Symbol -> maximum notional value of its position on an exchange
+        :param leverage: Platform -> leverage of its positions, for the margin usage, 1 by default
+        """
+
+        self.max_exposure = max_exposure
+        self.max_open_trades = max_open_trades
+        self.symbol_caps = symbol_caps or dict()
+        self.leverage = leverage or dict()
+
+        self.assets: typing.Dict[typing.Tuple[str, str], AssetRisk] = dict()  # (platform, symbol) -> position
+
+        self.totals = {name: 0.0 for name in TOTALS}
+        self.exchange_totals: typing.Dict[str, typing.Dict[str, float]] = dict()
+        self.asset_exposure: typing.Dict[str, float] = dict()  # BTC, ETH... -> net exposure on all the exchanges
+
+        self.open_trades = 0
+        self._open_trade_ids: typing.Set[int] = set()
+        self._opening_orders = 0
+
+        self._reservations: typing.Dict[str, Reservation] = dict()  # Client order id -> order in flight
+
+        # Platform -> price of its settlement currency, and its bid / ask
+        self.settlement_prices: typing.Dict[str, float] = dict()
+        self._settlement_quotes: typing.Dict[str, typing.List[typing.Optional[float]]] = dict()
+
+        self._lock = threading.Lock()
+
+        dispatcher.subscribe(QuoteEvent, self._on_quote)
+        dispatcher.subscribe(OrderUpdateEvent, self._on_trade_update)
+
+    def _asset(self, platform: str, contract: Contract) -> AssetRisk:
+        asset = self.assets.get((platform, contract.symbol))
+
+        if asset is None:
+            asset = AssetRisk(platform, contract)
+            self.assets[(platform, contract.symbol)] = asset
+            self.exchange_totals.setdefault(platform, {name: 0.0 for name in TOTALS})
+
+        return asset
+
+    def watch(self, platform: str, contract: Contract):
+
+        """
+        Track the quotes of a contract before its first order, called when a live strategy starts on it: the market
+        orders have no price of their own for the checks.
+        """
+
+        with self._lock:
+            self._asset(platform, contract)
+
+    def _revalue(self, asset: AssetRisk):
+
+        """
+        Compute the contribution of a contract again and add its changes to the totals, in constant time.
+        Must be called with the lock.
+        """
+
+        price = asset.price
+
+        if price is not None and asset.quantity != 0 and asset.entry_value == 0:
+            # Position found on the exchange at startup, its PnL is counted from the first price
+            asset.entry_value = 1 / price if asset.contract.inverse else price
+
+        settlement_price = self.settlement_prices.get(asset.platform)
+
+        exposure = asset.notional(asset.quantity, price, settlement_price)
+        gross_exposure = abs(asset.notional(asset.quantity + asset.pending, price, settlement_price))
+        margin = abs(exposure) / self.leverage.get(asset.platform, 1)
+        unrealized_pnl = asset.pnl(price, settlement_price)
+
+        exposure_change = exposure - asset.exposure
+        gross_exposure_change = gross_exposure - asset.gross_exposure
+        margin_change = margin - asset.margin
+        pnl_change = unrealized_pnl - asset.unrealized_pnl
+
+        for totals in (self.totals, self.exchange_totals[asset.platform]):
+            totals["exposure"] += exposure_change
+            totals["gross_exposure"] += gross_exposure_change
+            totals["margin"] += margin_change
+            totals["unrealized_pnl"] += pnl_change
+
+        self.asset_exposure[asset.asset] = self.asset_exposure.get(asset.asset, 0.0) + exposure_change
+
+        asset.exposure = exposure
+        asset.gross_exposure = gross_exposure
+        asset.margin = margin
+        asset.unrealized_pnl = unrealized_pnl
+
+    def reserve(self, platform: str, contract: Contract, side: str, quantity: float, client_order_id: str,
+                price: typing.Optional[float] = None) -> typing.Optional[str]:
+
+        """
+        Pre-trade checks of an order, its quantity is reserved when it is accepted. Constant time, can be called from
+        any thread. Reserving an order a second time (a retry with the same client order id) accepts it again.
+        :param platform:
+        :param contract:
+        :param side: buy or sell
+        :param quantity:
+        :param client_order_id:
+        :param price: Limit price, or the last price known by the client for a market order, used when no quote was
+        received for the contract yet
+        :return: Why the order is refused, None when it is accepted
+        """
+
+        signed_quantity = quantity if side.lower() == "buy" else -quantity
+
+        with self._lock:
+            if client_order_id in self._reservations:
+                return None
+
+            asset = self._asset(platform, contract)
+
+            committed = asset.quantity + asset.pending
+            new_committed = committed + signed_quantity
+            opening = abs(new_committed) > abs(committed)
+
+            if opening:
+                mark_price = asset.price if asset.price is not None else price
+                cap = self.symbol_caps.get(contract.symbol)
+
+                # Without a limit on the notional values the order can be checked without a price
+                if (self.max_exposure is not None or cap is not None) and not contract.inverse:
+                    if mark_price is None:
+                        return f"no price for {contract.symbol} yet"
+                    if contract.quanto and platform not in self.settlement_prices:
+                        return f"no price for the settlement currency of {contract.symbol} yet"
+
+                settlement_price = self.settlement_prices.get(platform)
+                new_gross_exposure = abs(asset.notional(new_committed, mark_price, settlement_price))
+
+                if cap is not None and new_gross_exposure > cap:
+                    return f"{contract.symbol} exposure of {round(new_gross_exposure, 2)} above its cap of {cap}"
+
+                total = self.totals["gross_exposure"] - asset.gross_exposure + new_gross_exposure
+                if self.max_exposure is not None and total > self.max_exposure:
+                    return f"total exposure of {round(total, 2)} above the maximum of {self.max_exposure}"
+
+                if self.max_open_trades is not None and self.open_trades + self._opening_orders >= self.max_open_trades:
+                    return f"already {self.open_trades + self._opening_orders} open trades"
+
+                self._opening_orders += 1
+
+            self._reservations[client_order_id] = Reservation(asset, signed_quantity, opening)
+
+            asset.pending += signed_quantity
+            self._revalue(asset)
+
+        return None
+
+    def on_fill(self, client_order_id: str, filled: float, avg_price: typing.Optional[float]):
+
+        """
+        Update of a reserved order: the quantity filled since the previous update moves from the pending orders to
+        the position. Once the exchange knows the order, it no longer counts as a new trade: the strategy has its
+        trade.
+        :param client_order_id:
+        :param filled: Total filled quantity of the order
+        :param avg_price: Average price of the fills of the order
+        :return:
+        """
+
+        with self._lock:
+            reservation = self._reservations.get(client_order_id)
+            if reservation is None:
+                return
+
+            if reservation.opening:
+                reservation.opening = False
+                self._opening_orders -= 1
+
+            quantity = filled - reservation.filled
+            if quantity <= 0 or not avg_price:
+                return
+
+            fill_price = (avg_price * filled - reservation.filled_value) / quantity
+            reservation.filled = filled
+            reservation.filled_value = avg_price * filled
+
+            asset = reservation.asset
+            signed_quantity = quantity if reservation.quantity > 0 else -quantity
+
+            reservation.quantity -= signed_quantity
+            asset.pending -= signed_quantity
+
+            self._add_fill(asset, signed_quantity, fill_price)
+            if asset.price is None:  # No quote received yet for the contract
+                asset.price = fill_price
+            self._revalue(asset)
+
+    @staticmethod
+    def _add_fill(asset: AssetRisk, quantity: float, price: float):
+
+        """
+        Same netting as the PaperPosition: a fill reduces the position first, the rest opens a position at the fill
+        price.
+        """
+
+        value = 1 / price if asset.contract.inverse else price
+
+        if asset.quantity != 0 and (asset.quantity > 0) != (quantity > 0):
+            closed = min(abs(asset.quantity), abs(quantity))
+            side = 1 if asset.quantity > 0 else -1
+
+            asset.quantity -= side * closed
+            quantity += side * closed
+
+            if asset.quantity == 0:
+                asset.entry_value = 0.0
+
+        if quantity != 0:
+            total = abs(asset.quantity) + abs(quantity)
+            asset.entry_value = (asset.entry_value * abs(asset.quantity) + value * abs(quantity)) / total
+            asset.quantity += quantity
+
+    def release(self, client_order_id: str):
+
+        """
+        The order is done (filled, canceled, rejected, failed...): its unfilled quantity is no longer reserved.
+        """
+
+        with self._lock:
+            reservation = self._reservations.pop(client_order_id, None)
+            if reservation is None:
+                return
+
+            if reservation.opening:
+                self._opening_orders -= 1
+
+            reservation.asset.pending -= reservation.quantity
+            self._revalue(reservation.asset)
+
+    def positions(self, platform: str) -> typing.Dict[str, float]:
+
+        """
+        :return: Symbol -> quantity of the open positions of an exchange, as tracked from the fills
+        """
+
+        with self._lock:
+            return {symbol: asset.quantity for (asset_platform, symbol), asset in self.assets.items()
+                    if asset_platform == platform and asset.quantity != 0}
+
+    def set_positions(self, platform: str, positions: typing.Dict[str, float], contracts: typing.Dict[str, Contract]):
+
+        """
+        Replace the positions of an exchange with the ones it reports, at startup or after the kill switch.
+        :param platform:
+        :param positions: Symbol -> quantity, negative when short
+        :param contracts:
+        :return:
+        """
+
+        with self._lock:
+            for (asset_platform, symbol), asset in self.assets.items():
+                if asset_platform == platform and symbol not in positions:
+                    asset.quantity = 0.0
+                    asset.entry_value = 0.0
+                    self._revalue(asset)
+
+            for symbol, quantity in positions.items():
+                if symbol not in contracts:
+                    continue
+
+                asset = self._asset(platform, contracts[symbol])
+                if asset.quantity != quantity:
+                    asset.quantity = quantity
+                    asset.entry_value = 0.0
+                self._revalue(asset)
+
+    def _on_quote(self, event: QuoteEvent):
+        if SETTLEMENT_SYMBOLS.get(event.source) == event.symbol:
+            self._update_settlement_price(event)
+
+        asset = self.assets.get((event.source, event.symbol))
+        if asset is None:
+            return
+
+        with self._lock:
+            if event.bid is not None:
+                asset.bid = event.bid
+            if event.ask is not None:
+                asset.ask = event.ask
+
+            if asset.bid is None or asset.ask is None:
+                return
+
+            asset.price = (asset.bid + asset.ask) / 2
+
+            if asset.quantity != 0 or asset.pending != 0 or asset.exposure != 0:
+                self._revalue(asset)
+
+    def _update_settlement_price(self, event: QuoteEvent):
+
+        """
+        The values of the quanto contracts of the exchange change with the price of its settlement currency.
+        """
+
+        quote = self._settlement_quotes.setdefault(event.source, [None, None])
+        if event.bid is not None:
+            quote[0] = event.bid
+        if event.ask is not None:
+            quote[1] = event.ask
+
+        if quote[0] is None or quote[1] is None:
+            return
+
+        with self._lock:
+            self.settlement_prices[event.source] = (quote[0] + quote[1]) / 2
+
+            for (platform, _), asset in self.assets.items():
+                if platform == event.source and asset.contract.quanto and (asset.quantity != 0 or asset.pending != 0):
+                    self._revalue(asset)
+
+    def _on_trade_update(self, event: OrderUpdateEvent):
+        if not self._is_live(event.strategy):
+            return
+
+        with self._lock:
+            if event.trade.status == "open":
+                self._open_trade_ids.add(id(event.trade))
+            else:
+                self._open_trade_ids.discard(id(event.trade))
+
+            self.open_trades = len(self._open_trade_ids)
+
+    @staticmethod
+    def _is_live(strategy: "Strategy") -> bool:
+
+        """
+        The paper trading strategies have their own order manager, without risk checks, their trades are not counted.
+        """
+
+        client = getattr(strategy, "client", None)
+        return client is None or getattr(client.orders, "risk", None) is not None  # RemoteStrategy: always live
+
+    def report(self) -> typing.Dict:
+
+        """
+        :return: The totals of the portfolio, of each exchange and the net exposure of each asset
+        """
+
+        with self._lock:
+            return {"portfolio": dict(self.totals), "open_trades": self.open_trades,
+                    "exchanges": {platform: dict(totals) for platform, totals in self.exchange_totals.items()},
+                    "assets": dict(self.asset_exposure)}
+
+
+portfolio_risk = PortfolioRisk()
@@ -0,0 +1,126 @@
+import logging
+import os
+import threading
+import time
+import typing
+
+logger = logging.getLogger()
+
+
+class Timer:
+    def __init__(self, deadline: int, callback: typing.Callable):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    def __init__(self, tick_ms: int = 10, slots: int = 4096):
+
+        """
+        Hashed timing wheel: the timers are stored in the slot of their deadline tick, so adding a timer is O(1) and
+        each tick only looks at one slot. Timers further than one rotation stay in their slot until their deadline.
+        One thread runs all the timers, instead of one threading.Timer thread per timer.
+        :param tick_ms: Resolution of the wheel in milliseconds
+        :param slots: Number of slots of the wheel
+        """
+
+        self._tick_ms = tick_ms
+        self._slots: typing.List[typing.List[Timer]] = [[] for _ in range(slots)]
+
+        self._current_tick = self._now() // tick_ms
+
+        self._lock = threading.Lock()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    @staticmethod
+    def _now() -> int:
+        return int(time.time() * 1000)
+
+    def call_at(self, timestamp: int, callback: typing.Callable, clock_offset: int = 0) -> Timer:
+
+        """
+        Run the callback at a given time.
+        :param timestamp: Unix timestamp in milliseconds, in the clock of an exchange if clock_offset is set
+        :param callback: Called from the wheel thread, it should not block
+        :param clock_offset: Exchange server time - local time, in milliseconds
+        :return: The timer, can be cancelled
+        """
+
+        timer = Timer(timestamp - clock_offset, callback)
+
+        with self._lock:
+            tick = max(-(-timer.deadline // self._tick_ms), self._current_tick + 1)  # First tick >= the deadline
+            self._slots[tick % len(self._slots)].append(timer)
+
+        if self._thread is None:
+            self._start()
+
+        return timer
+
+    def call_later(self, delay: float, callback: typing.Callable) -> Timer:
+
+        """
+        :param delay: In seconds, like threading.Timer
+        :param callback:
+        :return:
+        """
+
+        return self.call_at(self._now() + int(delay * 1000), callback)
+
+    def _after_fork(self):
+
+        """
+        The wheel thread does not exist in a child process, the child starts its own with its first timer. The timers
+        of the parent are dropped.
+        """
+
+        self._slots = [[] for _ in range(len(self._slots))]
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            now_tick = self._now() // self._tick_ms
+
+            while self._current_tick < now_tick:
+                self._process_next_tick()
+
+            next_tick_time = (self._current_tick + 1) * self._tick_ms
+            time.sleep(max(next_tick_time - self._now(), 0) / 1000)
+
+    def _process_next_tick(self):
+        with self._lock:
+            self._current_tick += 1
+            tick = self._current_tick
+            tick_time = tick * self._tick_ms
+
+            slot = self._slots[tick % len(self._slots)]
+            due = [t for t in slot if t.deadline <= tick_time]
+            if len(due) > 0:
+                slot[:] = [t for t in slot if t.deadline > tick_time]
+
+        for timer in due:
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback()
+            except Exception as e:
+                logger.error("Error in timer callback %s: %s", timer.callback, e)
+
+
+scheduler = TimerWheel()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=scheduler._after_fork)
@@ -0,0 +1,269 @@
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import typing
+
+import numpy as np
+
+from models import *
+from events import dispatcher, TimerEvent
+from indicators import indicator_registry
+from journal import strategy_key
+
+if typing.TYPE_CHECKING:
+    from connectors.binance_futures import BinanceFuturesClient
+    from connectors.bitmex import BitmexClient
+
+logger = logging.getLogger()
+
+
+CANDLE_DTYPE = np.dtype([("timestamp", np.int64), ("open", np.float64), ("high", np.float64), ("low", np.float64),
+                         ("close", np.float64), ("volume", np.float64)])
+
+MAGIC = b"TBSNAP01"
+HEADER = struct.Struct("<8sQQ")  # Magic, length of the pickled state, number of buffers
+BUFFER_ENTRY = struct.Struct("<QQ")  # Offset and length of each buffer
+ALIGNMENT = 64
+
+
+def candles_to_array(candles: typing.List[Candle]) -> np.ndarray:
+    return np.array([(c.timestamp, c.open, c.high, c.low, c.close, c.volume) for c in candles], dtype=CANDLE_DTYPE)
+
+
+def array_to_candles(array: np.ndarray, timeframe: str) -> typing.List[Candle]:
+    return [Candle({'ts': int(ts), 'open': float(o), 'high': float(h), 'low': float(l), 'close': float(c),
+                    'volume': float(v)}, timeframe, "parse_trade") for ts, o, h, l, c, v in array.tolist()]
+
+
+class SnapshotStore:
+    def __init__(self, path: str = "snapshot.bin", interval: float = 60.0, max_age: float = 6 * 3600):
+
+        """
+        Periodic snapshots of the state rebuilt at every start: the candles of the aggregators, the indicator series and
+        the open trades of the live strategies, saved to a memory-mapped file.
+        At the next start a strategy restores its candles and indicators from the snapshot and only requests the
+        candles missing since then, instead of the whole history and an indicator computation from the first candle.
+        The candle arrays are pickled out-of-band (protocol 5), so they are read as views of the mapped file.
+        :param path:
+        :param interval: In seconds, between two snapshots
+        :param max_age: In seconds, an older snapshot is ignored
+        """
+
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+
+        self._clients: typing.List[typing.Union["BinanceFuturesClient", "BitmexClient"]] = []
+        self._state: typing.Optional[typing.Dict] = None  # Loaded from the file
+        self._mmap: typing.Optional[mmap.mmap] = None
+
+        self._writing = threading.Lock()
+
+    # Writing
+
+    def start(self, clients: typing.List[typing.Union["BinanceFuturesClient", "BitmexClient"]]):
+        self._clients = clients
+        dispatcher.call_later(self.interval, self._periodic)
+
+    def _periodic(self):
+        self.take()
+        dispatcher.call_later(self.interval, self._periodic)
+
+    def take(self, done: typing.Optional[threading.Event] = None):
+
+        """
+        Capture the state, in the dispatcher thread where the candles and indicators are updated: only references and
+        the forming candles are copied there, the arrays are built and written in the thread pool.
+        :param done: Set once the file is written
+        :return:
+        """
+
+        aggregators = dict()
+
+        for client in self._clients:
+            for symbol, aggregator in list(client.aggregators.items()):
+                with aggregator._lock:
+                    candles = {tf: (tf_candles[:-1], candles_to_array(tf_candles[-1:]))
+                               for tf, tf_candles in aggregator.candles.items() if len(tf_candles) > 0}
+                aggregators[(client.platform, symbol)] = {"last_trade_time": aggregator.last_trade_time,
+                                                          "candles": candles}
+
+        # The series only grow at the candle closes, in this thread: pickling them here gives a consistent copy
+        indicators = pickle.dumps(indicator_registry.series(), protocol=pickle.HIGHEST_PROTOCOL)
+
+        trades = dict()
+
+        for client in self._clients:
+            for strategy in list(client.strategies.values()):
+                if getattr(strategy, "client", None) is not client:  # Paper and worker process strategies
+                    continue
+                trades[(client.platform, strategy_key(strategy))] = [
+                    {"time": t.time, "side": t.side, "entry_price": t.entry_price, "quantity": t.quantity,
+                     "entry_id": t.entry_id, "pnl": t.pnl} for t in strategy.trades if t.status == "open"]
+
+        def write():
+            state = {"time": int(time.time() * 1000), "indicators": indicators, "trades": trades,
+                     "aggregators": {key: {"last_trade_time": a["last_trade_time"],
+                                           "candles": {tf: np.concatenate([candles_to_array(closed), forming])
+                                                       for tf, (closed, forming) in a["candles"].items()}}
+                                     for key, a in aggregators.items()}}
+            self._write(state)
+
+        def written(result):
+            if done is not None:
+                done.set()
+
+        dispatcher.run_blocking(write, written)
+
+    def flush(self, timeout: float = 5.0) -> bool:
+
+        """
+        Take a snapshot now and wait until it is written, e.g. before closing the program.
+        """
+
+        done = threading.Event()
+        dispatcher.publish(TimerEvent(lambda: self.take(done)))
+        return done.wait(timeout)
+
+    def _write(self, state: typing.Dict):
+        buffers = []
+        payload = pickle.dumps(state, protocol=5, buffer_callback=buffers.append)
+        buffers = [buffer.raw() for buffer in buffers]
+
+        offset = HEADER.size + BUFFER_ENTRY.size * len(buffers) + len(payload)
+        entries = []
+        for buffer in buffers:
+            offset += -offset % ALIGNMENT
+            entries.append((offset, buffer.nbytes))
+            offset += buffer.nbytes
+
+        temp_path = self.path + ".tmp"
+
+        with self._writing:
+            with open(temp_path, "wb") as f:
+                f.truncate(max(offset, 1))
+
+            with open(temp_path, "r+b") as f:
+                with mmap.mmap(f.fileno(), max(offset, 1)) as mm:
+                    position = HEADER.size
+                    mm[:position] = HEADER.pack(MAGIC, len(payload), len(buffers))
+                    for entry in entries:
+                        mm[position:position + BUFFER_ENTRY.size] = BUFFER_ENTRY.pack(*entry)
+                        position += BUFFER_ENTRY.size
+                    mm[position:position + len(payload)] = payload
+                    for (start, length), buffer in zip(entries, buffers):
+                        mm[start:start + length] = buffer
+                    mm.flush()
+
+            os.replace(temp_path, self.path)  # A crash while writing leaves the previous snapshot
+
+        logger.info("State snapshot written: %s candle series, %s bytes", len(buffers), offset)
+
+    # Restoring
+
+    def load(self) -> bool:
+
+        """
+        Map the snapshot of the previous run, at the start.
+        :return: False if there is no usable snapshot
+        """
+
+        if not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            magic, payload_length, n_buffers = HEADER.unpack_from(self._mmap, 0)
+            if magic != MAGIC:
+                raise ValueError("not a snapshot file")
+
+            view = memoryview(self._mmap)
+            position = HEADER.size
+            buffers = []
+            for _ in range(n_buffers):
+                start, length = BUFFER_ENTRY.unpack_from(self._mmap, position)
+                buffers.append(view[start:start + length])
+                position += BUFFER_ENTRY.size
+
+            state = pickle.loads(view[position:position + payload_length], buffers=buffers)
+        except Exception as e:
+            logger.error("Error while loading the snapshot %s: %s", self.path, e)
+            return False
+
+        age = time.time() - state["time"] / 1000
+        if age > self.max_age:
+            logger.info("Snapshot ignored, taken %s minutes ago", int(age / 60))
+            return False
+
+        state["indicators"] = pickle.loads(state["indicators"])
+        self._state = state
+
+        logger.info("Snapshot of %s minutes ago loaded: %s symbols", int(age / 60), len(state["aggregators"]))
+
+        return True
+
+    def restore_candles(self, client, contract: Contract, exchange: str,
+                        timeframe: str) -> typing.Optional[typing.List[Candle]]:
+
+        """
+        The candles of the snapshot, completed with the candles of the gap requested to the exchange, and the indicator
+        series of the symbol and timeframe. Called instead of the historical data request when a strategy starts.
+        :param client:
+        :param contract:
+        :param exchange: Name of the exchange in the indicator keys
+        :param timeframe:
+        :return: None if the snapshot doesn't have the candles or they can't be joined to the current ones
+        """
+
+        if self._state is None:
+            return None
+
+        aggregator_state = self._state["aggregators"].get((client.platform, contract.symbol))
+        if aggregator_state is None or timeframe not in aggregator_state["candles"]:
+            return None
+
+        array = aggregator_state["candles"][timeframe]
+        forming_ts = int(array["timestamp"][-1])
+        tf_equiv = TF_EQUIV[timeframe] * 1000
+
+        gap = client.get_historical_candles(contract, timeframe, forming_ts)
+
+        # The gap must start at the candle that was forming, and reach the current one (not cut by the request limit)
+
+        now = int(time.time() * 1000) + client.server_time_offset
+        if len(gap) == 0 or gap[0].timestamp != forming_ts or gap[-1].timestamp + 2 * tf_equiv < now:
+            logger.info("%s %s %s: gap since the snapshot too long, the history is requested", client.platform,
+                        contract.symbol, timeframe)
+            return None
+
+        candles = array_to_candles(array[:-1], timeframe) + gap
+
+        key = (exchange, contract.symbol, timeframe)
+        series = [s for s in self._state["indicators"] if s.key[:3] == key]
+        indicator_registry.restore(series)
+
+        logger.info("%s %s %s restored from the snapshot, %s candles requested for the gap", client.platform,
+                    contract.symbol, timeframe, len(gap))
+
+        return candles
+
+    def open_trades(self, platform: str, strategy, contract: Contract) -> typing.List[Trade]:
+
+        """
+        Open trades of the strategy when the snapshot was taken, used when there is no journal.
+        """
+
+        if self._state is None:
+            return []
+
+        return [Trade({**info, "contract": contract, "strategy": strategy.stat_name, "status": "open"})
+                for info in self._state["trades"].get((platform, strategy_key(strategy)), [])]
+
+
+snapshot_store = SnapshotStore()
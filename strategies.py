@@ -1,21 +1,77 @@
 import logging
 from typing import *
 import time
-
-from threading import Timer
-
-import pandas as pd
+import collections
+import math
 
 from models import *
+from indicators import SharedIndicator, indicator_registry
+from events import dispatcher, LogEvent, OrderUpdateEvent
+from orders import OrderTicket
 
 if TYPE_CHECKING:
     from connectors.bitmex import BitmexClient
     from connectors.binance_futures import BinanceFuturesClient
+    from candle_aggregator import CandleAggregator
+    from orders import Order
 
 logger = logging.getLogger()
 
 
-TF_EQUIV = {"1m": 60, "5m": 300, "15m": 900, "30m": 900, "1h": 3600, "4h": 14400}
+class BalanceRefresh:
+    _instances: Dict[int, "BalanceRefresh"] = dict()
+
+    def __init__(self, client, delay: float = 0.2):
+
+        """
+        Re-arms the tickets of all the strategies of a client when a trade is filled or closed. The fills received
+        within `delay` seconds share one balance request, then every ticket is resized from its result, instead of
+        each strategy requesting the balance in the thread pool that also sends the orders.
+        :param client: The exchange connector, or a PaperClient which has its own balance
+        :param delay: In seconds
+        """
+
+        self.client = client
+        self.delay = delay
+        self.strategies: List["Strategy"] = []
+        self._pending = False
+
+    @classmethod
+    def of(cls, client) -> "BalanceRefresh":
+        if id(client) not in cls._instances:
+            cls._instances[id(client)] = cls(client)
+        return cls._instances[id(client)]
+
+    def add(self, strategy: "Strategy"):
+        if len(self.strategies) == 0:
+            dispatcher.subscribe(OrderUpdateEvent, self._on_order_update, self.client.platform)
+        self.strategies.append(strategy)
+
+    def remove(self, strategy: "Strategy"):
+        if strategy in self.strategies:
+            self.strategies.remove(strategy)
+            if len(self.strategies) == 0:
+                dispatcher.unsubscribe(OrderUpdateEvent, self._on_order_update, self.client.platform)
+                del BalanceRefresh._instances[id(self.client)]
+
+    def _on_order_update(self, event: OrderUpdateEvent):
+        if event.strategy.client is not self.client:  # The paper and live strategies publish with the same source
+            return
+
+        if event.trade.entry_price is None or self._pending:  # Not filled yet, or a request is already due
+            return
+
+        self._pending = True
+        dispatcher.call_later(self.delay, lambda: dispatcher.run_blocking(self.client.get_trade_balance,
+                                                                          self._on_balance))
+
+    def _on_balance(self, balance: Optional[float]):
+        self._pending = False
+        if balance is None:
+            return
+
+        for strategy in list(self.strategies):
+            strategy._arm_ticket(balance)
 
 
 class Strategy:
@@ -33,169 +89,278 @@ class Strategy:
         self.stop_loss = stop_loss
 
         self.stat_name = strat_name
+        self.uid: Optional[str] = None  # Of the workspace row, set by the interface
 
         self.ongoing_position = False
 
+        self.aggregator: Optional["CandleAggregator"] = None
         self.candles: List[Candle] = []
         self.trades: List[Trade] = []
+        self.unrealized_pnl = 0.0
         self.logs = []
 
+        self.close_latencies: Deque[int] = collections.deque(maxlen=100)
+
+        # Entry order prepared at each candle close and after each balance change, so a signal doesn't wait for the
+        # balance
+        self._ticket: Optional[OrderTicket] = None
+        self._arming = False
+        self._rearm = False  # The balance changed while the ticket was prepared
+        self._rearm_balance: Optional[float] = None
+
+        # The fills of all the strategies of the client change the balance
+        self._balance_refresh = BalanceRefresh.of(client)
+        self._balance_refresh.add(self)
+
     def _add_log(self, msg: str):
         logger.info("%s", msg)
         self.logs.append({"log": msg, "displayed": False})
+        dispatcher.publish(LogEvent(self.client.platform, msg))
 
-    def parse_trades(self, price: float, size: float, timestamp: int) -> str:
+    def _publish_trade(self, trade: Trade):
+        journal = self.client.orders.journal
+        if journal is not None:  # Live strategies only, the paper clients have no journal
+            journal.record_trade(self.client.platform, self, trade)
 
-        timestamp_diff = int(time.time() * 1000) - timestamp
-        if timestamp_diff >= 2000:
-            logger.warning("%s %s: %s milliseconds of difference between the current time and the trade time",
-                           self.exchange, self.contract.symbol, timestamp_diff)
+        dispatcher.publish(OrderUpdateEvent(self.client.platform, self, trade))
 
-        last_candle = self.candles[-1]
+    def on_candle_update(self):
 
-        # Same Candle
+        """
+        Called by the CandleAggregator when a trade updated the last candle of the strategy timeframe.
+        :return:
+        """
 
-        if timestamp < last_candle.timestamp + self.tf_equiv:
+        self.check_trade("same_candle")
 
-            last_candle.close = price
-            last_candle.volume += size
+    def on_candle_close(self):
 
-            if price > last_candle.high:
-                last_candle.high = price
-            elif price < last_candle.low:
-                last_candle.low = price
+        """
+        Called by the CandleAggregator when a new candle started, the previous one is closed. It is triggered by the
+        first trade of the new candle, or by the timer at the candle boundary if no trade came before.
+        :return:
+        """
 
-            # Check Take profit / Stop loss
+        self.check_trade("new_candle")
 
-            for trade in self.trades:
-                if trade.status == "open" and trade.entry_price is not None:
-                    self._check_tp_sl(trade)
+        self._arm_ticket()
 
-            return "same_candle"
+        # Time between the end of the candle and the end of the signal evaluation, in the exchange clock
 
-        # Missing Candle(s)
+        latency = self.aggregator.server_time() - self.candles[-1].timestamp
+        self.close_latencies.append(latency)
 
-        elif timestamp >= last_candle.timestamp + 2 * self.tf_equiv:
+        logger.info("%s %s %s close-to-signal latency: %s ms (median of the last %s candles: %s ms)",
+                    self.exchange, self.contract.symbol, self.tf, latency, len(self.close_latencies),
+                    sorted(self.close_latencies)[len(self.close_latencies) // 2])
 
-            missing_candles = int((timestamp - last_candle.timestamp) / self.tf_equiv) - 1
+    def check_trade(self, tick_type: str):
+        pass
+
+    def stop(self):
 
-            logger.info("%s missing %s candles for %s %s (%s %s)", self.exchange, missing_candles, self.contract.symbol,
-                        self.tf, timestamp, last_candle.timestamp)
+        """
+        Called when the strategy is switched off, releases the resources shared with other strategies.
+        :return:
+        """
 
-            for missing in range(missing_candles):
-                new_ts = last_candle.timestamp + self.tf_equiv
-                candle_info = {'ts': new_ts, 'open': last_candle.close, 'high': last_candle.close,
-                               'low': last_candle.close, 'close': last_candle.close, 'volume': 0}
-                new_candle = Candle(candle_info, self.tf, "parse_trade")
+        self._balance_refresh.remove(self)
 
-                self.candles.append(new_candle)
+        if self.aggregator is not None:
+            self.aggregator.trigger_book.remove_strategy(self)
+            self.client.position_table(self.contract).remove_strategy(self)
+            self.aggregator.unsubscribe(self)
+            self.aggregator = None
 
-                last_candle = new_candle
+    def _arm_ticket(self, balance: Optional[float] = None):
 
-            new_ts = last_candle.timestamp + self.tf_equiv
-            candle_info = {'ts': new_ts, 'open': price, 'high': price, 'low': price, 'close': price, 'volume': size}
-            new_candle = Candle(candle_info, self.tf, "parse_trade")
+        """
+        Compute the trade size with the current balance and encode the entry order of both sides, in the thread pool
+        of the dispatcher. The ticket is used by the next signal.
+        :param balance: Already requested by the BalanceRefresh of the client, requested by the ticket if None
+        :return:
+        """
+
+        if len(self.candles) == 0:
+            return
 
-            self.candles.append(new_candle)
+        if self._arming:  # The ticket being prepared may have read the previous balance
+            self._rearm = True
+            self._rearm_balance = balance
+            return
 
-            return "new_candle"
+        self._arming = True
 
-        # New Candle
+        contract, client = self.contract, self.client
+        price = self.candles[-1].close
 
-        elif timestamp >= last_candle.timestamp + self.tf_equiv:
-            new_ts = last_candle.timestamp + self.tf_equiv
-            candle_info = {'ts': new_ts, 'open': price, 'high': price, 'low': price, 'close': price, 'volume': size}
-            new_candle = Candle(candle_info, self.tf, "parse_trade")
+        def prepare() -> Optional[OrderTicket]:
+            if balance is None:
+                trade_size = client.get_trade_size(contract, price, self.balance_pct)
+            else:
+                trade_size = client.trade_size_from_balance(contract, price, self.balance_pct, balance)
+            if not trade_size:
+                return None
+            templates = {side: client.order_template(contract, "MARKET", trade_size, side) for side in ["buy", "sell"]}
+            return OrderTicket(contract, trade_size, price, templates)
 
-            self.candles.append(new_candle)
+        dispatcher.run_blocking(prepare, self._set_ticket)
 
-            logger.info("%s New candle for %s %s", self.exchange, self.contract.symbol, self.tf)
+    def _set_ticket(self, ticket: Optional[OrderTicket]):
+        self._arming = False
+        self._ticket = ticket
 
-            return "new_candle"
+        if self._rearm:
+            self._rearm = False
+            self._arm_ticket(self._rearm_balance)
 
-    def _check_order_status(self, order_id):
+    def _open_position(self, signal_result: int):
 
-        order_status = self.client.get_order_status(self.contract, order_id)
+        signal_time = time.perf_counter_ns()
 
-        if order_status is not None:
+        order_side = "buy" if signal_result == 1 else "sell"
+        position_side = "long" if signal_result == 1 else "short"
 
-            logger.info("%s order status: %s", self.exchange, order_status.status)
+        ticket = self._ticket
 
-            if order_status.status == "filled":
-                for trade in self.trades:
-                    if trade.entry_id == order_id:
-                        trade.entry_price = order_status.avg_price
-                        break
-                return
+        self.ongoing_position = True  # Until the order is refused, so the next signals don't open another position
 
-        t = Timer(2.0, lambda: self._check_order_status(order_id))
-        t.start()
+        if ticket is None:  # Not armed yet, e.g. right after the start
+            # The balance request runs in the thread pool, not on the market data thread shared by the exchanges
+            contract, client, price = self.contract, self.client, self.candles[-1].close
 
-    def _open_position(self, signal_result: int):
+            def on_trade_size(trade_size: Optional[float]):
+                if trade_size is None:
+                    self.ongoing_position = False
+                    return
+                self._submit_entry(order_side, position_side, trade_size, None, signal_time)
 
-        trade_size = self.client.get_trade_size(self.contract, self.candles[-1].close, self.balance_pct)
-        if trade_size is None:
+            dispatcher.run_blocking(lambda: client.get_trade_size(contract, price, self.balance_pct), on_trade_size)
             return
 
-        order_side = "buy" if signal_result == 1 else "sell"
-        position_side = "long" if signal_result == 1 else "short"
+        self._submit_entry(order_side, position_side, ticket.quantity, ticket.templates[order_side], signal_time)
 
+    def _submit_entry(self, order_side: str, position_side: str, trade_size: float, template: Optional[Dict],
+                      signal_time: int):
         self._add_log(f"{position_side.capitalize()} signal on {self.contract.symbol} {self.tf}")
 
-        order_status = self.client.place_order(self.contract, "MARKET", trade_size, order_side)
-
-        if order_status is not None:
-            self._add_log(f"{order_side.capitalize()} order placed on {self.exchange} | Status: {order_status.status}")
+        # Netted with the entries of the other strategies of the contract signaling at the same time
+        self.client.orders.submit_netted(self.contract, trade_size, order_side,
+                                         on_update=lambda order: self._on_entry_update(order, position_side),
+                                         template=template, signal_time=signal_time)
+
+    def _on_entry_update(self, order: "Order", position_side: str):
+
+        """
+        Called by the OrderManager when the state of the entry order changes: the trade is created when the order
+        is acknowledged, and tracked once it is filled.
+        :param order:
+        :param position_side: long or short
+        :return:
+        """
+
+        trade = None
+        for t in self.trades:
+            if order.order_id is not None and t.entry_id == order.order_id:
+                trade = t
+                break
+
+        # Canceled or expired after a partial fill: the position is open for the part filled
+        partially_filled = order.state in ("canceled", "expired") and order.filled_quantity > 0
+
+        if order.state in ("rejected", "failed", "canceled", "expired") and not partially_filled:
+            self._add_log(f"{order.side.capitalize()} order on {self.exchange} failed | Status: {order.state}")
+            self.ongoing_position = False
+            if trade is not None:
+                trade.status = "canceled"
+                self._publish_trade(trade)
+            return
 
+        if trade is None:
+            self._add_log(f"{order.side.capitalize()} order placed on {self.exchange} | Status: {order.state}")
+
+            # The journal and the worker reports identify the trades of a strategy by their time
+            trade_time = int(time.time() * 1000)
+            if len(self.trades) > 0 and trade_time <= self.trades[-1].time:
+                trade_time = self.trades[-1].time + 1
+
+            trade = Trade({"time": trade_time, "entry_price": None, "contract": self.contract,
+                           "strategy": self.stat_name, "side": position_side, "status": "open", "pnl": 0,
+                           "quantity": order.quantity, "entry_id": order.order_id})
+            self.trades.append(trade)
+            self._publish_trade(trade)
+
+        if (order.state == "filled" or partially_filled) and trade.entry_price is None:
+            if partially_filled:
+                self._add_log(f"{order.side.capitalize()} order on {self.exchange} {order.state} after a partial "
+                              f"fill of {order.filled_quantity}")
+
+            trade.entry_price = order.avg_price
+            # The part of the netted order allocated to the strategy, or the part filled before the cancel
+            trade.quantity = order.filled_quantity if partially_filled else order.quantity
+            self._track_open_trade(trade)
+            self._publish_trade(trade)  # The BalanceRefresh of the client re-arms the tickets
+
+    def recover_trades(self, trades: List[Trade]):
+
+        """
+        Resume the open trades of a previous run, rebuilt from the journal when the strategy starts: their take profit
+        / stop loss levels are armed again and no new position is opened while they are open.
+        :param trades:
+        :return:
+        """
+
+        for trade in trades:
+            self.trades.append(trade)
             self.ongoing_position = True
+            self._track_open_trade(trade)
+            self._publish_trade(trade)
 
-            avg_fill_price = None
-
-            if order_status.status == "filled":
-                avg_fill_price = order_status.avg_price
-            else:
-                t = Timer(2.0, lambda: self._check_order_status(order_status.order_id))
-                t.start()
+    def _track_open_trade(self, trade: Trade):
 
-            new_trade = Trade({"time": int(time.time() * 1000), "entry_price": avg_fill_price,
-                               "contract": self.contract, "strategy": self.stat_name, "side": position_side,
-                               "status": "open", "pnl": 0, "quantity": trade_size, "entry_id": order_status.order_id})
-            self.trades.append(new_trade)
+        """
+        Once the entry price of a trade is known, its take profit / stop loss levels are armed and it is marked to
+        market with the other open trades of the symbol.
+        :param trade:
+        :return:
+        """
 
-    def _check_tp_sl(self, trade: Trade):
+        if self.aggregator is None:
+            return
 
-        tp_triggered = False
-        sl_triggered = False
+        self.aggregator.trigger_book.add(self, trade)
+        self.client.position_table(self.contract).add(self, trade)
 
-        price = self.candles[-1].close
+    def exit_trade(self, trade: Trade, reason: str):
 
-        if trade.side == "long":
-            if self.stop_loss is not None:
-                if price <= trade.entry_price * (1 - self.stop_loss / 100):
-                    sl_triggered = True
-            if self.take_profit is not None:
-                if price >= trade.entry_price * (1 + self.take_profit / 100):
-                    tp_triggered = True
+        """
+        Called by the TriggerBook of the symbol when the take profit or stop loss level of an open trade is reached.
+        :param trade:
+        :param reason: take_profit or stop_loss
+        :return:
+        """
 
-        elif trade.side == "short":
-            if self.stop_loss is not None:
-                if price >= trade.entry_price * (1 + self.stop_loss / 100):
-                    sl_triggered = True
-            if self.take_profit is not None:
-                if price <= trade.entry_price * (1 - self.take_profit / 100):
-                    tp_triggered = True
+        self._add_log(f"{'Stop loss' if reason == 'stop_loss' else 'Take profit'} for {self.contract.symbol} {self.tf}")
 
-        if tp_triggered or sl_triggered:
+        order_side = "SELL" if trade.side == "long" else "BUY"
+        self.client.orders.submit(self.contract, "MARKET", trade.quantity, order_side,
+                                  on_update=lambda order: self._on_exit_update(order, trade))
 
-            self._add_log(f"{'Stop loss' if sl_triggered else 'Take profit'} for {self.contract.symbol} {self.tf}")
+    def _on_exit_update(self, order: "Order", trade: Trade):
+        if trade.status != "open":  # Already closed by a previous update of the order
+            return
 
-            order_side = "SELL" if trade.side == "long" else "BUY"
-            order_status = self.client.place_order(self.contract, "MARKET", trade.quantity, order_side)
+        if order.state in ("rejected", "failed", "canceled", "expired"):  # The exit is tried again on the next trade
+            if self.aggregator is not None:
+                self.aggregator.trigger_book.add(self, trade)
+            return
 
-            if order_status is not None:
-                self._add_log(f"Exit order on {self.contract.symbol} {self.tf} placed successfully")
-                trade.status = "closed"
-                self.ongoing_position = False
+        self._add_log(f"Exit order on {self.contract.symbol} {self.tf} placed successfully")
+        trade.status = "closed"
+        self.ongoing_position = False
+        if self.aggregator is not None:
+            self.client.position_table(self.contract).remove(trade)
+        self._publish_trade(trade)
 
 
 class TechnicalStrategy(Strategy):
@@ -209,44 +374,66 @@ class TechnicalStrategy(Strategy):
 
         self._rsi_length = other_params['rsi_length']
 
-    def _rsi(self):
-        close_list = []
-        for candle in self.candles:
-            close_list.append(candle.close)
+        self._ema_fast_series: Optional[SharedIndicator] = None
+        self._ema_slow_series: Optional[SharedIndicator] = None
+        self._macd_signal_series: Optional[SharedIndicator] = None
+        self._rsi_series: Optional[SharedIndicator] = None
 
-        closes = pd.Series(close_list)
+        self._indicators_index = 0  # Number of candles already added to the indicators
 
-        delta = closes.diff().dropna()
+    def _acquire_indicators(self):
 
-        up, down = delta.copy(), delta.copy()
-        up[up < 0] = 0
-        down[down > 0] = 0
+        """
+        The indicator series are shared with the other strategies running on the same contract and timeframe,
+        so the EMAs / RSI with the same parameters are computed only once per candle close.
+        :return:
+        """
 
-        avg_gain = up.ewm(com=(self._rsi_length - 1), min_periods=self._rsi_length).mean()
-        avg_loss = down.abs().ewm(com=(self._rsi_length - 1), min_periods=self._rsi_length).mean()
+        key = (self.exchange, self.contract.symbol, self.tf)
 
-        rs = avg_gain / avg_loss
+        self._ema_fast_series = indicator_registry.acquire(*key, "ema", (self._ema_fast,))
+        self._ema_slow_series = indicator_registry.acquire(*key, "ema", (self._ema_slow,))
+        self._macd_signal_series = indicator_registry.acquire(*key, "macd_signal",
+                                                              (self._ema_fast, self._ema_slow, self._ema_signal))
+        self._rsi_series = indicator_registry.acquire(*key, "rsi", (self._rsi_length,))
 
-        rsi = 100 - 100 / (1 + rs)
-        rsi = rsi.round(2)
+    def stop(self):
+        super().stop()
 
-        return rsi.iloc[-2]
+        for series in [self._ema_fast_series, self._ema_slow_series, self._macd_signal_series, self._rsi_series]:
+            if series is not None:
+                indicator_registry.release(series)
 
-    def _macd(self) -> Tuple[float, float]:
+        self._ema_fast_series = self._ema_slow_series = self._macd_signal_series = self._rsi_series = None
+
+    def _update_indicators(self):
 
-        close_list = []
-        for candle in self.candles:
-            close_list.append(candle.close)
+        """
+        Add the candles closed since the last call to the indicators, the last candle is still forming so it is left
+        out. The first call adds the whole historical data, then it is usually one candle per call.
+        :return:
+        """
 
-        closes = pd.Series(close_list)
+        if self._rsi_series is None:
+            self._acquire_indicators()
 
-        ema_fast = closes.ewm(span=self._ema_fast).mean()
-        ema_slow = closes.ewm(span=self._ema_slow).mean()
+        while self._indicators_index < len(self.candles) - 1:
+            candle = self.candles[self._indicators_index]
+            self._macd_signal_series.update(candle.timestamp, candle.close)
+            self._rsi_series.update(candle.timestamp, candle.close)
+            self._indicators_index += 1
 
-        macd_line = ema_fast - ema_slow
-        macd_signal = macd_line.ewm(span=self._ema_signal).mean()
+    def _rsi(self) -> float:
+        self._update_indicators()
+        return self._rsi_series.value_at(self.candles[-2].timestamp)
 
-        return macd_line.iloc[-2], macd_signal.iloc[-2]
+    def _macd(self) -> Tuple[float, float]:
+        self._update_indicators()
+
+        timestamp = self.candles[-2].timestamp
+        macd_line = self._ema_fast_series.value_at(timestamp) - self._ema_slow_series.value_at(timestamp)
+
+        return macd_line, self._macd_signal_series.value_at(timestamp)
 
     def _check_signal(self):
 
@@ -275,30 +462,45 @@ class BreakoutStrategy(Strategy):
 
         self._min_volume = other_params['min_volume']
 
+        # Breakout levels of the last closed candle, armed once per candle close. NaN until armed, so the first
+        # comparison fails and arms them.
+        self._long_trigger = math.nan
+        self._short_trigger = math.nan
+
+    def _arm_triggers(self):
+        self._long_trigger = self.candles[-2].high
+        self._short_trigger = self.candles[-2].low
+
     def _check_signal(self) -> int:
 
-        if self.candles[-1].close > self.candles[-2].high and self.candles[-1].volume > self._min_volume:
+        candle = self.candles[-1]
+
+        # Per-print path: the price is inside the range of the previous candle, no breakout possible
+
+        if self._short_trigger <= candle.close <= self._long_trigger:
+            return 0
+
+        if math.isnan(self._long_trigger):
+            self._arm_triggers()
+            return self._check_signal()
+
+        if candle.volume <= self._min_volume:
+            return 0
+
+        if candle.close > self._long_trigger:
             return 1
-        elif self.candles[-1].close < self.candles[-2].low and self.candles[-1].volume > self._min_volume:
+        elif candle.close < self._short_trigger:
             return -1
         else:
             return 0
 
     def check_trade(self, tick_type: str):
 
+        if tick_type == "new_candle":
+            self._arm_triggers()
+
         if not self.ongoing_position:
             signal_result = self._check_signal()
 
             if signal_result in [1, -1]:
                 self._open_position(signal_result)
-
-
-
-
-
-
-
-
-
-
-
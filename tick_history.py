@@ -0,0 +1,334 @@
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import time
+import typing
+
+import dateutil.parser
+import numpy as np
+
+from models import *
+from backtester import CandleData, Prints
+
+logger = logging.getLogger()
+
+
+TICK_COLUMNS = ["timestamp", "price", "quantity", "buyer_maker"]
+HOUR_MS = 3600 * 1000
+
+
+class TickData:
+    def __init__(self, timestamp: np.ndarray, price_ticks: np.ndarray, quantity_lots: np.ndarray,
+                 buyer_maker: np.ndarray, meta: typing.Dict):
+
+        """
+        Trade prints of one symbol. Prices and quantities are stored as integer numbers of ticks / lots, like the
+        files they are memory-mapped from, and converted to floats on access.
+        :param meta: price_scale, tick_units, quantity_scale, lot_units of the contract when it was downloaded
+        """
+
+        self.timestamp = timestamp
+        self.price_ticks = price_ticks
+        self.quantity_lots = quantity_lots
+        self.buyer_maker = buyer_maker
+        self.meta = meta
+
+    def __len__(self) -> int:
+        return len(self.timestamp)
+
+    @property
+    def price(self) -> np.ndarray:
+        return self.price_ticks * self.meta['tick_units'] / self.meta['price_scale']
+
+    @property
+    def quantity(self) -> np.ndarray:
+        return self.quantity_lots * self.meta['lot_units'] / self.meta['quantity_scale']
+
+    def candles(self, timeframe: str) -> CandleData:
+
+        """
+        Rebuild the candles of any timeframe by bucketing the prints on the candle timestamps.
+        Periods without any trade have no candle, like in the candles built live from the trades.
+        :param timeframe: 1m, 5m, ... 4h
+        :return:
+        """
+
+        if len(self) == 0:
+            return CandleData(*[np.empty(0)] * 6)
+
+        tf_ms = TF_EQUIV[timeframe] * 1000
+        bucket = self.timestamp // tf_ms
+
+        starts = np.r_[0, np.flatnonzero(np.diff(bucket)) + 1]
+        ends = np.r_[starts[1:], len(bucket)]
+
+        price = self.price
+
+        return CandleData(bucket[starts] * tf_ms, price[starts], np.maximum.reduceat(price, starts),
+                          np.minimum.reduceat(price, starts), price[ends - 1],
+                          np.add.reduceat(self.quantity, starts))
+
+    def prints(self, candles: CandleData) -> Prints:
+
+        """
+        The real intrabar path, for the backtester, instead of the 4 prints per candle approximation.
+        :param candles: Built with candles() from the same prints
+        :return:
+        """
+
+        candle_index = np.searchsorted(candles.timestamp, self.timestamp, side="right") - 1
+        valid = candle_index >= 0
+
+        return Prints(self.price[valid], self.quantity[valid], candle_index[valid])
+
+
+class TickHistory:
+    def __init__(self, client, contract: Contract, data_dir: str = "tick_data", workers: int = 8):
+
+        """
+        Download the historical trades of a contract and store them by day, each column in its own .npy file of
+        fixed-width integers (ticks / lots), so a day can be memory-mapped instead of parsed. Each day keeps the tick
+        and lot sizes it was stored with, in its own meta.json.
+        :param client: BinanceClient or BitmexClient, its _make_request() method is used for the public endpoints
+        :param contract:
+        :param data_dir:
+        :param workers: Number of hours of a day downloaded at the same time
+        """
+
+        self.client = client
+        self.contract = contract
+        self.workers = workers
+
+        self.directory = os.path.join(data_dir, client.platform, contract.symbol)
+
+        self.meta = {'price_scale': contract.price_scale, 'tick_units': contract.tick_units,
+                     'quantity_scale': contract.quantity_scale, 'lot_units': contract.lot_units}
+
+    def _day_directory(self, day: datetime.date) -> str:
+        return os.path.join(self.directory, day.isoformat())
+
+    def download(self, start: datetime.date, end: datetime.date):
+
+        """
+        Download the days from start to end (included). Days already on disk are skipped, except the current day
+        that is not complete yet. A day with an hour that could not be downloaded is not stored, it is downloaded again
+        by the next call.
+        :param start:
+        :param end:
+        :return:
+        """
+
+        self._save_meta()
+
+        today = datetime.datetime.utcnow().date()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            day = start
+            while day <= end:
+                if day == today or not os.path.exists(os.path.join(self._day_directory(day), "timestamp.npy")):
+                    day_start = int(datetime.datetime(day.year, day.month, day.day,
+                                                      tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+                    hours = list(pool.map(self._download_hour, [day_start + h * HOUR_MS for h in range(24)]))
+
+                    if any(hour is None for hour in hours):
+                        logger.error("%s %s: trades of %s incomplete, the day is not stored", self.client.platform,
+                                     self.contract.symbol, day)
+                        day += datetime.timedelta(days=1)
+                        continue
+
+                    self._save_day(day, [t for hour in hours for t in hour])
+
+                    logger.info("%s %s: %s trades downloaded for %s", self.client.platform, self.contract.symbol,
+                                sum(len(hour) for hour in hours), day)
+
+                day += datetime.timedelta(days=1)
+
+    def _request(self, endpoint: str, data: typing.Dict) -> typing.Optional[typing.List]:
+
+        """
+        The history endpoints are rate limited, wait and retry a few times before giving up.
+        """
+
+        for attempt in range(5):
+            result = self.client._make_request("GET", endpoint, data)
+            if result is not None:
+                return result
+            time.sleep(2 ** attempt)
+
+        return None
+
+    def _download_hour(self, hour_start: int) -> typing.Optional[typing.List[typing.Tuple[int, float, float, bool]]]:
+
+        """
+        :return: None if a request failed, the hour is incomplete
+        """
+
+        if self.client.platform == "bitmex":
+            return self._download_hour_bitmex(hour_start)
+        else:
+            return self._download_hour_binance(hour_start)
+
+    def _download_hour_binance(self,
+                               hour_start: int) -> typing.Optional[typing.List[typing.Tuple[int, float, float, bool]]]:
+        endpoint = "/fapi/v1/aggTrades" if self.client.platform == "binance_futures" else "/api/v3/aggTrades"
+        hour_end = hour_start + HOUR_MS
+
+        data = dict()
+        data['symbol'] = self.contract.symbol
+        data['startTime'] = hour_start
+        data['endTime'] = hour_end - 1
+        data['limit'] = 1000
+
+        trades = []
+
+        while True:
+            raw_trades = self._request(endpoint, data)
+            if raw_trades is None:
+                logger.error("Could not download the %s trades of %s", self.contract.symbol, hour_start)
+                return None
+
+            for t in raw_trades:
+                if t['T'] >= hour_end:
+                    break
+                trades.append((t['T'], float(t['p']), float(t['q']), t['m']))
+
+            if len(raw_trades) < 1000 or raw_trades[-1]['T'] >= hour_end:
+                break
+
+            # The time window can't be combined with fromId, the next pages are requested by id
+            data = {'symbol': self.contract.symbol, 'fromId': raw_trades[-1]['a'] + 1, 'limit': 1000}
+
+        return trades
+
+    def _download_hour_bitmex(self,
+                              hour_start: int) -> typing.Optional[typing.List[typing.Tuple[int, float, float, bool]]]:
+        data = dict()
+        data['symbol'] = self.contract.symbol
+        data['startTime'] = datetime.datetime.utcfromtimestamp(hour_start / 1000).isoformat()
+        data['endTime'] = datetime.datetime.utcfromtimestamp((hour_start + HOUR_MS - 1) / 1000).isoformat()
+        data['count'] = 1000
+        data['start'] = 0
+
+        trades = []
+
+        while True:
+            raw_trades = self._request("/api/v1/trade", data)
+            if raw_trades is None:
+                logger.error("Could not download the %s trades of %s", self.contract.symbol, hour_start)
+                return None
+
+            for t in raw_trades:
+                timestamp = int(dateutil.parser.isoparse(t['timestamp']).timestamp() * 1000)
+                trades.append((timestamp, t['price'], t['size'], t['side'] == "Sell"))
+
+            if len(raw_trades) < 1000:
+                break
+
+            data['start'] += 1000
+
+        return trades
+
+    def _save_meta(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(os.path.join(self.directory, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+
+    def _save_day(self, day: datetime.date, trades: typing.List[typing.Tuple[int, float, float, bool]]):
+        trades.sort(key=lambda t: t[0])  # Stable, the trades of the same millisecond keep their order
+
+        price = np.array([t[1] for t in trades], dtype=np.float64)
+        quantity = np.array([t[2] for t in trades], dtype=np.float64)
+
+        price_ticks = np.rint(price * self.contract.price_scale / self.contract.tick_units)
+        quantity_lots = np.rint(quantity * self.contract.quantity_scale / self.contract.lot_units)
+
+        columns = {
+            "timestamp": np.array([t[0] for t in trades], dtype=np.int64),
+            "price": price_ticks.astype(int_type(price_ticks)),
+            "quantity": quantity_lots.astype(int_type(quantity_lots)),
+            "buyer_maker": np.array([t[3] for t in trades], dtype=bool),
+        }
+
+        directory = self._day_directory(day)
+        os.makedirs(directory, exist_ok=True)
+
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+
+        # The timestamp file is written last, it marks the day as complete
+        for name in ["price", "quantity", "buyer_maker", "timestamp"]:
+            np.save(os.path.join(directory, name + ".npy"), columns[name])
+
+    def load(self, start: datetime.date, end: datetime.date) -> TickData:
+        return load_ticks(self.directory, start, end)
+
+
+def int_type(values: np.ndarray) -> type:
+    if len(values) == 0 or np.abs(values).max() < 2 ** 31:
+        return np.int32
+    return np.int64
+
+
+def load_ticks(directory: str, start: datetime.date, end: datetime.date) -> TickData:
+
+    """
+    Read the trades stored by TickHistory, from start to end (included).
+    A single day is memory-mapped without any copy, several days are concatenated. The days stored with other tick or
+    lot sizes than the last one are converted to its sizes.
+    :param directory: data_dir/platform/symbol
+    :param start:
+    :param end:
+    :return:
+    """
+
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)  # The days stored before they had their own meta.json
+
+    days = []
+    metas = []
+
+    day = start
+    while day <= end:
+        day_directory = os.path.join(directory, day.isoformat())
+        if os.path.exists(os.path.join(day_directory, "timestamp.npy")):
+            days.append([np.load(os.path.join(day_directory, name + ".npy"), mmap_mode="r") for name in TICK_COLUMNS])
+
+            day_meta = meta
+            if os.path.exists(os.path.join(day_directory, "meta.json")):
+                with open(os.path.join(day_directory, "meta.json")) as f:
+                    day_meta = json.load(f)
+            metas.append(day_meta)
+        else:
+            logger.warning("No trades stored for %s on %s", directory, day)
+        day += datetime.timedelta(days=1)
+
+    if len(days) == 0:
+        return TickData(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                        np.empty(0, dtype=bool), meta)
+
+    if len(days) == 1:
+        return TickData(*days[0], metas[0])
+
+    meta = metas[-1]
+
+    for columns, day_meta in zip(days, metas):
+        if day_meta != meta:
+            columns[1] = _rescale(columns[1], day_meta['tick_units'] / day_meta['price_scale'],
+                                  meta['tick_units'] / meta['price_scale'])
+            columns[2] = _rescale(columns[2], day_meta['lot_units'] / day_meta['quantity_scale'],
+                                  meta['lot_units'] / meta['quantity_scale'])
+
+    return TickData(*[np.concatenate([d[i] for d in days]) for i in range(len(TICK_COLUMNS))], meta)
+
+
+def _rescale(values: np.ndarray, size: float, new_size: float) -> np.ndarray:
+
+    """
+    :param size: Of a tick or lot, in price or quantity
+    """
+
+    return np.rint(values * (size / new_size)).astype(np.int64)
@@ -0,0 +1,113 @@
+import heapq
+import itertools
+import threading
+import typing
+
+from models import *
+
+if typing.TYPE_CHECKING:
+    from strategies import Strategy
+
+
+class TriggerBook:
+    def __init__(self):
+
+        """
+        Take profit and stop loss levels of the open trades of one symbol.
+        Levels that trigger when the price goes up are in a min-heap, levels that trigger when the price goes down in a
+        max-heap (negated levels), so each price update only compares the price with the top of the two heaps.
+        Closed trades are removed from the active trades right away and their levels are skipped when they reach the
+        top of a heap.
+        """
+
+        self._above: typing.List[typing.Tuple[float, int, Trade, str]] = []
+        self._below: typing.List[typing.Tuple[float, int, Trade, str]] = []
+
+        self._active: typing.Dict[int, "Strategy"] = dict()  # id(trade) -> strategy of the open trades
+
+        self._counter = itertools.count()  # Tie breaker, trades are not comparable
+        self._lock = threading.Lock()
+
+    def add(self, strategy: "Strategy", trade: Trade):
+
+        """
+        Compute the take profit and stop loss levels of a trade whose entry price is known.
+        :param strategy: Its _exit_trade() method is called when a level is reached
+        :param trade:
+        :return:
+        """
+
+        tp_level = sl_level = None
+
+        if trade.side == "long":
+            if strategy.take_profit is not None:
+                tp_level = ("above", trade.entry_price * (1 + strategy.take_profit / 100))
+            if strategy.stop_loss is not None:
+                sl_level = ("below", trade.entry_price * (1 - strategy.stop_loss / 100))
+        elif trade.side == "short":
+            if strategy.take_profit is not None:
+                tp_level = ("below", trade.entry_price * (1 - strategy.take_profit / 100))
+            if strategy.stop_loss is not None:
+                sl_level = ("above", trade.entry_price * (1 + strategy.stop_loss / 100))
+
+        with self._lock:
+            self._active[id(trade)] = strategy
+
+            for level, reason in [(tp_level, "take_profit"), (sl_level, "stop_loss")]:
+                if level is None:
+                    continue
+                direction, price = level
+                if direction == "above":
+                    heapq.heappush(self._above, (price, next(self._counter), trade, reason))
+                else:
+                    heapq.heappush(self._below, (-price, next(self._counter), trade, reason))
+
+    def remove(self, trade: Trade):
+        with self._lock:
+            self._active.pop(id(trade), None)
+            self._clean_tops()
+
+    def remove_strategy(self, strategy: "Strategy"):
+        with self._lock:
+            for trade_id in [t_id for t_id, s in self._active.items() if s is strategy]:
+                del self._active[trade_id]
+            self._clean_tops()
+
+    def _clean_tops(self):
+        while len(self._above) > 0 and id(self._above[0][2]) not in self._active:
+            heapq.heappop(self._above)
+        while len(self._below) > 0 and id(self._below[0][2]) not in self._active:
+            heapq.heappop(self._below)
+
+    def check(self, price: float):
+
+        """
+        Called on every trade print, exits the trades whose take profit or stop loss level is reached.
+        :param price:
+        :return:
+        """
+
+        # Fast path without the lock: nothing to trigger at this price
+
+        above, below = self._above, self._below
+        if (len(above) == 0 or price < above[0][0]) and (len(below) == 0 or price > -below[0][0]):
+            return
+
+        triggered = []
+
+        with self._lock:
+            while len(self._above) > 0 and price >= self._above[0][0]:
+                triggered.append(heapq.heappop(self._above))
+            while len(self._below) > 0 and price <= -self._below[0][0]:
+                triggered.append(heapq.heappop(self._below))
+
+            exits = []
+            for level, count, trade, reason in triggered:
+                strategy = self._active.pop(id(trade), None)
+                if strategy is not None:  # A trade can reach both levels on the same print, it is exited once
+                    exits.append((strategy, trade, reason))
+
+            self._clean_tops()
+
+        for strategy, trade, reason in exits:
+            strategy.exit_trade(trade, reason)
@@ -0,0 +1,505 @@
+import collections
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import typing
+
+from models import *
+from events import dispatcher, LogEvent, OrderUpdateEvent, TradeEvent, QuoteEvent, TimerEvent
+from orders import OrderManager, EXCHANGE_STATUSES
+from ring_buffer import RingBuffer, TRADE_DTYPE, QUOTE_DTYPE
+
+if typing.TYPE_CHECKING:
+    from candle_aggregator import CandleAggregator
+    from positions import PositionTable
+    from connectors.binance_futures import BinanceFuturesClient
+    from connectors.bitmex import BitmexClient
+
+logger = logging.getLogger()
+
+
+# Client methods a strategy running in a worker can call, they are executed by the connector of the main process
+REMOTE_METHODS = ["place_order", "place_orders", "order_template", "place_order_template", "get_order_status",
+                  "find_order", "cancel_order", "get_trade_size", "get_trade_balance", "trade_size_from_balance",
+                  "get_balances", "get_historical_candles"]
+
+PLACE_ORDER_ARGS = ["contract", "order_type", "quantity", "side", "price", "tif", "client_order_id"]
+
+
+class RemoteStrategy:
+    def __init__(self, pool: "StrategyWorkerPool", b_index: int, contract: Contract, exchange: str, timeframe: str,
+                 strat_name: str):
+
+        """
+        Stands for a strategy running in a worker process, in the strategies dict of the connector: the logs and
+        trades sent back by the worker are displayed like the ones of the local strategies.
+        """
+
+        self._pool = pool
+        self._b_index = b_index
+
+        self.client = pool.client  # The orders of the worker go through this connector
+
+        self.contract = contract
+        self.exchange = exchange
+        self.tf = timeframe
+        self.stat_name = strat_name
+        self.uid: typing.Optional[str] = None  # Of the workspace row, set by the interface
+
+        self.trades: typing.List[Trade] = []
+        self.logs = []
+
+    def update_trade(self, trade_info: typing.Dict):
+        for trade in self.trades:
+            if trade.time == trade_info['time']:
+                break
+        else:
+            trade = Trade({**trade_info, "contract": self.contract})
+            self.trades.append(trade)
+
+        trade.entry_price = trade_info['entry_price']
+        trade.status = trade_info['status']
+        trade.quantity = trade_info['quantity']
+        trade.pnl = trade_info['pnl']
+
+        journal = self._pool.client.orders.journal
+        if journal is not None:
+            journal.record_trade(self._pool.client.platform, self, trade)
+
+        dispatcher.publish(OrderUpdateEvent(self._pool.client.platform, self, trade))
+
+    def add_log(self, msg: str):
+        self.logs.append({"log": msg, "displayed": False})
+        dispatcher.publish(LogEvent(self._pool.client.platform, msg))
+
+    def stop(self):
+        self._pool.stop_strategy(self._b_index)
+
+
+class StrategyWorkerPool:
+    def __init__(self, client: typing.Union["BinanceFuturesClient", "BitmexClient"],
+                 n_workers: typing.Optional[int] = None, capacity: int = 1 << 16):
+
+        """
+        Runs the strategies of a connector in worker processes, so the indicators of one symbol don't hold the GIL of
+        the websocket thread. The connector publishes every trade and quote into shared memory ring buffers that all
+        the workers read, the orders of the strategies come back to the connector through a queue.
+        The strategies are sharded by symbol: all the strategies of a symbol run in the same worker, which builds the
+        candles of the symbol once.
+        :param client:
+        :param n_workers: All the cores by default
+        :param capacity: Number of trades / quotes kept in the ring buffers
+        """
+
+        self.client = client
+        self.n_workers = n_workers or os.cpu_count()
+
+        self._symbols = list(client.contracts.keys())
+        self._symbol_index = {symbol: i for i, symbol in enumerate(self._symbols)}
+
+        self._trades = RingBuffer(TRADE_DTYPE, capacity)
+        self._quotes = RingBuffer(QUOTE_DTYPE, capacity)
+        self._publish_lock = threading.Lock()
+
+        self._requests = multiprocessing.Queue()
+        self._commands = []
+        self._responses = []
+        self._response_locks = []
+        self._processes = []
+
+        for worker_id in range(self.n_workers):
+            commands = multiprocessing.Queue()
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+
+            process = multiprocessing.Process(target=_worker_main, daemon=True,
+                                              args=(worker_id, client.platform, client.contracts,
+                                                    client.server_time_offset, self._symbols,
+                                                    self._trades.descriptor(), self._quotes.descriptor(),
+                                                    commands, self._requests, receiver))
+            process.start()
+
+            self._commands.append(commands)
+            self._responses.append(sender)
+            self._response_locks.append(threading.Lock())
+            self._processes.append(process)
+
+        self.strategies: typing.Dict[int, RemoteStrategy] = dict()
+
+        # Orders encoded for the workers by order_template(), for the risk checks of place_order_template()
+        self._templates: typing.OrderedDict[str, typing.Dict] = collections.OrderedDict()
+
+        # The orders are sent to the exchange from a thread pool, one slow request doesn't delay the others
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+
+        t = threading.Thread(target=self._serve_requests, daemon=True)
+        t.start()
+
+        logger.info("%s: %s strategy worker processes started", client.platform, self.n_workers)
+
+    def publish_trade(self, symbol: str, price: float, quantity: float, timestamp: int):
+        index = self._symbol_index.get(symbol)
+        if index is not None:
+            with self._publish_lock:
+                self._trades.publish(index, timestamp, price, quantity)
+
+    def publish_quote(self, symbol: str, bid: float, ask: float):
+        index = self._symbol_index.get(symbol)
+        if index is not None:
+            with self._publish_lock:
+                self._quotes.publish(index, int(time.time() * 1000), bid, ask)
+
+    def _worker_of(self, contract: Contract) -> int:
+        return self._symbol_index[contract.symbol] % self.n_workers
+
+    def start_strategy(self, b_index: int, strat_name: str, contract: Contract, exchange: str, timeframe: str,
+                       balance_pct: float, take_profit: float, stop_loss: float,
+                       other_params: typing.Dict) -> RemoteStrategy:
+
+        """
+        Start a strategy in the worker of its symbol.
+        :return: The local stand-in of the strategy, for the strategies dict of the connector
+        """
+
+        strategy = RemoteStrategy(self, b_index, contract, exchange, timeframe, strat_name)
+        self.strategies[b_index] = strategy
+
+        self._commands[self._worker_of(contract)].put(("start", b_index, strat_name, contract.symbol, exchange,
+                                                       timeframe, balance_pct, take_profit, stop_loss, other_params))
+
+        return strategy
+
+    def stop_strategy(self, b_index: int):
+        strategy = self.strategies.pop(b_index, None)
+        if strategy is not None:
+            self._commands[self._worker_of(strategy.contract)].put(("stop", b_index))
+
+    def stop(self):
+        for commands in self._commands:
+            commands.put(("exit",))
+        for process in self._processes:
+            process.join(timeout=2)
+
+        self._executor.shutdown(wait=False)
+        self._trades.close()
+        self._quotes.close()
+
+    def _serve_requests(self):
+        while True:
+            message = self._requests.get()
+
+            if message[0] == "call":
+                self._executor.submit(self._execute_call, *message[1:])
+
+            elif message[0] == "log":
+                b_index, msg = message[1:]
+                if b_index in self.strategies:
+                    self.strategies[b_index].add_log(msg)
+
+            elif message[0] == "trade":
+                b_index, trade_info = message[1:]
+                if b_index in self.strategies:
+                    self.strategies[b_index].update_trade(trade_info)
+
+    def _execute_call(self, worker_id: int, call_id: int, method: str, args: typing.Tuple):
+        try:
+            if self.client.orders.halted and method.startswith("place_order"):  # Stopped by the kill switch
+                result = None
+            elif self.client.orders.risk is not None and method.startswith("place_order"):
+                result = self._place_checked(method, args)
+            else:
+                result = getattr(self.client, method)(*args)
+
+            if method == "order_template" and result is not None:
+                self._templates[result] = dict(zip(PLACE_ORDER_ARGS, args))
+                if len(self._templates) > 1000:
+                    self._templates.popitem(last=False)
+            elif method == "get_order_status" and self.client.orders.risk is not None:
+                self._track_fills([result])
+            elif method == "find_order" and self.client.orders.risk is not None and result is not None:
+                self._track_fills([result[1]])
+        except Exception as e:
+            logger.error("Error in %s called by strategy worker %s: %s", method, worker_id, e)
+            result = None
+
+        with self._response_locks[worker_id]:
+            self._responses[worker_id].send((call_id, result))
+
+
+    def _place_checked(self, method: str, args: typing.Tuple):
+
+        """
+        The orders of the workers go through the risk checks of the main process, which sees the positions of all the
+        strategies. A refused order gets a rejected status, like an order refused by the exchange.
+        """
+
+        risk = self.client.orders.risk
+
+        if method == "place_orders":
+            orders = args[0]
+        elif method == "place_order":
+            orders = [dict(zip(PLACE_ORDER_ARGS, args))]
+        else:
+            orders = [{**self._templates.get(args[0], {}), "client_order_id": args[1]}]
+
+        accepted = []
+        for order in orders:
+            if 'contract' not in order:
+                refusal = "unknown order template"
+            else:
+                refusal = risk.reserve(self.client.platform, order['contract'], order['side'], order['quantity'],
+                                       order.get('client_order_id'), order.get('price'))
+            if refusal is not None:
+                logger.warning("%s order %s of a strategy worker refused by the risk checks: %s", self.client.platform,
+                               order.get('client_order_id'), refusal)
+            accepted.append(refusal is None)
+
+        if method == "place_orders":
+            results = self.client.place_orders([order for order, ok in zip(orders, accepted) if ok])
+            results = iter(results or [None] * sum(accepted))
+            statuses = [next(results) if ok else _rejected(order.get('client_order_id'))
+                        for order, ok in zip(orders, accepted)]
+            self._track_fills(statuses)
+            return statuses
+
+        if not accepted[0]:
+            return _rejected(orders[0].get('client_order_id'))
+
+        order_status = getattr(self.client, method)(*args)
+        self._track_fills([order_status])
+        return order_status
+
+    def _track_fills(self, statuses: typing.List[typing.Optional[OrderStatus]]):
+        risk = self.client.orders.risk
+
+        for order_status in statuses:
+            if order_status is None or order_status.client_order_id is None:
+                continue
+
+            risk.on_fill(order_status.client_order_id, order_status.executed_qty, order_status.avg_price)
+            if EXCHANGE_STATUSES.get(order_status.status) in ("filled", "canceled", "rejected", "expired"):
+                risk.release(order_status.client_order_id)
+
+
+def _rejected(client_order_id: typing.Optional[str]) -> OrderStatus:
+    return OrderStatus({'orderId': None, 'status': "REJECTED", 'avgPrice': 0, 'clientOrderId': client_order_id},
+                       "binance")
+
+
+class WorkerClient:
+    def __init__(self, worker_id: int, platform: str, contracts: typing.Dict[str, Contract], server_time_offset: int,
+                 requests: multiprocessing.Queue, responses):
+
+        """
+        The client of the strategies running in a worker process: the calls to the exchange are forwarded to the
+        connector of the main process and the calling thread waits for the result.
+        """
+
+        self.worker_id = worker_id
+        self.platform = platform
+        self.contracts = contracts
+        self.server_time_offset = server_time_offset
+
+        self.aggregators: typing.Dict[str, "CandleAggregator"] = dict()
+
+        # The market data read from the ring buffers goes through the dispatcher of the worker, like the timers and
+        # the order updates, so the strategies are only changed by its thread. The source is not the platform: the
+        # handlers of the connectors of the main process are still subscribed in the forked worker
+        self.feed_source = platform + "_worker"
+        dispatcher.subscribe(TradeEvent, self._on_trade, self.feed_source)
+        dispatcher.subscribe(QuoteEvent, self._on_quote, self.feed_source)
+
+        self._requests = requests
+        self._responses = responses
+
+        self._call_ids = itertools.count()
+        self._pending: typing.Dict[int, concurrent.futures.Future] = dict()
+        self._lock = threading.Lock()
+
+        self.orders = OrderManager(self)
+
+        t = threading.Thread(target=self._receive_responses, daemon=True)
+        t.start()
+
+    def __getattr__(self, name: str):
+        if name in REMOTE_METHODS:
+            return lambda *args: self._call(name, *args)
+        raise AttributeError(name)
+
+    def _call(self, method: str, *args):
+        future = concurrent.futures.Future()
+
+        with self._lock:
+            call_id = next(self._call_ids)
+            self._pending[call_id] = future
+
+        self._requests.put(("call", self.worker_id, call_id, method, args))
+
+        return future.result()
+
+    def _receive_responses(self):
+        while True:
+            try:
+                call_id, result = self._responses.recv()
+            except EOFError:
+                return
+
+            with self._lock:
+                future = self._pending.pop(call_id, None)
+
+            if future is not None:
+                future.set_result(result)
+
+    def get_aggregator(self, contract: Contract) -> "CandleAggregator":
+        from candle_aggregator import CandleAggregator
+
+        if contract.symbol not in self.aggregators:
+            self.aggregators[contract.symbol] = CandleAggregator(self.platform, contract.symbol,
+                                                                 clock_offset=self.server_time_offset)
+
+        return self.aggregators[contract.symbol]
+
+    def position_table(self, contract: Contract) -> "PositionTable":
+        return self.get_aggregator(contract).positions
+
+    def _on_trade(self, event: TradeEvent):
+        aggregator = self.aggregators.get(event.symbol)
+        if aggregator is not None:
+            aggregator.parse_trade(event.price, event.quantity, event.timestamp)
+
+    def _on_quote(self, event: QuoteEvent):
+        aggregator = self.aggregators.get(event.symbol)
+        if aggregator is not None:
+            aggregator.positions.revalue(event.bid, event.ask)
+
+
+def _worker_main(worker_id: int, platform: str, contracts: typing.Dict[str, Contract], server_time_offset: int,
+                 symbols: typing.List[str], trades_descriptor, quotes_descriptor, commands: multiprocessing.Queue,
+                 requests: multiprocessing.Queue, responses):
+
+    """
+    Main loop of a worker process: read the start / stop commands and the trades and quotes of the symbols of the
+    worker, and pass them to the dispatcher thread of the worker, which runs the strategies and sends their new logs
+    and trade updates back.
+    """
+
+    from strategies import TechnicalStrategy, BreakoutStrategy
+
+    client = WorkerClient(worker_id, platform, contracts, server_time_offset, requests, responses)
+
+    trades = RingBuffer(*trades_descriptor)
+    quotes = RingBuffer(*quotes_descriptor)
+
+    # Only the records published after the start of the worker are read
+    trade_seq = trades.write_seq
+    quote_seq = quotes.write_seq
+
+    symbol_index = {symbol: i for i, symbol in enumerate(symbols)}
+    watched = [False] * len(symbols)  # By symbol index, the symbols of the strategies of the worker
+
+    strategies = dict()
+    sent_trades: typing.Dict[int, typing.Tuple] = collections.defaultdict(tuple)
+    last_report = 0.0
+
+    def start(b_index: int, strategy, timeframe: str, candles: typing.List[Candle]):
+        aggregator = client.get_aggregator(strategy.contract)
+        if not aggregator.has_timeframe(timeframe):
+            aggregator.add_timeframe(timeframe, candles)
+        aggregator.subscribe(strategy)
+
+        strategies[b_index] = strategy
+
+    def stop(b_index: int):
+        strategy = strategies.pop(b_index, None)
+        if strategy is not None:
+            strategy.stop()
+
+    def stop_all(stopped: threading.Event):
+        for b_index in list(strategies.keys()):
+            stop(b_index)
+        stopped.set()
+
+    def report():
+
+        """
+        Logs and trades back to the interface, the trades at most once per second.
+        """
+
+        nonlocal last_report
+
+        for b_index, strategy in strategies.items():
+            if len(strategy.logs) > 0:  # Only kept until they are sent, the interface of the main process shows them
+                for log in strategy.logs:
+                    requests.put(("log", b_index, log['log']))
+                strategy.logs.clear()
+
+        if time.time() - last_report > 1:
+            for b_index, strategy in strategies.items():
+                for trade in strategy.trades:
+                    trade_info = {"time": trade.time, "entry_price": trade.entry_price, "strategy": trade.strategy,
+                                  "side": trade.side, "status": trade.status, "pnl": trade.pnl,
+                                  "quantity": trade.quantity, "entry_id": trade.entry_id}
+                    if sent_trades[id(trade)] != tuple(trade_info.values()):
+                        requests.put(("trade", b_index, trade_info))
+                        sent_trades[id(trade)] = tuple(trade_info.values())
+            last_report = time.time()
+
+        dispatcher.call_later(0.01, report)
+
+    dispatcher.call_later(0.01, report)
+
+    while True:
+
+        # Commands from the main process
+
+        try:
+            while True:
+                command = commands.get_nowait()
+
+                if command[0] == "exit":
+                    stopped = threading.Event()
+                    dispatcher.publish(TimerEvent(lambda: stop_all(stopped)))
+                    stopped.wait(timeout=1)
+                    trades.close()
+                    quotes.close()
+                    return
+
+                elif command[0] == "start":
+                    b_index, strat_name, symbol, exchange, timeframe, balance_pct, take_profit, stop_loss, \
+                        other_params = command[1:]
+
+                    contract = contracts[symbol]
+                    strategy_class = TechnicalStrategy if strat_name == "Technical" else BreakoutStrategy
+                    strategy = strategy_class(client, contract, exchange, timeframe, balance_pct, take_profit,
+                                              stop_loss, other_params)
+
+                    # Requested here, the dispatcher thread must not wait for the main process
+                    candles = client.get_historical_candles(contract, timeframe) or []
+                    dispatcher.publish(TimerEvent(lambda args=(b_index, strategy, timeframe, candles): start(*args)))
+
+                    watched[symbol_index[symbol]] = True
+
+                elif command[0] == "stop":
+                    dispatcher.publish(TimerEvent(lambda b_index=command[1]: stop(b_index)))
+
+        except queue.Empty:
+            pass
+
+        # Market data
+
+        records, trade_seq = trades.read_copy(trade_seq)
+        for r in records.tolist():  # Tuples of Python numbers: seq, symbol, timestamp, price, quantity
+            if watched[r[1]]:
+                dispatcher.publish(TradeEvent(client.feed_source, symbols[r[1]], r[3], r[4], r[2]))
+
+        quote_records, quote_seq = quotes.read_copy(quote_seq)
+        for r in quote_records.tolist():  # seq, symbol, timestamp, bid, ask
+            if watched[r[1]]:
+                dispatcher.publish(QuoteEvent(client.feed_source, symbols[r[1]], r[3], r[4]))
+
+        if len(records) == 0 and len(quote_records) == 0:
+            time.sleep(0.001)